@@ -1,15 +1,29 @@
-from prompt_generator import phrase_extraction, prompt_generator
-from prompt_preprocessing import tokenize_prompts_beto
-from inference import extract_bert_embeddings_dataframe
+from prompt_generator import prompt_generator, iter_prompts, save_prompt_dictionary
+from corpus_ingestion import corpus_phrase_extraction
+from ingestion_cache import IngestionCache
+from prompt_store import PromptStore, store_config_key
+from prompt_preprocessing import tokenize_prompts_beto, select_prompt_records, deduplicate_prompts, expand_predictions, expand_prediction_store, attach_provenance
+from inference import extract_bert_embeddings_dataframe, extract_multi_model_predictions
+from model_cache import load_tokenizer
+from token_store import tokenizer_fingerprint
+from quantization import quantization_agreement
+from sweep_scheduler import SweepScheduler, estimate_model_memory
+from staged_pipeline import QUEUE_SIZE, iter_corpus_prompts, iter_keyed_prompts, corpus_order, canonical_order, run_staged_inference
 from clustering import compute_kmeans_clustering, plot_elbow_curve
+import numpy as np
 import pandas as pd
+import shutil
+import time
 import os
 
 
 
 class pipeline_PromptORE:
     def __init__(self):
-        pass
+        # Seconds spent in every stage of the last run
+        self.timings = {}
+        # Result of quantization_agreement by model
+        self.agreement = {}
 
     """
     A pipeline class for generating prompts, extracting BERT embeddings, and performing clustering using PromptORE approach.
@@ -18,7 +32,8 @@ class pipeline_PromptORE:
         None
 
     Attributes:
-        None
+        agreement (dict): The quantization_agreement of every model checked with agreement_sample.
+        timings (dict): Seconds spent in every stage of the last run_pipeline or model of run_models.
 
     Methods:
         run_pipeline(xml_input, model_name, batch_size, entity_number, prompt_type, json_file_path_name, max_k) -> pd.DataFrame:
@@ -29,6 +44,132 @@ class pipeline_PromptORE:
         results_dataframe = pipeline.run_pipeline(xml_input='input.xml', model_name='model_name', batch_size=8, entity_number=2, prompt_type='prompt_1', json_file_path_name='output.json', max_k=20)
     """
 
+    def generate_prompts(
+        self,
+        xml_input: str,
+        entity_number: int = 2,
+        full_prompt: bool = True,
+        json_file_path_name: str = None,
+        max_workers: int = None,
+        cache_dir: str = None,
+        prompt_store: str = None,
+        pair_policy: str = 'baseline',
+        pair_window: int = None,
+        template_set: str = 'baseline',
+        max_prompts: int = None,
+        max_prompts_per_document: int = None,
+        with_provenance: bool = False
+    ):
+        """
+        Extracts the phrases of the XML files and generates their prompts.
+
+        Args:
+            See run_pipeline. If prompt_store holds the prompts of the same files and options,
+            they are read from it without extracting the XML files again.
+            with_provenance (bool): Always return the prompts as tuples of iter_prompts, each one with
+                the (source, div, sentence) of its phrase. Default: False.
+
+        Returns:
+            The prompt dictionary of prompt_generator, or the (template_id, entity_pair, text)
+            tuples of iter_prompts when the prompts are streamed.
+        """
+        if xml_input is None:
+            raise ValueError("xml file is required")
+
+        prompt_options = {
+            'entity_number': entity_number,
+            'full_extraction': full_prompt,
+            'pair_policy': pair_policy,
+            'pair_window': pair_window,
+            'template_set': template_set,
+            'max_prompts': max_prompts,
+            'max_prompts_per_document': max_prompts_per_document
+        }
+        store = None
+        store_key = None
+        if prompt_store is not None:
+            store = PromptStore(prompt_store)
+            store_key = store_config_key(xml_input, prompt_options)
+            if store.is_complete(store_key):
+                print(f'Prompts read from {prompt_store}')
+                return store.iter_prompts(with_provenance=with_provenance)
+
+        if cache_dir is not None:
+            _, prompt_dictionary = IngestionCache(cache_dir).extract(
+                xml_input,
+                json_file_path_name=json_file_path_name,
+                max_workers=max_workers,
+                prompt_store=store,
+                store_key=store_key,
+                with_provenance=with_provenance,
+                **prompt_options
+            )
+            print('Phrases with entities extracted')
+            print('Prompts generated')
+            # A list would be taken for a list of prompt texts by select_prompts
+            return iter(prompt_dictionary) if with_provenance else prompt_dictionary
+
+        entity_dictionary = corpus_phrase_extraction(xml_input, max_workers=max_workers, records=True)
+        print('Phrases with entities extracted')
+
+        if store is not None:
+            store.write(iter_prompts(phrase_input=entity_dictionary, with_provenance=True, **prompt_options), store_key)
+            print(f'Prompts generated and saved at {prompt_store}')
+            return store.iter_prompts(with_provenance=with_provenance)
+
+        if with_provenance:
+            prompt_dictionary = iter_prompts(phrase_input=entity_dictionary, with_provenance=True, **prompt_options)
+            if json_file_path_name:
+                prompt_records = list(prompt_dictionary)
+                save_prompt_dictionary(prompt_records, json_file_path_name)
+                prompt_dictionary = iter(prompt_records)
+        elif json_file_path_name:
+            prompt_dictionary = prompt_generator(
+                phrase_input=entity_dictionary,
+                json_file_path_name=json_file_path_name,
+                **prompt_options
+            )
+        else:
+            # Nothing to save, so the prompts are streamed to the tokenizer
+            prompt_dictionary = iter_prompts(phrase_input=entity_dictionary, **prompt_options)
+        print('Prompts generated')
+
+        return prompt_dictionary
+
+    def _timed(self, stage: str, function, *args, **kwargs):
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        self.timings[stage] = self.timings.get(stage, 0.0) + time.perf_counter() - start
+        return result
+
+    def prepare_prompts(
+        self,
+        xml_input: str,
+        prompt_type: str,
+        full_extraction: bool,
+        deduplicate: bool,
+        prompt_options: dict
+    ) -> tuple:
+        """
+        Extracts, selects and deduplicates the prompts of run_pipeline, the preprocessing that
+        does not depend on the model.
+
+        Args:
+            xml_input, prompt_type, full_extraction, deduplicate: See run_pipeline.
+            prompt_options (dict): The arguments of generate_prompts.
+
+        Returns:
+            tuple: The prompts and their provenance in the order of select_prompt_records, the unique
+            prompts to infer, and the unique prompt of every prompt (None without deduplicate).
+        """
+        prompt_dictionary = self.generate_prompts(xml_input, with_provenance=True, **prompt_options)
+
+        prompts, provenance = select_prompt_records(prompt_dictionary, prompt_type=prompt_type, full_extraction=full_extraction)
+        unique_prompts, prompt_inverse = prompts, None
+        if deduplicate:
+            unique_prompts, prompt_inverse = deduplicate_prompts(prompts)
+        return prompts, provenance, unique_prompts, prompt_inverse
+
     def run_pipeline(
         self,
         xml_input: str = None,
@@ -44,7 +185,30 @@ class pipeline_PromptORE:
         max_k: int = 20,
         return_tensors: bool = False,
         save_df: bool = False,
-        df_name: str = None
+        df_name: str = None,
+        max_workers: int = None,
+        cache_dir: str = None,
+        pair_policy: str = 'baseline',
+        pair_window: int = None,
+        template_set: str = 'baseline',
+        max_prompts: int = None,
+        max_prompts_per_document: int = None,
+        deduplicate: bool = True,
+        prompt_store: str = None,
+        spliced_tokenization: bool = True,
+        token_cache_dir: str = None,
+        embedding: str = 'logits',
+        hidden_layers=-1,
+        layer_pooling: str = 'mean',
+        embedding_cache_dir: str = None,
+        prediction_dir: str = None,
+        embedding_dtype: str = 'float32',
+        staged: bool = False,
+        queue_size: int = QUEUE_SIZE,
+        max_tokens: int = None,
+        precision: str = 'float32',
+        quantized_cache_dir: str = None,
+        agreement_sample: int = None
     ) -> pd.DataFrame:
 
         """
@@ -52,7 +216,7 @@ class pipeline_PromptORE:
         and performing clustering using the PromptORE approach.
 
         Args:
-            xml_input (str, mandatory): The path to the XML input file. Default is None.
+            xml_input (str, mandatory): The path to the XML input file, or a directory or glob pattern of XML files. Default is None.
             model_name (str, optional): The name of the BERT model to use. Default is 'dccuchile/bert-base-spanish-wwm-uncased'.
             batch_size (int, optional): Batch size for BERT embeddings extraction. Default is 8.
             full_prompt (bool, optional): if true returns a json file with all the prompts.
@@ -63,10 +227,35 @@ class pipeline_PromptORE:
             max_k (int, optional): The maximum number of clusters to consider for elbow curve. Default is 20.
             return_tensors (bool, optional): If True return the pd.DataFrame with the embeddings attached for the MASK token. Default is False.
             save_df (bool, optional): Parameter if you want to save the results. Default is False
+            max_workers (int, optional): Number of processes to extract the phrases of a corpus of XML files. Default is None (one per CPU).
+            cache_dir (str, optional): Directory of the ingestion cache. If given, only the XML files and divs changed since the last run are processed again. Default is None.
+            pair_policy (str, optional): How the entities of a phrase are paired: 'baseline', 'all', 'adjacent' or 'window'. 'baseline' gives the pairs of the original prompts. Default is 'baseline'.
+            pair_window (int, optional): Maximum number of words between the entities of a pair for the 'window' policy. Default is None.
+            template_set (str, optional): 'baseline' for the templates of the original prompts, only for 1 to 3 entities, 'uniform' for the same templates ending with a period for any number of entities, or 'legacy' for the original prompts with their repetitions. Default is 'baseline'.
+            max_prompts (int, optional): Maximum number of prompts of the run. Default is None (no limit).
+            max_prompts_per_document (int, optional): Maximum number of prompts of every XML file. Default is None (no limit).
+            deduplicate (bool, optional): Infer every distinct prompt once and copy the results to its repetitions. Default is True.
+            prompt_store (str, optional): Path of a JSON Lines prompt store. The prompts are saved there instead of json_file_path_name, and a later run with the same XML files and options reads them without extracting the XML files again. Default is None.
+            spliced_tokenization (bool, optional): Tokenize every phrase, entity and template fragment once and splice their token ids instead of tokenizing every prompt. The ids are the same. Default is True.
+            token_cache_dir (str, optional): Directory where the tokenized prompts are saved as memory-mapped shards. A later run with the same prompts and an identical tokenizer, for example another checkpoint of run_models, reads them instead of tokenizing again. Default is None.
+            embedding (str, optional): 'logits' clusters the vocabulary scores of the LM head at the mask, 'hidden' the encoder hidden state at the mask, 40 to 50 times smaller. The predicted tokens come from the LM head in both cases. Default is 'logits'.
+            hidden_layers (int or list, optional): Index of the hidden layer used by the 'hidden' embedding (0 is the embedding layer), or a list of layers. Default is -1 (last layer).
+            layer_pooling (str, optional): How several hidden_layers are combined: 'mean' or 'concat'. Default is 'mean'.
+            embedding_cache_dir (str, optional): Directory of the embedding cache. The predictions are saved there by model weights, embedding configuration and prompt token ids, so a later run with the same model only infers the prompts it has not seen, for example to try another number of clusters or templates. Default is None.
+            prediction_dir (str, optional): Directory where the predictions are written as they are inferred, so the memory of the inference depends on the batch size and not on the corpus size. The pipeline then returns the PredictionStore of that directory, whose DataFrames are built on demand, for example with iter_dataframes. Default is None.
+            embedding_dtype (str, optional): 'float32' or 'float16' embeddings in the prediction_dir. Default is 'float32'.
+            staged (bool, optional): Run the ingestion and the tokenization in background threads that feed the inference through bounded queues, so the first batch is inferred within seconds instead of after the whole corpus is read and tokenized. The results are the same. Without cache_dir, prompt_store and max_prompts the XML files are turned into prompts one by one, otherwise the prompts of generate_prompts are streamed. token_cache_dir is not used. Default is False.
+            queue_size (int, optional): Maximum number of items waiting between two stages of the staged pipeline. Default is QUEUE_SIZE.
+            max_tokens (int, optional): Group the prompts by length and pack every batch up to this number of padded tokens instead of taking batch_size prompts, so short prompts are not padded to long ones and long batches fit in memory. A batch that runs out of memory is split and the next batches shrink. The tokens per second and the padding efficiency are printed. Default is None.
+            precision (str, optional): 'float32', or 'int8' to run the model on the CPU with its Linear layers quantized to int8 when it is loaded, usually faster on CPU nodes with slightly different predictions. Default is 'float32'.
+            quantized_cache_dir (str, optional): Directory where the int8 models are saved, so a later run with the same checkpoint reads them instead of quantizing the model again. Default is None.
+            agreement_sample (int, optional): With the int8 precision, infer this number of prompts with both precisions first and print the top-1 mask token agreement, the adjusted Rand index of their clusterings and their speed, see quantization_agreement. Not run with staged. Default is None.
 
         Returns:
             pd.DataFrame: A DataFrame containing the first 10 predicted tokens,
-            objective phrases, BERT embeddings, and predicted clustering labels.
+            objective phrases, BERT embeddings, and predicted clustering labels, one row per
+            prompt in a deterministic order, with the template, entity pair, document, div
+            and sentence of the prompt. The PredictionStore with the same columns if prediction_dir is given.
 
         Usage:
             pipeline = PipelinePromptORE()
@@ -74,32 +263,157 @@ class pipeline_PromptORE:
                                                      batch_size=8, entity_number=2, prompt_type='prompt_1',
                                                      json_file_path_name='output.json', max_k=20)
         """
-        if xml_input is None:
-            raise ValueError("xml file is required")
+        prompt_options = {
+            'entity_number': entity_number,
+            'full_prompt': full_prompt,
+            'json_file_path_name': json_file_path_name,
+            'max_workers': max_workers,
+            'cache_dir': cache_dir,
+            'prompt_store': prompt_store,
+            'pair_policy': pair_policy,
+            'pair_window': pair_window,
+            'template_set': template_set,
+            'max_prompts': max_prompts,
+            'max_prompts_per_document': max_prompts_per_document
+        }
+        inference_options = {
+            'model_name': model_name,
+            'batch_size': batch_size,
+            'embedding': embedding,
+            'hidden_layers': hidden_layers,
+            'layer_pooling': layer_pooling,
+            'embedding_cache_dir': embedding_cache_dir,
+            'embedding_dtype': embedding_dtype,
+            'max_tokens': max_tokens,
+            'precision': precision,
+            'quantized_cache_dir': quantized_cache_dir
+        }
+        clustering_options = {
+            'elbow_curve': elbow_curve,
+            'num_clusters': num_clusters,
+            'max_k': max_k,
+            'return_tensors': return_tensors,
+            'save_df': save_df,
+            'df_name': df_name
+        }
 
-        entity_dictionary = phrase_extraction(xml_path=xml_input, return_dict=True)
-        print('Phrases with entities extracted')
+        self.timings = {}
+        if staged:
+            embeddings_dataframe, prompts, provenance, prompt_inverse = self._timed(
+                'staged inference', self._run_staged,
+                xml_input, prompt_type, full_extraction, deduplicate, spliced_tokenization,
+                prompt_options, inference_options, prediction_dir, queue_size
+            )
+            if prediction_dir is not None:
+                return self._timed(
+                    'clustering', self._finish_streamed,
+                    embeddings_dataframe, prompts, provenance, prompt_inverse, prediction_dir, **clustering_options
+                )
+            return self._timed(
+                'clustering', self._finish_dataframe,
+                embeddings_dataframe, prompts, provenance, prompt_inverse, **clustering_options
+            )
 
-        prompt_dictionary = prompt_generator(
-            phrase_input=entity_dictionary,
-            entity_number=entity_number,
-            json_file_path_name=json_file_path_name,
-            full_extraction=full_prompt
+        prompts, provenance, unique_prompts, prompt_inverse = self._timed(
+            'preprocessing', self.prepare_prompts, xml_input, prompt_type, full_extraction, deduplicate, prompt_options
         )
-        print('Prompts generated')
 
-        tokenized_inputs = tokenize_prompts_beto(
-            prompt_dictionary,
+        tokenized_inputs = self._timed(
+            'tokenization', tokenize_prompts_beto,
+            unique_prompts,
             prompt_type=prompt_type,
-            full_extraction=full_extraction
+            full_extraction=full_extraction,
+            tokenizer_name=model_name,
+            spliced=spliced_tokenization,
+            token_cache_dir=token_cache_dir
         )
         print('Inputs tokenized')
 
-        embeddings_dataframe = extract_bert_embeddings_dataframe(
+        return self._infer_and_cluster(
+            tokenized_inputs, prompts, provenance, prompt_inverse, prediction_dir, inference_options, clustering_options,
+            agreement_sample
+        )
+
+    def _infer_and_cluster(
+        self,
+        tokenized_inputs,
+        prompts: list,
+        provenance: pd.DataFrame,
+        prompt_inverse: list,
+        prediction_dir: str,
+        inference_options: dict,
+        clustering_options: dict,
+        agreement_sample: int = None
+    ):
+        """
+        Inference and clustering of run_pipeline, the part run for every model of run_models.
+
+        Returns:
+            pd.DataFrame: See run_pipeline, or the PredictionStore if prediction_dir is given.
+        """
+        if inference_options['precision'] == 'int8' and agreement_sample:
+            self.agreement[inference_options['model_name']] = self._timed(
+                'agreement check', quantization_agreement,
+                tokenized_inputs,
+                model_name=inference_options['model_name'],
+                sample_size=agreement_sample,
+                num_clusters=clustering_options['num_clusters'],
+                batch_size=inference_options['batch_size'],
+                embedding=inference_options['embedding'],
+                layers=inference_options['hidden_layers'],
+                layer_pooling=inference_options['layer_pooling'],
+                max_tokens=inference_options['max_tokens'],
+                quantized_cache_dir=inference_options['quantized_cache_dir']
+            )
+
+        if prediction_dir is not None:
+            return self._run_streamed(
+                tokenized_inputs, prompts, provenance, prompt_inverse, prediction_dir,
+                **inference_options, **clustering_options
+            )
+
+        embeddings_dataframe = self._timed(
+            'inference', extract_bert_embeddings_dataframe,
             inputs_tokenized=tokenized_inputs,
-            model_name=model_name,
-            batch_size=batch_size
+            model_name=inference_options['model_name'],
+            batch_size=inference_options['batch_size'],
+            embedding=inference_options['embedding'],
+            layers=inference_options['hidden_layers'],
+            layer_pooling=inference_options['layer_pooling'],
+            decode_phrases=False,
+            embedding_cache=inference_options['embedding_cache_dir'],
+            max_tokens=inference_options['max_tokens'],
+            precision=inference_options['precision'],
+            quantized_cache_dir=inference_options['quantized_cache_dir']
+        )
+        return self._timed(
+            'clustering', self._finish_dataframe,
+            embeddings_dataframe, prompts, provenance, prompt_inverse, **clustering_options
         )
+
+    def _finish_dataframe(
+        self,
+        embeddings_dataframe: pd.DataFrame,
+        prompts: list,
+        provenance: pd.DataFrame,
+        prompt_inverse: list,
+        elbow_curve: bool,
+        num_clusters: int,
+        max_k: int,
+        return_tensors: bool,
+        save_df: bool,
+        df_name: str
+    ) -> pd.DataFrame:
+        """
+        Clustering of run_pipeline for the predictions kept in memory.
+
+        Returns:
+            pd.DataFrame: See run_pipeline.
+        """
+        if prompt_inverse is not None:
+            embeddings_dataframe = expand_predictions(embeddings_dataframe, prompt_inverse)
+        # The phrases are rebuilt from the prompt texts instead of decoding the token ids
+        embeddings_dataframe = attach_provenance(embeddings_dataframe, prompts, provenance)
         if elbow_curve:
             plot_elbow_curve(embeddings_dataframe, max_k=max_k)
 
@@ -134,24 +448,257 @@ class pipeline_PromptORE:
         print('DataFrame created')
         return clusters_dataframe
 
+    def _run_streamed(
+        self,
+        tokenized_inputs,
+        prompts: list,
+        provenance: pd.DataFrame,
+        prompt_inverse: list,
+        prediction_dir: str,
+        model_name: str,
+        batch_size: int,
+        embedding: str,
+        hidden_layers,
+        layer_pooling: str,
+        embedding_cache_dir: str,
+        embedding_dtype: str,
+        max_tokens: int,
+        precision: str,
+        quantized_cache_dir: str,
+        elbow_curve: bool,
+        num_clusters: int,
+        max_k: int,
+        return_tensors: bool,
+        save_df: bool,
+        df_name: str
+    ):
+        """
+        Inference and clustering of run_pipeline through a PredictionStore, see prediction_dir.
+
+        Returns:
+            PredictionStore: The predictions, with the prompts, their provenance and the predicted_label column.
+        """
+        # The store of the unique prompts is only needed until it is fanned out
+        inference_dir = prediction_dir if prompt_inverse is None else prediction_dir + '.unique'
+        predictions = self._timed(
+            'inference', extract_bert_embeddings_dataframe,
+            inputs_tokenized=tokenized_inputs,
+            model_name=model_name,
+            batch_size=batch_size,
+            embedding=embedding,
+            layers=hidden_layers,
+            layer_pooling=layer_pooling,
+            decode_phrases=False,
+            embedding_cache=embedding_cache_dir,
+            prediction_dir=inference_dir,
+            embedding_dtype=embedding_dtype,
+            max_tokens=max_tokens,
+            precision=precision,
+            quantized_cache_dir=quantized_cache_dir
+        )
+        return self._timed(
+            'clustering', self._finish_streamed,
+            predictions, prompts, provenance, prompt_inverse, prediction_dir,
+            elbow_curve=elbow_curve,
+            num_clusters=num_clusters,
+            max_k=max_k,
+            return_tensors=return_tensors,
+            save_df=save_df,
+            df_name=df_name
+        )
+
+    def _finish_streamed(
+        self,
+        predictions,
+        prompts: list,
+        provenance: pd.DataFrame,
+        prompt_inverse: list,
+        prediction_dir: str,
+        elbow_curve: bool,
+        num_clusters: int,
+        max_k: int,
+        return_tensors: bool,
+        save_df: bool,
+        df_name: str
+    ):
+        """
+        Clustering of run_pipeline for the predictions of a PredictionStore.
+
+        Args:
+            predictions (PredictionStore): The predictions of the unique prompts if prompt_inverse is given,
+                in a directory removed once they are fanned out to prediction_dir.
+
+        Returns:
+            PredictionStore: See _run_streamed.
+        """
+        if prompt_inverse is not None:
+            inference_dir = predictions.directory
+            predictions = expand_prediction_store(predictions, prompt_inverse, prediction_dir)
+            shutil.rmtree(inference_dir)
+        # The phrases and the provenance are added to the DataFrames of the store on demand
+        predictions.save_prompts(prompts, provenance, tokenizer='bert')
+
+        if elbow_curve:
+            plot_elbow_curve(predictions, max_k=max_k)
+            num_clusters = int(input("Enter the number of clusters: "))
+        predictions.save_column('predicted_label', compute_kmeans_clustering(
+            predictions,
+            n_rel=num_clusters,
+            random_state=42
+        ))
+
+        if save_df:
+            predictions.to_csv(df_name or 'clusters_dataframe.csv', embeddings=return_tensors, encoding='utf-8')
+        print(f'Predictions saved at {prediction_dir}')
+        return predictions
+
+    def _run_staged(
+        self,
+        xml_input: str,
+        prompt_type: str,
+        full_extraction: bool,
+        deduplicate: bool,
+        spliced_tokenization: bool,
+        prompt_options: dict,
+        inference_options: dict,
+        prediction_dir: str,
+        queue_size: int
+    ) -> tuple:
+        """
+        Ingestion, tokenization and inference of run_pipeline as concurrent stages, see staged.
+
+        Returns:
+            tuple: The predictions of the prompts in the order they were inferred (a DataFrame, or the
+            PredictionStore in prediction_dir + '.unique' if prediction_dir is given), the prompts and
+            their provenance in the order of select_prompt_records, and for every prompt its row in the predictions.
+        """
+        if xml_input is None:
+            raise ValueError("xml file is required")
+        if not full_extraction and prompt_type is None:
+            raise ValueError('If full_extraction is not intended, please introduce a prompt_type')
+
+        selected_type = None if full_extraction else prompt_type
+        json_file_path_name = None
+        generated = None
+        if prompt_options['cache_dir'] is None and prompt_options['prompt_store'] is None and prompt_options['max_prompts'] is None:
+            # The XML files are turned into prompts one by one, the JSON file is written at the end
+            json_file_path_name = prompt_options['json_file_path_name']
+            generated = [] if json_file_path_name else None
+            keyed_prompts = iter_corpus_prompts(
+                xml_input,
+                max_workers=prompt_options['max_workers'],
+                prompt_type=selected_type,
+                generated=generated,
+                full_extraction=prompt_options['full_prompt'],
+                entity_number=prompt_options['entity_number'],
+                pair_policy=prompt_options['pair_policy'],
+                pair_window=prompt_options['pair_window'],
+                template_set=prompt_options['template_set'],
+                max_prompts_per_document=prompt_options['max_prompts_per_document']
+            )
+        else:
+            def generated_prompts():
+                # Run by the ingestion stage, not when the pipeline starts
+                yield from self.generate_prompts(xml_input, with_provenance=True, **prompt_options)
+            keyed_prompts = iter_keyed_prompts(generated_prompts(), prompt_type=selected_type)
+
+        predictions, records = run_staged_inference(
+            keyed_prompts,
+            model_name=inference_options['model_name'],
+            batch_size=inference_options['batch_size'],
+            embedding=inference_options['embedding'],
+            layers=inference_options['hidden_layers'],
+            layer_pooling=inference_options['layer_pooling'],
+            deduplicate=deduplicate,
+            spliced=spliced_tokenization,
+            embedding_cache=inference_options['embedding_cache_dir'],
+            prediction_dir=prediction_dir + '.unique' if prediction_dir is not None else None,
+            embedding_dtype=inference_options['embedding_dtype'],
+            queue_size=queue_size,
+            max_tokens=inference_options['max_tokens'],
+            precision=inference_options['precision'],
+            quantized_cache_dir=inference_options['quantized_cache_dir']
+        )
+
+        # The prompts arrive file by file, they are put back in the order of the merged corpus
+        order = canonical_order(records['keys'], [prompt[0] for prompt in records['prompts']])
+        if generated is not None:
+            positions = corpus_order([key for key, _ in generated])
+            save_prompt_dictionary([generated[position][1] for position in positions.tolist()], json_file_path_name)
+        # A list would be taken for a list of prompt texts by select_prompts
+        prompts, provenance = select_prompt_records(
+            (records['prompts'][position] for position in order.tolist()),
+            prompt_type=prompt_type,
+            full_extraction=full_extraction
+        )
+        prompt_inverse = np.asarray(records['inverse'], dtype=np.int64)[order].tolist()
+        return predictions, prompts, provenance, prompt_inverse
+
     def run_models(
             self,
             xml_input:str,
             models_path: str,
             output_folder: str,
             batch_size: int = 32,
-            entity_number: int = 3
+            entity_number: int = 3,
+            max_workers: int = None,
+            cache_dir: str = None,
+            pair_policy: str = 'baseline',
+            pair_window: int = None,
+            template_set: str = 'baseline',
+            max_prompts: int = None,
+            max_prompts_per_document: int = None,
+            prompt_store: str = None,
+            token_cache_dir: str = None,
+            embedding: str = 'logits',
+            hidden_layers=-1,
+            layer_pooling: str = 'mean',
+            embedding_cache_dir: str = None,
+            prediction_dir: str = None,
+            embedding_dtype: str = 'float32',
+            staged: bool = False,
+            queue_size: int = QUEUE_SIZE,
+            max_tokens: int = None,
+            workers: int = 1,
+            threads_per_worker: int = None,
+            interop_threads: int = 1,
+            memory_budget: float = None,
+            shared_batches: bool = False,
+            precision: str = 'float32',
+            quantized_cache_dir: str = None,
+            agreement_sample: int = None
                    ):
         """
-        Runs multiple models using a pipeline and saves the results to a JSON file.
+        Runs multiple models using a pipeline and saves the results to CSV files.
+        The prompts are extracted and tokenized once, see _sweep_models.
 
         Args:
-            xml_input (str): The path to the XML input file.
+            xml_input (str): The path to the XML input file, or a directory or glob pattern of XML files.
             models_path (str): The path to the models.
-            json_results (str): The path to the JSON file where the results will be saved.
-
-        Returns:
-            dict: A dictionary where the model names are the keys and the results are the values.
+            output_folder (str): The path to the folder where the CSV file of every model, <model>_clustering.csv, will be stored.
+            max_workers (int): Number of processes to extract the phrases of a corpus of XML files.
+            cache_dir (str): Directory of the ingestion cache, to reprocess only the XML files changed since the last run.
+            pair_policy, pair_window, template_set, max_prompts, max_prompts_per_document: See run_pipeline.
+            prompt_store (str): Path of the prompt store shared by all the models. See run_pipeline.
+            token_cache_dir (str): Directory of the tokenized prompts shared by the models with the same tokenizer. See run_pipeline.
+            embedding, hidden_layers, layer_pooling, embedding_cache_dir: See run_pipeline. The embedding cache is shared by all the models.
+            prediction_dir (str): If given, the predictions of every model are streamed to a PredictionStore of this directory named after the model. See run_pipeline.
+            embedding_dtype (str): See run_pipeline.
+            staged, queue_size: See run_pipeline.
+            max_tokens (int): Padded tokens per batch instead of batch_size prompts. See run_pipeline.
+            precision, quantized_cache_dir (str): See run_pipeline. The int8 models are quantized once per worker.
+            agreement_sample (int): See run_pipeline. The agreement of every model is checked before its inference, except with shared_batches.
+            workers (int): Number of models inferred at the same time, each one in its own process, see SweepScheduler.
+                The prompts are tokenized before the workers start, and a model that fails does not stop the others.
+                staged is not used and embedding_cache_dir is not supported with several workers. Default: 1.
+            threads_per_worker (int): torch threads of every worker. Default: None (the CPU cores divided by the workers).
+            interop_threads (int): torch inter-op threads of every worker. Default: 1.
+            memory_budget (float): Gigabytes of memory shared by the workers. A model starts only when its estimated
+                memory, three times its weight files, fits in the budget left by the running ones. Default: None (no budget).
+            shared_batches (bool): Load the models with the same tokenizer together and run every batch through all
+                of them, so the batches are collated, moved to the device and their masks found once for all the models,
+                see extract_multi_model_predictions. The time of every model per batch is printed. It cannot be combined
+                with workers nor embedding_cache_dir, and staged is not used. Default: False.
         """
         models_dict = {}
 
@@ -160,27 +707,313 @@ class pipeline_PromptORE:
                 if dire != '__pycache__':
                     models_dict[dire] = os.path.join(root, dire)
 
+        # The same options run_pipeline would receive for every model
+        prompt_options = {
+            'entity_number': entity_number,
+            'full_prompt': True,
+            'json_file_path_name': 'prompts_beto.json',
+            'max_workers': max_workers,
+            'cache_dir': cache_dir,
+            'prompt_store': prompt_store,
+            'pair_policy': pair_policy,
+            'pair_window': pair_window,
+            'template_set': template_set,
+            'max_prompts': max_prompts,
+            'max_prompts_per_document': max_prompts_per_document
+        }
+        clustering_options = {
+            'elbow_curve': False,
+            'num_clusters': 4,
+            'max_k': 10,
+            'return_tensors': False,
+            'save_df': False,
+            'df_name': None
+        }
+
+        inference_options = {
+            'batch_size': batch_size,
+            'embedding': embedding,
+            'hidden_layers': hidden_layers,
+            'layer_pooling': layer_pooling,
+            'embedding_cache_dir': embedding_cache_dir,
+            'embedding_dtype': embedding_dtype,
+            'max_tokens': max_tokens,
+            'precision': precision,
+            'quantized_cache_dir': quantized_cache_dir
+        }
+
+        if shared_batches:
+            if workers > 1:
+                raise ValueError('shared_batches runs all the models in one process, use workers=1')
+            if embedding_cache_dir is not None:
+                raise ValueError('The embedding cache is not used with shared_batches, every model would infer different prompts')
+            return self._run_shared_batches(
+                models_dict, xml_input, output_folder, prompt_options, inference_options, clustering_options,
+                token_cache_dir, prediction_dir
+            )
+
+        scheduler = None
+        if workers > 1 and len(models_dict) > 1:
+            if embedding_cache_dir is not None:
+                raise ValueError('The embedding cache cannot be written by several workers at the same time, use workers=1')
+            scheduler = SweepScheduler(
+                workers=workers,
+                threads_per_worker=threads_per_worker,
+                interop_threads=interop_threads,
+                memory_budget=int(memory_budget * 1024 ** 3) if memory_budget is not None else None
+            )
+
+        self._sweep_models(
+            models_dict, xml_input, output_folder, prompt_options, inference_options, clustering_options,
+            token_cache_dir, prediction_dir, staged, queue_size, scheduler, agreement_sample
+        )
+
+    def _sweep_models(
+        self,
+        models_dict: dict,
+        xml_input: str,
+        output_folder: str,
+        prompt_options: dict,
+        inference_options: dict,
+        clustering_options: dict,
+        token_cache_dir: str,
+        prediction_dir: str,
+        staged: bool,
+        queue_size: int,
+        scheduler: SweepScheduler = None,
+        agreement_sample: int = None
+    ):
+        """
+        Runs the models of run_models. The prompts are extracted once and tokenized once for every
+        tokenizer, only the inference and the clustering run for every model. The seconds of every
+        stage are printed per model and for the whole sweep.
+
+        Args:
+            models_dict (dict): The directory of every model by name.
+            prompt_options, inference_options, clustering_options (dict): The options of run_pipeline,
+                the model_name of inference_options is set to every model directory.
+            xml_input, output_folder, token_cache_dir, prediction_dir, staged, queue_size: See run_models.
+            scheduler (SweepScheduler): If given, the models are prepared one after another and inferred by its
+                worker processes, staged is not used. Default: None.
+            agreement_sample (int): See run_models. Default: None.
+        """
+        prompt_type, full_extraction, deduplicate, spliced_tokenization = None, True, True, True
+
+        # The prompts are extracted once for all the models, and tokenized once for every tokenizer
+        prepared = None
+        tokenized = {}
+        sweep_timings = {}
+        jobs = {}
+        sweep_start = time.perf_counter()
 
         for model, path in models_dict.items():
-            print(f'running model: {model}')
-            
+            print(f'running model: {model}' if scheduler is None else f'preparing model: {model}')
+            self.timings = {}
+            model_prediction_dir = os.path.join(prediction_dir, model) if prediction_dir is not None else None
+            model_options = dict(inference_options, model_name=path)
+
+            if prepared is None and staged and scheduler is None:
+                # The first model is inferred while the corpus is read, the next ones reuse its prompts
+                embeddings_dataframe, prompts, provenance, prompt_inverse = self._timed(
+                    'staged inference', self._run_staged,
+                    xml_input, prompt_type, full_extraction, deduplicate, spliced_tokenization,
+                    prompt_options, model_options, model_prediction_dir, queue_size
+                )
+                unique_prompts = [None] * (max(prompt_inverse) + 1 if prompt_inverse else 0)
+                for prompt, unique in zip(prompts, prompt_inverse):
+                    unique_prompts[unique] = prompt
+                prepared = prompts, provenance, unique_prompts, prompt_inverse
+
+                finish = self._finish_dataframe
+                finish_args = (embeddings_dataframe, prompts, provenance, prompt_inverse)
+                if model_prediction_dir is not None:
+                    finish = self._finish_streamed
+                    finish_args += (model_prediction_dir,)
+                results = self._timed('clustering', finish, *finish_args, **clustering_options)
+            else:
+                if prepared is None:
+                    prepared = self._timed(
+                        'preprocessing', self.prepare_prompts, xml_input, prompt_type, full_extraction, deduplicate, prompt_options
+                    )
+                prompts, provenance, unique_prompts, prompt_inverse = prepared
+
+                fingerprint = tokenizer_fingerprint(load_tokenizer(path))
+                if fingerprint not in tokenized:
+                    tokenized[fingerprint] = self._timed(
+                        'tokenization', tokenize_prompts_beto,
+                        unique_prompts,
+                        full_extraction=full_extraction,
+                        tokenizer_name=path,
+                        spliced=spliced_tokenization,
+                        token_cache_dir=token_cache_dir
+                    )
+                    print('Inputs tokenized')
+                else:
+                    print('Inputs tokenized by a previous model with the same tokenizer')
+
+                if scheduler is not None:
+                    # Inferred by the workers once every model is prepared
+                    jobs[model] = (
+                        model, tokenized[fingerprint], prompts, provenance, prompt_inverse, model_prediction_dir,
+                        model_options, clustering_options, output_folder, agreement_sample
+                    )
+                    self._report_timings(model, sweep_timings)
+                    continue
+
+                results = self._infer_and_cluster(
+                    tokenized[fingerprint], prompts, provenance, prompt_inverse, model_prediction_dir,
+                    model_options, clustering_options, agreement_sample
+                )
+
+            self._save_results(model, results, output_folder)
+            self._report_timings(model, sweep_timings)
+
+        failed = []
+        if jobs:
+            outcomes = scheduler.run(
+                self._run_model_worker,
+                jobs,
+                memory={model: estimate_model_memory(models_dict[model]) for model in jobs}
+            )
+            for model, outcome in outcomes.items():
+                if outcome['status'] == 'done':
+                    self.timings, agreement = outcome['result']
+                    self.agreement.update(agreement)
+                    self._report_timings(model, sweep_timings)
+                else:
+                    failed.append(model)
+
+        print(f'Timings of the {len(models_dict)} models:')
+        for stage, seconds in sweep_timings.items():
+            print(f'  {stage}: {seconds:.1f} s')
+        print(f'  total: {sum(sweep_timings.values()):.1f} s, wall time: {time.perf_counter() - sweep_start:.1f} s')
+        if failed:
+            print(f'{len(failed)} models failed: {", ".join(failed)}')
+
+    def _run_shared_batches(
+        self,
+        models_dict: dict,
+        xml_input: str,
+        output_folder: str,
+        prompt_options: dict,
+        inference_options: dict,
+        clustering_options: dict,
+        token_cache_dir: str,
+        prediction_dir: str
+    ):
+        """
+        Runs the models of run_models with shared_batches. The prompts are extracted once, and the
+        models with the same tokenizer are inferred together over the same tokenized batches.
+        """
+        prompt_type, full_extraction, deduplicate, spliced_tokenization = None, True, True, True
+        sweep_timings = {}
+        sweep_start = time.perf_counter()
+
+        self.timings = {}
+        prompts, provenance, unique_prompts, prompt_inverse = self._timed(
+            'preprocessing', self.prepare_prompts, xml_input, prompt_type, full_extraction, deduplicate, prompt_options
+        )
+        groups = {}
+        for model, path in models_dict.items():
+            groups.setdefault(tokenizer_fingerprint(load_tokenizer(path)), {})[model] = path
+        self._report_timings('prompts', sweep_timings)
+
+        for group in groups.values():
+            print(f'running models: {", ".join(group)}')
+            self.timings = {}
+            tokenized_inputs = self._timed(
+                'tokenization', tokenize_prompts_beto,
+                unique_prompts,
+                full_extraction=full_extraction,
+                tokenizer_name=next(iter(group.values())),
+                spliced=spliced_tokenization,
+                token_cache_dir=token_cache_dir
+            )
+            print('Inputs tokenized')
+
+            # The unique prompts are inferred next to the directory of every model, see _run_streamed
+            prediction_dirs = None
+            if prediction_dir is not None:
+                suffix = '' if prompt_inverse is None else '.unique'
+                prediction_dirs = {model: os.path.join(prediction_dir, model) + suffix for model in group}
 
-            results = self.run_pipeline(
-                xml_input=xml_input,
-                model_name=path,
-                batch_size=batch_size,
-                entity_number=entity_number,
-                full_extraction=True,
-                max_k=10,
-                save_df=False
-            )           
+            stats = {}
+            start = time.perf_counter()
+            predictions = extract_multi_model_predictions(
+                inputs_tokenized=tokenized_inputs,
+                model_names=group,
+                batch_size=inference_options['batch_size'],
+                embedding=inference_options['embedding'],
+                layers=inference_options['hidden_layers'],
+                layer_pooling=inference_options['layer_pooling'],
+                prediction_dirs=prediction_dirs,
+                embedding_dtype=inference_options['embedding_dtype'],
+                max_tokens=inference_options['max_tokens'],
+                stats=stats,
+                precision=inference_options['precision'],
+                quantized_cache_dir=inference_options['quantized_cache_dir']
+            )
+            # The seconds of every model are counted as its inference, the rest is shared by the group
+            self.timings['shared batches'] = time.perf_counter() - start - sum(model_stats.seconds for model_stats in stats.values())
+            self._report_timings(f'{len(group)} models', sweep_timings)
+
+            for model in group:
+                self.timings = {'inference': stats[model].seconds}
+                if prediction_dir is not None:
+                    results = self._timed(
+                        'clustering', self._finish_streamed,
+                        predictions[model], prompts, provenance, prompt_inverse, os.path.join(prediction_dir, model), **clustering_options
+                    )
+                else:
+                    results = self._timed(
+                        'clustering', self._finish_dataframe,
+                        predictions[model], prompts, provenance, prompt_inverse, **clustering_options
+                    )
+                self._save_results(model, results, output_folder)
+                self._report_timings(model, sweep_timings)
+
+        print(f'Timings of the {len(models_dict)} models:')
+        for stage, seconds in sweep_timings.items():
+            print(f'  {stage}: {seconds:.1f} s')
+        print(f'  total: {sum(sweep_timings.values()):.1f} s, wall time: {time.perf_counter() - sweep_start:.1f} s')
 
+    def _run_model_worker(
+        self,
+        model: str,
+        tokenized_inputs,
+        prompts: list,
+        provenance: pd.DataFrame,
+        prompt_inverse: list,
+        prediction_dir: str,
+        inference_options: dict,
+        clustering_options: dict,
+        output_folder: str,
+        agreement_sample: int = None
+    ) -> dict:
+        """
+        Inference, clustering and CSV of a model of _sweep_models, run by a worker process of SweepScheduler.
+
+        Returns:
+            tuple: The timings of the model and its agreement, see quantization_agreement.
+        """
+        self.timings = {}
+        self.agreement = {}
+        results = self._infer_and_cluster(
+            tokenized_inputs, prompts, provenance, prompt_inverse, prediction_dir, inference_options, clustering_options,
+            agreement_sample
+        )
+        self._save_results(model, results, output_folder)
+        return self.timings, self.agreement
 
-            # Create the output folder if it doesn't exist
-            if not os.path.exists(output_folder):
-                os.makedirs(output_folder)
+    def _save_results(self, model: str, results, output_folder: str):
+        # Create the output folder if it doesn't exist
+        if not os.path.exists(output_folder):
+            os.makedirs(output_folder, exist_ok=True)
 
-            results.to_csv(os.path.join(output_folder, f'{model}_clustering.csv'))
-            print(f'data set {model}_clustering.csv created at {output_folder}')
+        self._timed('saving', results.to_csv, os.path.join(output_folder, f'{model}_clustering.csv'))
+        print(f'data set {model}_clustering.csv created at {output_folder}')
 
-        print('Program Completed')
\ No newline at end of file
+    def _report_timings(self, model: str, sweep_timings: dict):
+        print(f'{model} timings: ' + ', '.join(f'{stage} {seconds:.1f} s' for stage, seconds in self.timings.items()))
+        for stage, seconds in self.timings.items():
+            sweep_timings[stage] = sweep_timings.get(stage, 0.0) + seconds
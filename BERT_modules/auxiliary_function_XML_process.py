@@ -1,4 +1,4 @@
-from collections import Counter
+from collections import Counter, deque
 import re
 
 def entity_sort_dictionary(result_list):
@@ -6,7 +6,7 @@ def entity_sort_dictionary(result_list):
     Sorts phrases in a list based on the count of entities and returns a dictionary.
 
     Args:
-        result_list (list): A list of phrases.
+        result_list (list): A list of phrases or PhraseRecord objects.
 
     Returns:
         dict: A dictionary where keys represent entity counts and values are lists of sorted phrases.
@@ -15,6 +15,12 @@ def entity_sort_dictionary(result_list):
 
     # Iterate through the result_list
     for phrase in result_list:
+        if isinstance(phrase, PhraseRecord):
+            # Records already know their entities and end with a period
+            entity_count = len(phrase.entities)
+            phrases_by_entity_count.setdefault(entity_count, []).append(phrase)
+            continue
+
         # Count the number of entities in the phrase
         entity_count = len(re.findall(r'\$[^$]+\$', phrase))
 
@@ -32,6 +38,224 @@ def entity_sort_dictionary(result_list):
     return sorted_phrases_by_entity_count
 
 
+ENTITY_PATTERN = re.compile(r'\$([^$]+)\$')
+
+
+class PhraseRecord:
+    """
+    A phrase with its entities already located.
+
+    Attributes:
+        text (str): The phrase without the $ entity marks, ending with a period.
+        entities (list): The entity names, in order of appearance.
+        spans (list): The (start, end) offsets of every entity name in text.
+        types (list): The TEI tag of every entity (persName, placeName, ...). None if unknown.
+        source (str): The XML file of the phrase.
+        div (int): The number of the div where the phrase ends, in order of appearance in the file.
+        sentence (int): The position of the phrase in the file.
+    """
+
+    __slots__ = ('text', 'entities', 'spans', 'types', 'source', 'div', 'sentence')
+
+    def __init__(self, text, entities, spans, types, source=None, div=None, sentence=None):
+        self.text = text
+        self.entities = entities
+        self.spans = spans
+        self.types = types
+        self.source = source
+        self.div = div
+        self.sentence = sentence
+
+    @classmethod
+    def from_phrase(cls, phrase: str, types: list = None, source: str = None, div: int = None, sentence: int = None):
+        """
+        Builds a record from a phrase with the entities marked between $, as returned by phrase_extraction.
+
+        Args:
+            phrase (str): The phrase.
+            types (list): The type of every pair of $ marks. Default: None.
+            source (str), div (int), sentence (int): See the class attributes.
+
+        Returns:
+            PhraseRecord: The record. Its text is the cleaned phrase of prompt_generator and its
+            entities the ones counted by entity_sort_dictionary.
+        """
+        phrase = phrase.strip() + '.'
+        entities = []
+        spans = []
+        entity_types = []
+        marks = 0
+        position = 0
+        for match in ENTITY_PATTERN.finditer(phrase):
+            # The $ marks before the entity name are removed from the text
+            marks += phrase.count('$', position, match.start(1))
+            position = match.start(1)
+            name = match.group(1)
+            start = match.start(1) - marks + (len(name) - len(name.lstrip()))
+            name = name.strip()
+            entities.append(name)
+            spans.append((start, start + len(name)))
+            entity_types.append(types[(marks - 1) // 2] if types is not None and (marks - 1) // 2 < len(types) else None)
+
+        return cls(phrase.replace('$', ''), entities, spans, entity_types, source, div, sentence)
+
+    def __repr__(self):
+        return f'PhraseRecord(text={self.text!r}, entities={self.entities!r}, types={self.types!r})'
+
+
+class PhraseRecordBuilder:
+    """
+    Builds the PhraseRecord objects of the phrases of a PhraseNormalizer created with
+    paragraphs=True, giving every entity the type of its TEI tag.
+
+    Every paragraph is added with the type of each of its $ marks before its text is
+    fed to the normalizer. The marks removed by the normalization (the ones following
+    a colon) are dropped with their types, so every $ of the phrases keeps its own type
+    and a $ of the text itself does not shift the types of the next entities.
+
+    Args:
+        source (str): The XML file of the phrases. Default: None.
+
+    Usage:
+        builder = PhraseRecordBuilder(xml_path)
+        for div, paragraph_text, mark_types in paragraphs:
+            builder.add_paragraph(paragraph_text, mark_types)
+            records.extend(builder.build(normalizer.feed(paragraph_text, div)))
+        records.extend(builder.build(normalizer.close()))
+    """
+
+    def __init__(self, source: str = None):
+        self.source = source
+        # Position of the next record, not part of the state
+        self.sentence = 0
+        # Types of the marks not read yet, and the end of the previous paragraphs that
+        # can change the normalization of the next one
+        self._types = deque()
+        self._context = ''
+
+    def add_paragraph(self, text: str, mark_types: list):
+        """
+        Adds the marks of the next paragraph.
+
+        Args:
+            text (str): The raw text of the paragraph.
+            mark_types (list): The type of every $ of the text, as collected by iter_paragraphs.
+        """
+        context = self._context + text
+        if mark_types and DROPPED_MARK_PATTERN.search(context):
+            marks = self._context.count('$')
+            dropped = {index - marks for index in _dropped_characters(_clean_text(context), '$') if index >= marks}
+            mark_types = [mark_type for index, mark_type in enumerate(mark_types) if index not in dropped]
+        self._types.extend(mark_types)
+        self._context = _unsafe_suffix(context)
+
+    def build(self, phrases):
+        """
+        Builds the records of some phrases.
+
+        Args:
+            phrases (list): (div, phrase) tuples returned by PhraseNormalizer.
+
+        Returns:
+            generator: The PhraseRecord of every phrase.
+        """
+        for div, phrase in phrases:
+            marks = phrase.count('$')
+            # The type of an entity is the type of its opening mark
+            types = [self._types[index] if index < len(self._types) else None for index in range(0, marks, 2)]
+            for _ in range(min(marks, len(self._types))):
+                self._types.popleft()
+            yield PhraseRecord.from_phrase(phrase, types, self.source, div, self.sentence)
+            self.sentence += 1
+
+    def get_state(self) -> list:
+        """
+        Returns the pending marks, so the building can be resumed later with set_state.
+
+        Returns:
+            list: The types of the marks not read yet and the end of the previous paragraphs.
+        """
+        return [list(self._types), self._context]
+
+    def set_state(self, state: list):
+        """
+        Restores a state returned by get_state.
+
+        Args:
+            state (list): The types of the marks not read yet and the end of the previous paragraphs.
+        """
+        types, self._context = state
+        self._types = deque(types)
+
+
+def phrase_entities(phrase) -> tuple:
+    """
+    Returns the entity names and the text without entity marks of a phrase.
+
+    Args:
+        phrase (str or PhraseRecord): A phrase with the entities marked between $, or a record.
+
+    Returns:
+        tuple: The list of entity names and the cleaned phrase.
+    """
+    if isinstance(phrase, PhraseRecord):
+        return phrase.entities, phrase.text
+
+    entity_names = [entity.strip() for entity in re.findall(r'\$(.*?)\$', phrase)]
+    return entity_names, phrase.replace('$', '')
+
+
+def entity_spans(phrase) -> list:
+    """
+    Returns the (start, end) offsets of the entities in the cleaned phrase.
+
+    Args:
+        phrase (str or PhraseRecord): A phrase with the entities marked between $, or a record.
+
+    Returns:
+        list: One (start, end) tuple per entity name of phrase_entities.
+    """
+    if isinstance(phrase, PhraseRecord):
+        return phrase.spans
+
+    spans = []
+    for index, match in enumerate(re.finditer(r'\$(.*?)\$', phrase)):
+        # Every previous entity removed two $ and the opening $ of this one removes another
+        shift = 2 * index + 1
+        name = match.group(1)
+        start = match.start(1) - shift + len(name) - len(name.lstrip())
+        spans.append((start, start + len(name.strip())))
+    return spans
+
+
+def filter_records(entity_dictionary: dict, entity_types: list) -> dict:
+    """
+    Keeps only the entities of the given types and sorts the records again by number of entities.
+
+    Args:
+        entity_dictionary (dict): Dictionary of PhraseRecord objects returned by phrase_extraction.
+        entity_types (list): The entity types to keep, e.g. ['persName', 'placeName'].
+
+    Returns:
+        dict: A dictionary where keys represent entity counts and values are lists of records.
+    """
+    records = []
+    for phrases in entity_dictionary.values():
+        for record in phrases:
+            kept = [index for index, entity_type in enumerate(record.types) if entity_type in entity_types]
+            records.append(PhraseRecord(
+                record.text,
+                [record.entities[index] for index in kept],
+                [record.spans[index] for index in kept],
+                [record.types[index] for index in kept],
+                record.source,
+                record.div,
+                record.sentence
+            ))
+
+    return entity_sort_dictionary(records)
+
+
 def counter(dict_list):
     """
     Counts the number of values in each list within a dictionary and returns a Counter.
@@ -48,3 +272,232 @@ def counter(dict_list):
         result[k] = len(values)
 
     return result
+
+
+# Patterns of the phrase_extraction normalization, compiled once
+WHITESPACE_DASH_PATTERN = re.compile(r'\s+\-')
+BRACKETS_PATTERN = re.compile(r'[\[\]\(\)]')
+COLON_PATTERN = re.compile(r'\:.')
+COMMA_PATTERN = re.compile(r'\ , ')
+ASTERISK_PATTERN = re.compile(r'\* * * ')
+SQUARE_BRACKETS_PATTERN = re.compile(r'\[\S+\]')
+
+# The colon pattern only removes a $ that follows a colon once the brackets are removed
+DROPPED_MARK_PATTERN = re.compile(r':[\[\]\(\)]*\$')
+
+# Characters that can take part in a match spanning two fragments
+UNSAFE_CHARACTERS = frozenset(':*-[](),')
+
+
+def _clean_text(text: str) -> str:
+    # The first patterns of the normalization, none of them removes a period
+    text = ' '.join(text.split())
+    text = WHITESPACE_DASH_PATTERN.sub('', text)
+    return BRACKETS_PATTERN.sub('', text)
+
+
+def _finish_text(text: str) -> str:
+    text = COLON_PATTERN.sub(': ', text)
+    text = COMMA_PATTERN.sub(', ', text)
+    text = ASTERISK_PATTERN.sub('', text)
+
+    return SQUARE_BRACKETS_PATTERN.sub('', text)
+
+
+def normalize_text(text: str) -> str:
+    """
+    Applies the phrase_extraction normalization to a text.
+
+    Args:
+        text (str): The raw text.
+
+    Returns:
+        str: The normalized text, before splitting it into phrases.
+    """
+    return _finish_text(_clean_text(text))
+
+
+def _dropped_characters(text: str, character: str) -> list:
+    # Positions, among the occurrences of a character in a cleaned text, of the ones replaced by the colon pattern
+    dropped = []
+    count = 0
+    position = 0
+    for match in COLON_PATTERN.finditer(text):
+        count += text.count(character, position, match.start())
+        position = match.end()
+        if match.group() == ':' + character:
+            dropped.append(count)
+            count += 1
+    return dropped
+
+
+def _is_safe(character: str) -> bool:
+    return not character.isspace() and character not in UNSAFE_CHARACTERS
+
+
+def _unsafe_suffix(text: str) -> str:
+    # The text after its last cut between two safe characters, the only part that can
+    # change the normalization of the text that follows it
+    for cut in range(len(text) - 1, 0, -1):
+        if _is_safe(text[cut - 1]) and _is_safe(text[cut]):
+            return text[cut:]
+    return text
+
+
+class PhraseNormalizer:
+    """
+    Incremental version of the phrase_extraction normalization.
+
+    The text is fed paragraph by paragraph. It is normalized in fragments cut
+    between two characters that no pattern can match across (neither of them
+    whitespace nor one of ':*-[](),'), so normalizing the fragments one by one
+    gives the same text as normalizing the whole corpus at once. The text is
+    buffered until it reaches buffer_size characters, then the complete phrases
+    are returned and only the unfinished one is kept.
+
+    With paragraphs=True every phrase is returned with the paragraph of its closing
+    period, as a (paragraph, phrase) tuple. The paragraph is the identifier passed
+    to feed, e.g. its index or its div. The periods removed by the normalization
+    (the ones following a colon) are not taken into account.
+
+    Args:
+        buffer_size (int): Number of raw characters to buffer before normalizing. Default: 65536.
+        paragraphs (bool): Return the paragraph of every phrase. Default: False.
+
+    Usage:
+        normalizer = PhraseNormalizer()
+        for paragraph in paragraphs:
+            phrases.extend(normalizer.feed(paragraph))
+        phrases.extend(normalizer.close())
+    """
+
+    def __init__(self, buffer_size: int = 65536, paragraphs: bool = False):
+        self.buffer_size = buffer_size
+        self.paragraphs = paragraphs
+        self._raw_segments = []
+        self._raw_size = 0
+        self._phrase_segments = []
+        # Paragraph of every period of the raw text, and of the last fed text
+        self._period_paragraphs = []
+        self._paragraph = None
+
+    def feed(self, text: str, paragraph=None) -> list:
+        """
+        Adds a raw text fragment.
+
+        Args:
+            text (str): The raw text of a paragraph.
+            paragraph: The identifier of the paragraph, when paragraphs is True. Default: None.
+
+        Returns:
+            list: The phrases completed by this fragment, split by '.' as in phrase_extraction,
+            or (paragraph, phrase) tuples when paragraphs is True.
+        """
+        if self.paragraphs:
+            self._paragraph = paragraph
+            self._period_paragraphs.extend([paragraph] * text.count('.'))
+
+        if self._raw_size + len(text) < self.buffer_size:
+            # Normalizing tiny fragments costs more than it saves, keep buffering
+            if text:
+                self._raw_segments.append(text)
+                self._raw_size += len(text)
+            return []
+
+        previous = self._raw_segments[-1][-1] if self._raw_segments else ''
+        # Look for the last safe cut, including the one between the buffered text and this fragment
+        for cut in range(len(text) - 1, -1, -1):
+            left = text[cut - 1] if cut else previous
+            if left and _is_safe(left) and _is_safe(text[cut]):
+                break
+        else:
+            if text:
+                self._raw_segments.append(text)
+                self._raw_size += len(text)
+            return []
+
+        self._raw_segments.append(text[:cut])
+        fragment = ''.join(self._raw_segments)
+        self._raw_segments = [text[cut:]]
+        self._raw_size = len(text) - cut
+
+        return self._normalize(fragment, text.count('.', cut))
+
+    def close(self, paragraph=None) -> list:
+        """
+        Normalizes the remaining text.
+
+        Args:
+            paragraph: The paragraph of the text after the final period, when paragraphs
+            is True. Default: None (the last fed paragraph).
+
+        Returns:
+            list: The remaining phrases, the last one being the text after the final period.
+        """
+        phrases = self._normalize(''.join(self._raw_segments), 0)
+        last_phrase = ''.join(self._phrase_segments)
+        if self.paragraphs:
+            last_phrase = (self._paragraph if paragraph is None else paragraph, last_phrase)
+        phrases.append(last_phrase)
+        self._raw_segments = []
+        self._raw_size = 0
+        self._phrase_segments = []
+        self._period_paragraphs = []
+
+        return phrases
+
+    def get_state(self) -> list:
+        """
+        Returns the buffered text, so the normalization can be resumed later with set_state.
+
+        Returns:
+            list: The raw text not normalized yet and the unfinished phrase. When paragraphs is
+            True, also the paragraph of every raw period and the last fed paragraph.
+        """
+        state = [''.join(self._raw_segments), ''.join(self._phrase_segments)]
+        if self.paragraphs:
+            state.extend([list(self._period_paragraphs), self._paragraph])
+        return state
+
+    def set_state(self, state: list):
+        """
+        Restores a state returned by get_state.
+
+        Args:
+            state (list): The raw text not normalized yet and the unfinished phrase, and
+            the paragraphs when paragraphs is True.
+        """
+        raw_text, phrase_text = state[:2]
+        self._raw_segments = [raw_text] if raw_text else []
+        self._raw_size = len(raw_text)
+        self._phrase_segments = [phrase_text] if phrase_text else []
+        if self.paragraphs:
+            self._period_paragraphs = list(state[2])
+            self._paragraph = state[3]
+
+    def _normalize(self, fragment: str, periods_left: int) -> list:
+        # periods_left: the raw periods after the fragment, still buffered
+        fragment = _clean_text(fragment)
+        if not self.paragraphs:
+            return self._split(_finish_text(fragment))
+
+        periods = len(self._period_paragraphs) - periods_left
+        paragraphs = self._period_paragraphs[:periods]
+        self._period_paragraphs = self._period_paragraphs[periods:]
+        for index in reversed(_dropped_characters(fragment, '.')):
+            del paragraphs[index]
+
+        return list(zip(paragraphs, self._split(_finish_text(fragment))))
+
+    def _split(self, fragment: str) -> list:
+        pieces = fragment.split('.')
+        if len(pieces) == 1:
+            self._phrase_segments.append(fragment)
+            return []
+
+        self._phrase_segments.append(pieces[0])
+        phrases = [''.join(self._phrase_segments)]
+        phrases.extend(pieces[1:-1])
+        self._phrase_segments = [pieces[-1]]
+
+        return phrases
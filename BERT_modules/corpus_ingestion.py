@@ -0,0 +1,161 @@
+import os
+import re
+import glob
+from concurrent.futures import ProcessPoolExecutor
+from prompt_generator import phrase_extraction
+
+
+def resolve_xml_inputs(xml_input: str) -> list:
+    '''
+    DESCRIPTION:
+    Resolves the XML-TEI files of a corpus.
+
+    INPUTS:
+        xml_input: a XML file, a directory (searched recursively for .xml files)
+        or a glob pattern such as 'corpus/legajo_*.xml'.
+
+    OUTPUTS: sorted list of XML file paths.
+    '''
+    if xml_input is None:
+        raise ValueError("xml file is required")
+
+    if os.path.isfile(xml_input):
+        return [xml_input]
+
+    if os.path.isdir(xml_input):
+        xml_files = glob.glob(os.path.join(xml_input, '**', '*.xml'), recursive=True)
+    else:
+        xml_files = glob.glob(xml_input, recursive=True)
+
+    return sorted(path for path in xml_files if os.path.isfile(path))
+
+
+def _extract_file(xml_path: str, streaming: bool = True, records: bool = False) -> dict:
+    return phrase_extraction(xml_path=xml_path, return_dict=True, streaming=streaming, records=records)
+
+
+def merge_entity_dictionaries(dictionaries: list) -> tuple:
+    '''
+    DESCRIPTION:
+    Merges the dictionaries returned by entity_sort_dictionary for several documents.
+
+    INPUTS:
+        dictionaries: list of (source, dictionary) tuples, where source identifies
+        the document and dictionary has the number of entities as keys.
+
+    OUTPUTS: the merged dictionary with sorted keys, and a dictionary with the same
+    shape holding the source document of every phrase.
+    '''
+    merged = {}
+    provenance = {}
+
+    for source, dictionary in dictionaries:
+        for entity_count, phrases in dictionary.items():
+            merged.setdefault(entity_count, []).extend(phrases)
+            provenance.setdefault(entity_count, []).extend([source] * len(phrases))
+
+    sorted_keys = sorted(merged.keys())
+    merged = {key: merged[key] for key in sorted_keys}
+    provenance = {key: provenance[key] for key in sorted_keys}
+
+    return merged, provenance
+
+
+def _prompt_key_order(prompt_key: str) -> tuple:
+    # prompt_generator writes the keys by number of entities and then by prompt number
+    match = re.match(r'prompt_(\d+)_(?:ent_(\d+)|unique)$', prompt_key)
+    if match is None:
+        return (float('inf'), 0, prompt_key)
+    entity_count = int(match.group(2)) if match.group(2) else 1
+    return (entity_count, int(match.group(1)), prompt_key)
+
+
+def merge_prompt_dictionaries(dictionaries: list) -> dict:
+    '''
+    DESCRIPTION:
+    Merges prompt dictionaries generated separately, concatenating the prompts of
+    every key and keeping the key order of prompt_generator.
+
+    INPUTS:
+        dictionaries: list of dictionaries returned by prompt_generator.
+
+    OUTPUTS: the merged prompt dictionary.
+    '''
+    merged = {}
+
+    for dictionary in dictionaries:
+        for prompt_key, prompts in dictionary.items():
+            merged.setdefault(prompt_key, []).extend(prompts)
+
+    return {key: merged[key] for key in sorted(merged, key=_prompt_key_order)}
+
+
+def iter_corpus_phrases(xml_input: str, max_workers: int = None, streaming: bool = True, records: bool = False):
+    '''
+    DESCRIPTION:
+    Lazy version of corpus_phrase_extraction. The files are processed by a process
+    pool and every dictionary is yielded as soon as its file and the previous ones
+    are done, so the next stages can start before the whole corpus is read.
+
+    INPUTS:
+        xml_input, max_workers, streaming, records: see corpus_phrase_extraction.
+
+    OUTPUTS: generator of (source, dictionary) tuples in the order of resolve_xml_inputs,
+    as expected by merge_entity_dictionaries.
+    '''
+    xml_files = resolve_xml_inputs(xml_input)
+    if not xml_files:
+        raise ValueError(f"No XML files found at {xml_input}")
+
+    if len(xml_files) == 1 or max_workers == 1:
+        for xml_path in xml_files:
+            yield xml_path, _extract_file(xml_path, streaming, records)
+        return
+
+    workers = min(max_workers or os.cpu_count() or 1, len(xml_files))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        dictionaries = executor.map(
+            _extract_file,
+            xml_files,
+            [streaming] * len(xml_files),
+            [records] * len(xml_files),
+            chunksize=max(1, len(xml_files) // (workers * 4))
+        )
+        yield from zip(xml_files, dictionaries)
+
+
+def corpus_phrase_extraction(
+    xml_input: str,
+    max_workers: int = None,
+    streaming: bool = True,
+    return_provenance: bool = False,
+    records: bool = False
+):
+    '''
+    DESCRIPTION:
+    Runs phrase_extraction over every XML-TEI file of a corpus with a process pool
+    and merges the results. Each file is processed independently, so the work
+    scales with the number of worker processes.
+
+    INPUTS:
+        xml_input: a XML file, a directory or a glob pattern. See resolve_xml_inputs.
+
+        max_workers: number of worker processes. default: None (one per CPU).
+
+        streaming: read the files with the iterparse mode of phrase_extraction. default: True
+
+        return_provenance: if True also returns the source file of every phrase. default: False
+
+        records: return PhraseRecord objects instead of phrases. See phrase_extraction. default: False
+
+    OUTPUTS: dictionary with keys for the number of entities and the list of phrases attached,
+    and the provenance dictionary if return_provenance is True.
+    '''
+    file_dictionaries = list(iter_corpus_phrases(xml_input, max_workers, streaming, records))
+
+    print(f'{len(file_dictionaries)} XML files processed')
+    merged, provenance = merge_entity_dictionaries(file_dictionaries)
+
+    if return_provenance:
+        return merged, provenance
+    return merged
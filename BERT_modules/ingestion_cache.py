@@ -0,0 +1,315 @@
+import os
+import json
+import hashlib
+import inspect
+from concurrent.futures import ProcessPoolExecutor
+from prompt_generator import iter_paragraphs, iter_prompts
+import prompt_templates
+from auxiliary_function_XML_process import entity_sort_dictionary, PhraseNormalizer, PhraseRecord, PhraseRecordBuilder
+from corpus_ingestion import resolve_xml_inputs, merge_entity_dictionaries, merge_prompt_dictionaries
+
+
+MANIFEST_VERSION = 5
+
+
+def file_sha256(path: str, block_size: int = 1 << 20) -> str:
+    '''
+    DESCRIPTION:
+    Computes the SHA-256 of a file reading it by blocks.
+
+    INPUTS:
+        path: the file path.
+
+        block_size: number of bytes read at a time. default: 1 MiB
+
+    OUTPUTS: the hexadecimal digest.
+    '''
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _text_sha256(texts: list) -> str:
+    digest = hashlib.sha256()
+    for text in texts:
+        digest.update(text.encode('utf-8'))
+        digest.update(b'\x00')
+    return digest.hexdigest()
+
+
+def prompt_config_key(
+    entity_number: int,
+    full_extraction: bool,
+    pair_policy: str = 'baseline',
+    pair_window: int = None,
+    template_set: str = 'baseline'
+) -> str:
+    '''
+    DESCRIPTION:
+    Identifies the prompts generated for a configuration. It includes the source of
+    the prompt templates and of iter_prompts, so the stored prompts are dropped when
+    the templates change.
+
+    OUTPUTS: the configuration key.
+    '''
+    sources = [inspect.getsource(prompt_templates), inspect.getsource(iter_prompts)]
+    options = [str(MANIFEST_VERSION), str(entity_number), str(full_extraction), pair_policy, str(pair_window), template_set]
+    return _text_sha256(sources + options)[:16]
+
+
+def _read_json(path: str, default):
+    if not os.path.isfile(path):
+        return default
+    with open(path, 'r', encoding='utf-8') as json_file:
+        return json.load(json_file)
+
+
+def _write_json(path: str, data):
+    # Write to a temporary file first so an interrupted run never leaves a broken cache
+    temporary_path = path + '.tmp'
+    with open(temporary_path, 'w', encoding='utf-8') as json_file:
+        json.dump(data, json_file)
+    os.replace(temporary_path, path)
+
+
+def _shift_divs(state: list, offset: int) -> list:
+    # The divs of a normalizer state are cached relative to the div of their unit, so a
+    # unit can be reused when the divs before it are added or removed
+    raw_text, phrase_text, divs, last_div = state
+    shift = lambda div: None if div is None else div + offset
+    return [raw_text, phrase_text, [shift(div) for div in divs], shift(last_div)]
+
+
+def _record_data(record, div: int) -> list:
+    offset = None if record.div is None else record.div - div
+    return [record.text, record.entities, [list(span) for span in record.spans], record.types, offset]
+
+
+def _load_record(data: list, source: str, div: int, sentence: int) -> PhraseRecord:
+    text, entities, spans, types, offset = data
+    div = None if offset is None else div + offset
+    return PhraseRecord(text, entities, [tuple(span) for span in spans], types, source, div, sentence)
+
+
+def _iter_divs(xml_path: str):
+    # The runs of paragraphs of the same div, in document order: a div with paragraphs after a
+    # nested div gives two runs. The mark types of a paragraph are appended when it is yielded,
+    # so the paragraphs are grouped by hand: groupby reads the first paragraph of the next run
+    # before closing a group
+    mark_types = []
+    div_paragraphs = []
+    current_div = None
+    for div_number, text in iter_paragraphs(xml_path, with_div=True, mark_types=mark_types):
+        if div_paragraphs and div_number != current_div:
+            yield current_div, div_paragraphs
+            div_paragraphs = []
+        current_div = div_number
+        div_paragraphs.append([text, list(mark_types)])
+        mark_types.clear()
+
+    if div_paragraphs:
+        yield current_div, div_paragraphs
+
+
+def _process_file(xml_path: str, file_entry: dict, record_path: str) -> tuple:
+    stats = {'files_reused': 0, 'files_processed': 0, 'divs_reused': 0, 'divs_processed': 0}
+    stat = os.stat(xml_path)
+    record = _read_json(record_path, None)
+    if record is not None and record.get('version') != MANIFEST_VERSION:
+        record = None
+
+    if file_entry and (file_entry['size'], file_entry['mtime_ns']) == (stat.st_size, stat.st_mtime_ns):
+        sha256 = file_entry['sha256']
+    else:
+        sha256 = file_sha256(xml_path)
+
+    if record is not None and record['sha256'] == sha256:
+        stats['files_reused'] += 1
+        units = record['units']
+    else:
+        # The file changed: reuse the divs whose content and incoming state did not
+        stats['files_processed'] += 1
+        previous_units = {unit['key']: unit for unit in (record or {}).get('units', [])}
+        # Normalize paragraph by paragraph so the state carried between divs stays small
+        normalizer = PhraseNormalizer(buffer_size=0, paragraphs=True)
+        builder = PhraseRecordBuilder()
+        units = []
+
+        div_number = None
+        for div_number, div_paragraphs in _iter_divs(xml_path):
+            div_hash = _text_sha256([json.dumps(paragraph, ensure_ascii=False) for paragraph in div_paragraphs])
+            state = [_shift_divs(normalizer.get_state(), -div_number), builder.get_state()]
+            key = div_hash + ':' + _text_sha256([json.dumps(state, ensure_ascii=False)])
+
+            unit = previous_units.get(key)
+            if unit is not None:
+                stats['divs_reused'] += 1
+                normalizer.set_state(_shift_divs(unit['state'][0], div_number))
+                builder.set_state(unit['state'][1])
+                unit = dict(unit, div=div_number)
+            else:
+                stats['divs_processed'] += 1
+                records = []
+                for text, mark_types in div_paragraphs:
+                    builder.add_paragraph(text, mark_types)
+                    records.extend(builder.build(normalizer.feed(text, div_number)))
+                unit = {
+                    'key': key,
+                    'div_hash': div_hash,
+                    'div': div_number,
+                    'records': [_record_data(record, div_number) for record in records],
+                    'state': [_shift_divs(normalizer.get_state(), -div_number), builder.get_state()]
+                }
+            units.append(unit)
+
+        # The text after the last period belongs to the last div
+        close_records = [_record_data(record, div_number) for record in builder.build(normalizer.close())]
+        units.append({'key': 'close', 'div_hash': None, 'div': div_number, 'records': close_records, 'state': None})
+        _write_json(record_path, {'version': MANIFEST_VERSION, 'sha256': sha256, 'units': units})
+
+    file_entry = {
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+        'sha256': sha256,
+        'divs': [unit['div_hash'] for unit in units if unit['div_hash'] is not None]
+    }
+    unit_records = ((unit['div'], data) for unit in units for data in unit['records'])
+    entity_dictionary = entity_sort_dictionary(
+        _load_record(data, xml_path, div, sentence) for sentence, (div, data) in enumerate(unit_records)
+    )
+
+    return file_entry, entity_dictionary, stats
+
+
+class IngestionCache:
+    """
+    Persistent cache of the phrase records extracted from a corpus of XML-TEI files.
+
+    A manifest stores the size, modification time and SHA-256 of every file and the
+    hashes of its divs. Unchanged files reuse their cached records without being parsed.
+    In a changed file only the divs whose content changed are normalized again. The
+    records keep the entities, spans and types of their phrases, and the prompts are
+    generated from them on every run, so any template or prompt option can be used
+    without invalidating the cache.
+
+    Args:
+        cache_dir (str): Directory where the manifest and the cached outputs are stored.
+
+    Usage:
+        cache = IngestionCache('ingestion_cache')
+        entity_dictionary, prompt_dictionary = cache.extract('corpus/', entity_number=3, full_extraction=True)
+    """
+
+    def __init__(self, cache_dir: str):
+        self.cache_dir = cache_dir
+        self.records_dir = os.path.join(cache_dir, 'files')
+        self.manifest_path = os.path.join(cache_dir, 'manifest.json')
+        os.makedirs(self.records_dir, exist_ok=True)
+
+        self.manifest = _read_json(self.manifest_path, {'version': MANIFEST_VERSION, 'files': {}})
+        if self.manifest.get('version') != MANIFEST_VERSION:
+            self.manifest = {'version': MANIFEST_VERSION, 'files': {}}
+
+    def record_path(self, xml_path: str) -> str:
+        name = hashlib.sha256(os.path.abspath(xml_path).encode('utf-8')).hexdigest()
+        return os.path.join(self.records_dir, name + '.json')
+
+    def extract(
+        self,
+        xml_input: str,
+        entity_number: int = 2,
+        full_extraction: bool = False,
+        json_file_path_name: str = None,
+        max_workers: int = None,
+        pair_policy: str = 'baseline',
+        pair_window: int = None,
+        template_set: str = 'baseline',
+        max_prompts: int = None,
+        max_prompts_per_document: int = None,
+        prompt_store=None,
+        store_key: str = None,
+        with_provenance: bool = False
+    ) -> tuple:
+        """
+        Extracts the phrases and prompts of a corpus, reprocessing only what changed.
+
+        Args:
+            xml_input (str): A XML file, a directory or a glob pattern of XML files.
+            entity_number (int): See prompt_generator. Default: 2.
+            full_extraction (bool): See prompt_generator. Default: False.
+            json_file_path_name (str): If given, the merged prompts are also saved in JSON format. Default: None.
+            max_workers (int): Number of processes used for the files. Default: None (one per CPU).
+            pair_policy, pair_window, template_set (str, int, str): See iter_prompts.
+            max_prompts, max_prompts_per_document (int): See iter_prompts. Default: None.
+            prompt_store (PromptStore): If given, the prompts are also written to the store. Default: None.
+            store_key (str): The configuration key committed with the store. Default: None.
+            with_provenance (bool): Return the prompts as the (template_id, entity_pair, text, provenance)
+                tuples of iter_prompts instead of the prompt dictionary. Default: False.
+
+        Returns:
+            tuple: The entity dictionary of PhraseRecord objects of phrase_extraction and the prompt dictionary of prompt_generator,
+            or the list of prompt tuples if with_provenance is True.
+        """
+        xml_files = resolve_xml_inputs(xml_input)
+        if not xml_files:
+            raise ValueError(f"No XML files found at {xml_input}")
+
+        prompt_options = {
+            'entity_number': entity_number,
+            'full_extraction': full_extraction,
+            'pair_policy': pair_policy,
+            'pair_window': pair_window,
+            'template_set': template_set
+        }
+        files = self.manifest['files']
+        arguments = [
+            (xml_path, files.get(os.path.abspath(xml_path)), self.record_path(xml_path))
+            for xml_path in xml_files
+        ]
+
+        if len(xml_files) == 1 or max_workers == 1:
+            results = [_process_file(*argument) for argument in arguments]
+        else:
+            workers = min(max_workers or os.cpu_count() or 1, len(xml_files))
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(_process_file, *zip(*arguments)))
+
+        stats = {'files_reused': 0, 'files_processed': 0, 'divs_reused': 0, 'divs_processed': 0}
+        for xml_path, (file_entry, _, file_stats) in zip(xml_files, results):
+            files[os.path.abspath(xml_path)] = file_entry
+            for key, value in file_stats.items():
+                stats[key] += value
+        _write_json(self.manifest_path, self.manifest)
+
+        print(f"{stats['files_reused']} XML files reused and {stats['files_processed']} processed "
+              f"({stats['divs_reused']} divs reused, {stats['divs_processed']} processed)")
+
+        entity_dictionary, _ = merge_entity_dictionaries(
+            (xml_path, result[1]) for xml_path, result in zip(xml_files, results)
+        )
+        # The budgets follow the order of iter_prompts over the whole corpus, as without the cache
+        prompts = list(iter_prompts(
+            phrase_input=entity_dictionary,
+            with_provenance=True,
+            max_prompts=max_prompts,
+            max_prompts_per_document=max_prompts_per_document,
+            **prompt_options
+        ))
+        if prompt_store is not None:
+            prompt_store.write(prompts, config_key=store_key)
+
+        if json_file_path_name or not with_provenance:
+            prompt_dictionary = {}
+            for template_id, _, text, _ in prompts:
+                prompt_dictionary.setdefault(template_id, []).append(text)
+            prompt_dictionary = merge_prompt_dictionaries([prompt_dictionary])
+
+            if json_file_path_name:
+                with open(json_file_path_name, 'w', encoding='utf-8') as json_file:
+                    json.dump(prompt_dictionary, json_file)
+
+        if with_provenance:
+            return entity_dictionary, prompts
+        return entity_dictionary, prompt_dictionary
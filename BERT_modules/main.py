@@ -2,12 +2,42 @@ from PromptORE import pipeline_PromptORE
 import click
 
 @click.command()
-@click.option("--xml_file", help="Path to the input XML file", required=True)
+@click.option("--xml_file", help="Path to the input XML file, or a directory or glob pattern of XML files", required=True)
 @click.option("--models_path", help="Path to the models directory", required=True)
 @click.option("--output_dir", help="Path to the models output directory for CSV files", required=True)
 @click.option("--batch_size", type=int, default=32, help="number of sentences per batch")
 @click.option("--entity_number", type=int, default=10, help="number of entities to extract with the method")
-def main(xml_file, models_path, output_dir, batch_size, entity_number):
+@click.option("--max_workers", type=int, default=None, help="number of processes to extract the phrases of a corpus")
+@click.option("--cache_dir", default=None, help="Directory of the ingestion cache, to reprocess only the XML files changed since the last run")
+@click.option("--pair_policy", type=click.Choice(['baseline', 'all', 'adjacent', 'window']), default='baseline', help="how the entities of a phrase are paired, baseline gives the pairs of the original prompts")
+@click.option("--pair_window", type=int, default=None, help="maximum number of words between the entities of a pair for the window policy")
+@click.option("--template_set", type=click.Choice(['baseline', 'uniform', 'legacy']), default='baseline', help="baseline for the original prompts, uniform for the same templates ending with a period for any number of entities, legacy for the original prompts with their repetitions")
+@click.option("--max_prompts", type=int, default=None, help="maximum number of prompts of the run")
+@click.option("--max_prompts_per_document", type=int, default=None, help="maximum number of prompts of every XML file")
+@click.option("--prompt_store", default=None, help="JSON Lines file where the prompts are stored, and read back by later runs with the same options")
+@click.option("--token_cache_dir", default=None, help="Directory where the tokenized prompts are stored, and shared by the models with the same tokenizer")
+@click.option("--embedding", type=click.Choice(['logits', 'hidden']), default='logits', help="cluster the LM head scores or the encoder hidden state at the mask")
+@click.option("--hidden_layers", type=int, multiple=True, default=[-1], help="hidden layer of the hidden embedding, repeat the option to pool several layers")
+@click.option("--layer_pooling", type=click.Choice(['mean', 'concat']), default='mean', help="how several hidden layers are combined")
+@click.option("--embedding_cache_dir", default=None, help="Directory where the mask predictions are cached, so unchanged models skip the inference of the prompts already seen")
+@click.option("--prediction_dir", default=None, help="Directory where the predictions of every model are streamed to disk instead of kept in memory")
+@click.option("--embedding_dtype", type=click.Choice(['float32', 'float16']), default='float32', help="type of the embeddings streamed to the prediction_dir")
+@click.option("--staged", is_flag=True, default=False, help="Run the ingestion and the tokenization in background threads that feed the inference")
+@click.option("--queue_size", type=int, default=8, help="maximum number of items waiting between two stages of the staged pipeline")
+@click.option("--max_tokens", type=int, default=None, help="pack the batches by prompt length up to this number of padded tokens instead of batch_size prompts")
+@click.option("--workers", type=int, default=1, help="number of models inferred at the same time, each one in its own process")
+@click.option("--threads_per_worker", type=int, default=None, help="torch threads of every worker, by default the CPU cores divided by the workers")
+@click.option("--interop_threads", type=int, default=1, help="torch inter-op threads of every worker")
+@click.option("--memory_budget", type=float, default=None, help="gigabytes of memory shared by the workers, a model starts only when its estimated memory fits")
+@click.option("--shared_batches", is_flag=True, default=False, help="Load the models with the same tokenizer together and run every batch through all of them")
+@click.option("--precision", type=click.Choice(['float32', 'int8']), default='float32', help="int8 quantizes the Linear layers of the models for a faster CPU inference")
+@click.option("--quantized_cache_dir", default=None, help="Directory where the int8 models are saved to skip their quantization in the next runs")
+@click.option("--agreement_sample", type=int, default=None, help="with int8, number of prompts inferred with both precisions to print their agreement and speed")
+def main(xml_file, models_path, output_dir, batch_size, entity_number, max_workers, cache_dir,
+         pair_policy, pair_window, template_set, max_prompts, max_prompts_per_document, prompt_store, token_cache_dir,
+         embedding, hidden_layers, layer_pooling, embedding_cache_dir, prediction_dir, embedding_dtype,
+         staged, queue_size, max_tokens, workers, threads_per_worker, interop_threads, memory_budget, shared_batches,
+         precision, quantized_cache_dir, agreement_sample):
     pipeline = pipeline_PromptORE()
 
     pipeline.run_models(
@@ -15,29 +45,34 @@ def main(xml_file, models_path, output_dir, batch_size, entity_number):
         models_path=models_path,
         output_folder=output_dir,
         batch_size=batch_size,
-        entity_number=entity_number
+        entity_number=entity_number,
+        max_workers=max_workers,
+        cache_dir=cache_dir,
+        pair_policy=pair_policy,
+        pair_window=pair_window,
+        template_set=template_set,
+        max_prompts=max_prompts,
+        max_prompts_per_document=max_prompts_per_document,
+        prompt_store=prompt_store,
+        token_cache_dir=token_cache_dir,
+        embedding=embedding,
+        hidden_layers=list(hidden_layers),
+        layer_pooling=layer_pooling,
+        embedding_cache_dir=embedding_cache_dir,
+        prediction_dir=prediction_dir,
+        embedding_dtype=embedding_dtype,
+        staged=staged,
+        queue_size=queue_size,
+        max_tokens=max_tokens,
+        workers=workers,
+        threads_per_worker=threads_per_worker,
+        interop_threads=interop_threads,
+        memory_budget=memory_budget,
+        shared_batches=shared_batches,
+        precision=precision,
+        quantized_cache_dir=quantized_cache_dir,
+        agreement_sample=agreement_sample
     )
 
 if __name__ == "__main__":
     main()
-entity_number = args.entity_number
-
-# Check if the XML file exists
-if not os.path.isfile(xml_file):
-    print(f"Error: The XML file '{xml_file}' does not exist.")
-    exit(1)
-
-pipeline = pipeline_PromptORE()
-
-pipeline.run_models(
-    xml_input=xml_file,
-    models_path=models_path,
-    output_folder=output_dir,
-    batch_size=batch_size,
-    entity_number=entity_number
-)
-
-    batch_size=batch_size,
-    entity_number=entity_number
-)
-
@@ -0,0 +1,210 @@
+import os
+import json
+import hashlib
+from functools import lru_cache
+import torch
+from transformers import AutoConfig, AutoTokenizer, BertForMaskedLM
+from transformers.utils import cached_file
+from transformers.utils.hub import extract_commit_hash
+
+
+DEFAULT_TOKENIZER = 'dccuchile/bert-base-spanish-wwm-uncased'
+
+# Files of a checkpoint directory that contain a tokenizer
+TOKENIZER_FILES = ('tokenizer.json', 'vocab.txt', 'vocab.json')
+
+# Number of models kept in memory. run_models goes through many checkpoints,
+# so only the most recent ones stay loaded.
+MODEL_CACHE_SIZE = 2
+
+# Precisions of load_model: the float32 weights, or the Linear layers quantized to int8
+# when the model is loaded, which only runs on the CPU
+PRECISIONS = ('float32', 'int8')
+
+# Files of a checkpoint directory that identify its weights
+CHECKPOINT_SUFFIXES = ('.json', '.safetensors', '.bin')
+
+
+def is_local_checkpoint(model_path: str) -> bool:
+    '''
+    DESCRIPTION:
+    Checks if a model path is a local checkpoint directory instead of a hub name.
+
+    INPUTS:
+        model_path: the model directory or hub name.
+
+    OUTPUTS: True for local directories.
+    '''
+    return os.path.isdir(model_path)
+
+
+@lru_cache(maxsize=None)
+def _load_tokenizer(model_path: str):
+    return AutoTokenizer.from_pretrained(
+        model_path,
+        use_fast=True,
+        local_files_only=is_local_checkpoint(model_path)
+    )
+
+
+def load_tokenizer(model_path: str = DEFAULT_TOKENIZER, fallback: str = DEFAULT_TOKENIZER):
+    '''
+    DESCRIPTION:
+    Loads the fast (Rust) tokenizer of a model once per process. Local checkpoint
+    directories are read without network access. Fine-tuned checkpoints saved
+    without tokenizer files use the tokenizer of fallback.
+
+    INPUTS:
+        model_path: the model directory or hub name. default: DEFAULT_TOKENIZER
+
+        fallback: the tokenizer used when model_path has no tokenizer. default: DEFAULT_TOKENIZER
+
+    OUTPUTS: the tokenizer, the same object for every call that resolves to the same path.
+    '''
+    if fallback is not None and is_local_checkpoint(model_path) and not any(
+        os.path.isfile(os.path.join(model_path, name)) for name in TOKENIZER_FILES
+    ):
+        return _load_tokenizer(fallback)
+
+    return _load_tokenizer(model_path)
+
+
+@lru_cache(maxsize=MODEL_CACHE_SIZE)
+def _load_model(model_path: str, device: str):
+    model = BertForMaskedLM.from_pretrained(model_path, local_files_only=is_local_checkpoint(model_path))
+    return model.to(device).eval()
+
+
+def model_device(precision: str = 'float32'):
+    '''
+    DESCRIPTION:
+    Chooses the device of the models of a precision.
+
+    INPUTS:
+        precision: one of PRECISIONS. default: 'float32'
+
+    OUTPUTS: cuda if available for the float32 models, otherwise the cpu.
+    '''
+    if precision == 'float32' and torch.cuda.is_available():
+        return torch.device("cuda")
+    return torch.device("cpu")
+
+
+def quantize_model(model):
+    '''
+    DESCRIPTION:
+    Applies dynamic int8 quantization to the Linear layers of a model: their weights are
+    stored in int8, and their inputs are quantized batch by batch. The embeddings and the
+    layer norms stay in float32.
+
+    INPUTS:
+        model: the float32 model on the cpu. It is quantized in place.
+
+    OUTPUTS: the quantized model, in evaluation mode.
+    '''
+    return torch.ao.quantization.quantize_dynamic(model.eval(), {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+
+
+def hub_revision(model_path: str) -> str:
+    '''
+    DESCRIPTION:
+    Finds the commit of the files of a hub model that from_pretrained loads, the latest one
+    of the hub or, without network access, the one in the local cache.
+
+    INPUTS:
+        model_path: the hub name.
+
+    OUTPUTS: the commit hash, or None if it cannot be resolved.
+    '''
+    try:
+        config_file = cached_file(model_path, 'config.json')
+    except (OSError, ValueError):
+        return None
+    if config_file is None:
+        return None
+    return extract_commit_hash(config_file, None)
+
+
+def _checkpoint_key(model_path: str) -> str:
+    # The files of a directory are identified by their size and modification time, a hub
+    # model by its name and commit. The quantized modules also depend on torch and its
+    # quantized engine. None for a hub model whose commit is unknown.
+    if is_local_checkpoint(model_path):
+        files = [
+            [name, os.path.getsize(os.path.join(model_path, name)), os.stat(os.path.join(model_path, name)).st_mtime_ns]
+            for name in sorted(os.listdir(model_path)) if name.endswith(CHECKPOINT_SUFFIXES)
+        ]
+    else:
+        revision = hub_revision(model_path)
+        if revision is None:
+            return None
+        files = [model_path, revision]
+    key = json.dumps([files, torch.__version__, torch.backends.quantized.engine])
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+@lru_cache(maxsize=MODEL_CACHE_SIZE)
+def _load_quantized_model(model_path: str, quantized_cache_dir: str = None):
+    local_files_only = is_local_checkpoint(model_path)
+    cache_path = None
+    if quantized_cache_dir is not None:
+        key = _checkpoint_key(model_path)
+        if key is None:
+            print(f'The revision of {model_path} is unknown, its int8 model is not cached')
+        else:
+            cache_path = os.path.join(quantized_cache_dir, f'{key[:32]}.state_dict.pt')
+        if cache_path is not None and os.path.isfile(cache_path):
+            # Only the tensors are saved: the quantized modules are rebuilt from the configuration
+            # of the checkpoint, without reading its float32 weights, and receive the int8 weights
+            config = AutoConfig.from_pretrained(model_path, local_files_only=local_files_only)
+            model = quantize_model(BertForMaskedLM(config))
+            model.load_state_dict(torch.load(cache_path, map_location='cpu', weights_only=True))
+            return model.eval()
+
+    model = quantize_model(BertForMaskedLM.from_pretrained(model_path, local_files_only=local_files_only))
+    if cache_path is not None:
+        os.makedirs(quantized_cache_dir, exist_ok=True)
+        temporary_path = cache_path + '.tmp'
+        torch.save(model.state_dict(), temporary_path)
+        os.replace(temporary_path, cache_path)
+    return model
+
+
+def load_model(model_path: str, device=None, precision: str = 'float32', quantized_cache_dir: str = None):
+    '''
+    DESCRIPTION:
+    Loads a masked language model once per process and device, in evaluation mode.
+
+    INPUTS:
+        model_path: the model directory or hub name.
+
+        device: the torch device. default: None (see model_device)
+
+        precision: one of PRECISIONS. The int8 model is quantized from the float32 weights
+        with quantize_model and runs on the cpu. default: 'float32'
+
+        quantized_cache_dir: directory where the state dicts of the int8 models are saved, so
+        a later run with the same checkpoint files, or hub commit, and torch version reads them
+        instead of quantizing the float32 model again. default: None
+
+    OUTPUTS: the model, the same object for every call with the same arguments.
+    '''
+    if precision not in PRECISIONS:
+        raise ValueError(f"Unknown precision {precision}. Use one of {PRECISIONS}")
+    if device is None:
+        device = model_device(precision)
+    if precision == 'int8':
+        if torch.device(device).type != 'cpu':
+            raise ValueError("The int8 models run on the cpu")
+        return _load_quantized_model(model_path, quantized_cache_dir)
+    return _load_model(model_path, str(device))
+
+
+def clear_model_cache():
+    '''
+    DESCRIPTION:
+    Releases the cached tokenizers and models.
+    '''
+    _load_tokenizer.cache_clear()
+    _load_model.cache_clear()
+    _load_quantized_model.cache_clear()
@@ -0,0 +1,330 @@
+import os
+import json
+import shutil
+import numpy as np
+import pandas as pd
+from prompt_templates import special_tokens
+
+
+PREDICTION_STORE_VERSION = 1
+
+EMBEDDING_DTYPES = ('float32', 'float16')
+TOP_ID_DTYPE = np.int32
+INDEX_DTYPE = np.int64
+
+# Number of rows copied or converted to a DataFrame at a time
+DEFAULT_CHUNK_SIZE = 65536
+
+
+class PredictionStore:
+    """
+    Mask predictions of an inference run written to disk as they are computed.
+
+    The rows are the masks, in the order of the prompts. The embeddings are a
+    float32 or float16 memory map (embeddings.bin), the top predicted token ids an
+    int32 one (top_ids.bin) and the prompt of every row an int64 one
+    (prompt_index.bin). Other per-row columns, like the cluster labels, are saved
+    as .npy files, and the prompts with their provenance as prompts.pkl. The
+    metadata (meta.json) is written last, so an interrupted run leaves an
+    incomplete store. Reading a store only maps the files: the DataFrames are
+    built chunk by chunk, on demand.
+
+    Args:
+        directory (str): Directory of the store files.
+        tokens_of (callable): Converts an array of top token ids into the predicted tokens of
+            every row, see predicted_tokens_of in inference. Default: None (the ids are returned).
+
+    Usage:
+        store = extract_bert_embeddings_dataframe(inputs, prediction_dir='predictions')
+        for dataframe in store.iter_dataframes(chunk_size=10000):
+            ...
+    """
+
+    def __init__(self, directory: str, tokens_of=None):
+        self.directory = directory
+        self.tokens_of = tokens_of
+        self.meta_path = os.path.join(directory, 'meta.json')
+        self.embeddings_path = os.path.join(directory, 'embeddings.bin')
+        self.top_ids_path = os.path.join(directory, 'top_ids.bin')
+        self.prompt_index_path = os.path.join(directory, 'prompt_index.bin')
+        self.prompts_path = os.path.join(directory, 'prompts.pkl')
+        self.shape = None
+        self.capacity = 0
+        self.embeddings = None
+        self.top_ids = None
+        self.prompt_index = None
+        self._columns = {}
+        self._prompts = None
+
+    def meta(self) -> dict:
+        if not os.path.isfile(self.meta_path):
+            return None
+        with open(self.meta_path, 'r', encoding='utf-8') as meta_file:
+            return json.load(meta_file)
+
+    def is_complete(self) -> bool:
+        meta = self.meta()
+        return meta is not None and meta.get('version') == PREDICTION_STORE_VERSION
+
+    def create(self, rows: int, width: int, top_k: int, embedding_dtype: str = 'float32'):
+        """
+        Allocates the files of a store of a known number of rows, replacing any previous content.
+        A store created with 0 rows is filled with append instead.
+
+        Args:
+            rows (int): The number of masks.
+            width (int): The size of the embeddings.
+            top_k (int): The number of predicted token ids of every mask.
+            embedding_dtype (str): One of EMBEDDING_DTYPES. Default: 'float32'.
+
+        Returns:
+            PredictionStore: The store itself, with its memory maps open for writing.
+        """
+        if embedding_dtype not in EMBEDDING_DTYPES:
+            raise ValueError(f"Unknown embedding_dtype {embedding_dtype}. Use one of {EMBEDDING_DTYPES}")
+
+        if os.path.isdir(self.directory):
+            shutil.rmtree(self.directory)
+        os.makedirs(self.directory)
+
+        self.shape = {'rows': rows, 'width': width, 'top_k': top_k, 'embedding_dtype': embedding_dtype}
+        self.capacity = rows
+        self._map('w+')
+        return self
+
+    def _row_bytes(self) -> tuple:
+        return (
+            self.shape['width'] * np.dtype(self.shape['embedding_dtype']).itemsize,
+            self.shape['top_k'] * np.dtype(TOP_ID_DTYPE).itemsize,
+            np.dtype(INDEX_DTYPE).itemsize
+        )
+
+    def _resize(self, capacity: int):
+        self.flush()
+        self.embeddings = self.top_ids = self.prompt_index = None
+        paths = (self.embeddings_path, self.top_ids_path, self.prompt_index_path)
+        for path, row_bytes in zip(paths, self._row_bytes()):
+            with open(path, 'ab') as store_file:
+                store_file.truncate(capacity * row_bytes)
+        self.capacity = capacity
+        self._map('r+')
+
+    def append(self, vectors: np.ndarray, top_ids: np.ndarray, prompt_index: np.ndarray):
+        """
+        Adds rows at the end of the store, growing its files.
+
+        Args:
+            vectors (np.ndarray): The embedding of every mask.
+            top_ids (np.ndarray): The top predicted token ids of every mask.
+            prompt_index (np.ndarray): The prompt of every mask.
+        """
+        start = self.shape['rows']
+        stop = start + len(vectors)
+        if stop > self.capacity:
+            self._resize(max(stop, 2 * self.capacity, 1024))
+        self.embeddings[start:stop] = vectors
+        self.top_ids[start:stop] = top_ids
+        self.prompt_index[start:stop] = prompt_index
+        self.shape['rows'] = stop
+
+    def _map(self, mode: str):
+        rows, width, top_k = self.capacity, self.shape['width'], self.shape['top_k']
+        # numpy cannot map an empty file
+        if rows * width:
+            self.embeddings = np.memmap(self.embeddings_path, dtype=self.shape['embedding_dtype'], mode=mode, shape=(rows, width))
+        else:
+            self.embeddings = np.zeros((rows, width), dtype=self.shape['embedding_dtype'])
+        if rows:
+            self.top_ids = np.memmap(self.top_ids_path, dtype=TOP_ID_DTYPE, mode=mode, shape=(rows, top_k))
+            self.prompt_index = np.memmap(self.prompt_index_path, dtype=INDEX_DTYPE, mode=mode, shape=(rows,))
+        else:
+            self.top_ids = np.zeros((0, top_k), dtype=TOP_ID_DTYPE)
+            self.prompt_index = np.zeros(0, dtype=INDEX_DTYPE)
+
+    def flush(self):
+        for array in (self.embeddings, self.top_ids, self.prompt_index):
+            if isinstance(array, np.memmap):
+                array.flush()
+
+    def close(self):
+        """
+        Flushes the files and marks the store as complete.
+
+        Returns:
+            PredictionStore: The store itself, opened for reading.
+        """
+        if self.capacity > self.shape['rows']:
+            # The unused rows of the last growth of append
+            self._resize(self.shape['rows'])
+        self.flush()
+        with open(self.meta_path, 'w', encoding='utf-8') as meta_file:
+            json.dump(dict(self.shape, version=PREDICTION_STORE_VERSION), meta_file)
+        return self.open()
+
+    def open(self):
+        """
+        Maps the store files in memory for reading.
+
+        Returns:
+            PredictionStore: The store itself.
+        """
+        meta = self.meta()
+        if meta is None or meta.get('version') != PREDICTION_STORE_VERSION:
+            raise ValueError(f"The prediction store {self.directory} is incomplete")
+
+        self.shape = {key: meta[key] for key in ('rows', 'width', 'top_k', 'embedding_dtype')}
+        self.capacity = self.shape['rows']
+        self._map('r')
+        self._columns = {}
+        self._prompts = None
+        return self
+
+    def __len__(self) -> int:
+        return self.shape['rows'] if self.shape else 0
+
+    def save_column(self, name: str, values):
+        """
+        Saves a per-row column, for example the cluster labels.
+
+        Args:
+            name (str): The column name.
+            values (array-like): One value per row.
+        """
+        values = np.asarray(values)
+        if len(values) != len(self):
+            raise ValueError(f"The column {name} has {len(values)} values for {len(self)} rows")
+        np.save(os.path.join(self.directory, name + '.npy'), values, allow_pickle=values.dtype == object)
+        self._columns.pop(name, None)
+
+    def columns(self) -> list:
+        return sorted(name[:-len('.npy')] for name in os.listdir(self.directory) if name.endswith('.npy'))
+
+    def column(self, name: str) -> np.ndarray:
+        if name not in self._columns:
+            path = os.path.join(self.directory, name + '.npy')
+            try:
+                self._columns[name] = np.load(path, mmap_mode='r')
+            except ValueError:
+                # Object columns are pickled and cannot be mapped
+                self._columns[name] = np.load(path, allow_pickle=True)
+        return self._columns[name]
+
+    def save_prompts(self, prompts: list, provenance: pd.DataFrame = None, tokenizer='bert'):
+        """
+        Saves the prompts of the prompt_index, and optionally their provenance, so the
+        DataFrames of the store carry the predicted_phrase and provenance columns.
+
+        Args:
+            prompts (list): The prompt texts.
+            provenance (pd.DataFrame): The provenance of select_prompt_records. Default: None.
+            tokenizer: The tokenizer, or model family, whose special tokens fill the prompts. See special_tokens.
+                Default: 'bert'.
+        """
+        table = pd.DataFrame({'prompt': prompts}) if provenance is None else provenance.assign(prompt=list(prompts))
+        table.to_pickle(self.prompts_path)
+        meta = self.meta()
+        meta['special_tokens'] = special_tokens(tokenizer)
+        with open(self.meta_path, 'w', encoding='utf-8') as meta_file:
+            json.dump(meta, meta_file)
+        self._prompts = None
+
+    def prompts(self) -> pd.DataFrame:
+        if self._prompts is None and os.path.isfile(self.prompts_path):
+            self._prompts = pd.read_pickle(self.prompts_path)
+        return self._prompts
+
+    def take(self, rows: np.ndarray, directory: str, prompt_index: np.ndarray = None, chunk_size: int = DEFAULT_CHUNK_SIZE):
+        """
+        Copies some rows to a new store, chunk by chunk.
+
+        Args:
+            rows (np.ndarray): The rows to copy, in their new order. They can repeat.
+            directory (str): The directory of the new store.
+            prompt_index (np.ndarray): The prompt of every new row. Default: None (the one of the copied row).
+            chunk_size (int): Number of rows copied at a time. Default: DEFAULT_CHUNK_SIZE.
+
+        Returns:
+            PredictionStore: The new store, opened for reading.
+        """
+        rows = np.asarray(rows, dtype=INDEX_DTYPE)
+        store = PredictionStore(directory, self.tokens_of).create(
+            len(rows), self.shape['width'], self.shape['top_k'], self.shape['embedding_dtype']
+        )
+        for start in range(0, len(rows), chunk_size):
+            chunk = rows[start:start + chunk_size]
+            store.embeddings[start:start + len(chunk)] = self.embeddings[chunk]
+            store.top_ids[start:start + len(chunk)] = self.top_ids[chunk]
+            store.prompt_index[start:start + len(chunk)] = (
+                self.prompt_index[chunk] if prompt_index is None else prompt_index[start:start + len(chunk)]
+            )
+            store.flush()
+        return store.close()
+
+    def to_dataframe(self, start: int = 0, stop: int = None, embeddings: bool = True) -> pd.DataFrame:
+        """
+        Builds the DataFrame of a range of rows, with the columns of the inference DataFrame.
+
+        Args:
+            start (int): The first row. Default: 0.
+            stop (int): The row after the last one. Default: None (the end of the store).
+            embeddings (bool): Include the mask_embedding column, as float32 arrays. Default: True.
+
+        Returns:
+            pd.DataFrame: predicted_token, predicted_phrase and provenance (if the prompts were saved),
+            mask_embedding, prompt_index and the saved columns.
+        """
+        stop = len(self) if stop is None else min(stop, len(self))
+        top_ids = np.asarray(self.top_ids[start:stop])
+        prompt_index = np.asarray(self.prompt_index[start:stop])
+        dataframe = pd.DataFrame({
+            'predicted_token': self.tokens_of(top_ids) if self.tokens_of is not None else list(top_ids)
+        })
+        if embeddings:
+            dataframe['mask_embedding'] = list(np.asarray(self.embeddings[start:stop], dtype=np.float32))
+        dataframe['prompt_index'] = prompt_index
+
+        prompts = self.prompts()
+        if prompts is not None:
+            # The phrase is rebuilt from the prompt text, as attach_provenance does
+            tokens = self.meta()['special_tokens']
+            dataframe.insert(1, 'predicted_phrase', [
+                prompt.replace(tokens['cls'], '').replace(tokens['sep'], '')
+                .replace(tokens['mask'], predicted_tokens[0] if len(predicted_tokens) else '').strip()
+                for prompt, predicted_tokens in zip(prompts['prompt'].to_numpy()[prompt_index], dataframe['predicted_token'])
+            ])
+            for column in prompts.columns:
+                if column != 'prompt':
+                    dataframe[column] = prompts[column].to_numpy()[prompt_index]
+
+        for name in self.columns():
+            dataframe[name] = np.asarray(self.column(name)[start:stop])
+        return dataframe
+
+    def iter_dataframes(self, chunk_size: int = DEFAULT_CHUNK_SIZE, embeddings: bool = True):
+        """
+        Reads the store as consecutive DataFrames of at most chunk_size rows.
+
+        Args:
+            chunk_size (int): Number of rows per DataFrame. Default: DEFAULT_CHUNK_SIZE.
+            embeddings (bool): See to_dataframe. Default: True.
+
+        Returns:
+            generator: The DataFrames, their index continuing from one chunk to the next.
+        """
+        for start in range(0, len(self), chunk_size):
+            dataframe = self.to_dataframe(start, start + chunk_size, embeddings)
+            dataframe.index += start
+            yield dataframe
+
+    def to_csv(self, path: str, chunk_size: int = DEFAULT_CHUNK_SIZE, embeddings: bool = False, **kwargs):
+        """
+        Writes the store to a CSV file chunk by chunk.
+
+        Args:
+            path (str): The CSV file.
+            chunk_size (int): See iter_dataframes. Default: DEFAULT_CHUNK_SIZE.
+            embeddings (bool): Include the mask_embedding column. Default: False.
+            kwargs: Passed to DataFrame.to_csv.
+        """
+        for position, dataframe in enumerate(self.iter_dataframes(chunk_size, embeddings)):
+            dataframe.to_csv(path, mode='w' if position == 0 else 'a', header=position == 0, **kwargs)
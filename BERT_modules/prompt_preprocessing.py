@@ -1,46 +1,280 @@
-from transformers import BertTokenizer
+from model_cache import load_tokenizer, DEFAULT_TOKENIZER
+from prompt_tokenization import SplicedTokenizer, verify_spliced_tokenization
+from token_store import TokenShard
+from prediction_store import PredictionStore
+from prompt_templates import special_tokens
+import pandas as pd
+import numpy as np
+
+
+# Number of prompts tokenized both ways before trusting the spliced tokenization
+VERIFY_SAMPLE = 256
 
-def tokenize_prompts_beto(prompt_dict: dict, prompt_type: str = None, full_extraction: bool = False) -> dict:
-    """Compute PromptORE relation embedding for the list extracted from the json format.
+
+def select_prompts(prompt_dict, prompt_type: str = None, full_extraction: bool = False) -> list:
+    """Returns the list of prompts that the tokenizer processes, in the order of prompt_generator.
 
     Args:
-        prompt_dict (dict): The dictionary from where to extract the prompts.
+        prompt_dict (dict): The dictionary from where to extract the prompts, the
+            (template_id, entity_pair, text) tuples yielded by iter_prompts, with or without
+            provenance, or a list of prompts that is returned as it is.
         prompt_type (str): The type of prompt to analyse. Default: none.
         full_extraction (bool): If True, a list appends all the prompts in one list.
     Returns:
-        dict: inputs dictionary of the model"""
+        list: the prompts"""
+    if isinstance(prompt_dict, list):
+        return prompt_dict
+
     if prompt_dict is None:
         raise ValueError('prompt_dictionary is required')
 
     if not full_extraction and prompt_type is None:
         raise ValueError('If full_extraction is not intended, please introduce a prompt_type')
 
-    tokenizer = BertTokenizer.from_pretrained('dccuchile/bert-base-spanish-wwm-uncased')
-    prompt_type_list = []
+    if not isinstance(prompt_dict, dict):
+        # Prompts streamed from iter_prompts, grouped by template as prompt_generator does
+        streamed_prompts = {}
+        for template_id, _, text, *_ in prompt_dict:
+            if full_extraction or template_id == prompt_type:
+                streamed_prompts.setdefault(template_id, []).append(text)
+        prompt_dict = streamed_prompts
 
     if full_extraction:
-        all_phrases = [phrase for value_list in prompt_dict.values() for phrase in value_list]
-        inputs = tokenizer.batch_encode_plus(
-            all_phrases,
-            max_length=512,
-            truncation=True,
-            padding='max_length',
-            return_tensors='pt',
-            add_special_tokens=False
-        )
-    else:
-        if prompt_type in prompt_dict:
-            prompt_type_list.extend(prompt_dict[prompt_type])
+        return [phrase for value_list in prompt_dict.values() for phrase in value_list]
+
+    return list(prompt_dict.get(prompt_type, []))
+
+
+def deduplicate_prompts(prompts: list) -> tuple:
+    """Keeps one copy of every prompt, so repeated formulae are inferred only once.
+
+    Args:
+        prompts (list): The prompts, for example the output of select_prompts.
+    Returns:
+        tuple: the unique prompts in order of first appearance, and for every
+        input prompt the index of its unique prompt."""
+    unique_index = {}
+    inverse = [unique_index.setdefault(prompt, len(unique_index)) for prompt in prompts]
+    unique_prompts = list(unique_index)
+
+    if prompts:
+        print(f'{len(prompts)} prompts, {len(unique_prompts)} unique '
+              f'({1 - len(unique_prompts) / len(prompts):.1%} deduplicated)')
+
+    return unique_prompts, inverse
+
+
+def expand_predictions(dataframe: pd.DataFrame, inverse: list) -> pd.DataFrame:
+    """Fans the predictions of the unique prompts out to every occurrence.
+
+    Args:
+        dataframe (pd.DataFrame): The output of the embeddings extraction for the unique prompts,
+            with the prompt_index column.
+        inverse (list): The inverse indices returned by deduplicate_prompts.
+    Returns:
+        pd.DataFrame: One row per mask of every original prompt, with prompt_index
+        pointing to the original prompt."""
+    rows_by_prompt = {}
+    for row, prompt_index in enumerate(dataframe['prompt_index'].tolist()):
+        rows_by_prompt.setdefault(prompt_index, []).append(row)
+
+    rows = []
+    prompt_indices = []
+    for original_index, unique_index in enumerate(inverse):
+        unique_rows = rows_by_prompt.get(unique_index, [])
+        rows.extend(unique_rows)
+        prompt_indices.extend([original_index] * len(unique_rows))
+
+    expanded = dataframe.iloc[rows].reset_index(drop=True)
+    expanded['prompt_index'] = prompt_indices
+    return expanded
+
+
+def expand_prediction_store(store: PredictionStore, inverse: list, directory: str) -> PredictionStore:
+    """Fans the predictions of a PredictionStore of the unique prompts out to every occurrence,
+    as expand_predictions does, copying the rows chunk by chunk to a new store.
+
+    Args:
+        store (PredictionStore): The store of the unique prompts.
+        inverse (list): The inverse indices returned by deduplicate_prompts.
+        directory (str): The directory of the new store.
+    Returns:
+        PredictionStore: One row per mask of every original prompt, with prompt_index
+        pointing to the original prompt."""
+    inverse = np.asarray(inverse, dtype=np.int64)
+    # The rows sorted by prompt, the prompts can be inferred in any order
+    prompt_index = np.asarray(store.prompt_index)
+    by_prompt = np.argsort(prompt_index, kind='stable')
+    counts = np.bincount(prompt_index, minlength=int(inverse.max(initial=-1)) + 1)
+    starts = np.concatenate([[0], np.cumsum(counts)])
+    expanded_counts = counts[inverse]
+    expanded_starts = np.concatenate([[0], np.cumsum(expanded_counts)])[:-1]
+    rows = by_prompt[np.repeat(starts[inverse] - expanded_starts, expanded_counts)
+                     + np.arange(int(expanded_counts.sum()))]
+    prompt_index = np.repeat(np.arange(len(inverse)), expanded_counts)
+    return store.take(rows, directory, prompt_index=prompt_index)
+
+
+# Identifiers of the prompt of every row, kept from the ingestion to the clustering
+PROVENANCE_COLUMNS = ('template_id', 'entity_pair', 'document', 'div', 'sentence')
+
+
+def select_prompt_records(prompt_dict, prompt_type: str = None, full_extraction: bool = False) -> tuple:
+    """Returns the prompts of select_prompts together with the provenance of every prompt.
+
+    Args:
+        prompt_dict: See select_prompts. Only the (template_id, entity_pair, text, provenance) tuples
+            of iter_prompts with with_provenance=True carry the full provenance. A prompt dictionary
+            only knows the template of its prompts, and a list of prompts nothing.
+        prompt_type (str): See select_prompts.
+        full_extraction (bool): See select_prompts.
+    Returns:
+        tuple: the prompts, in the order of select_prompts, and a DataFrame with the
+        PROVENANCE_COLUMNS of every prompt, None where unknown."""
+    if isinstance(prompt_dict, (dict, list)) or prompt_dict is None:
+        prompts = select_prompts(prompt_dict, prompt_type, full_extraction)
+        if isinstance(prompt_dict, dict):
+            template_ids = [
+                template_id for template_id, value_list in prompt_dict.items()
+                if full_extraction or template_id == prompt_type
+                for _ in value_list
+            ]
+        else:
+            template_ids = [None] * len(prompts)
+        unknown = [None] * len(prompts)
+        return prompts, pd.DataFrame(dict(zip(PROVENANCE_COLUMNS, (template_ids, unknown, unknown, unknown, unknown))))
+
+    if not full_extraction and prompt_type is None:
+        raise ValueError('If full_extraction is not intended, please introduce a prompt_type')
+
+    # Grouped by template as select_prompts does, the provenance in the same order as the texts
+    grouped = {}
+    for prompt in prompt_dict:
+        template_id, entity_pair, text = prompt[:3]
+        if full_extraction or template_id == prompt_type:
+            source, div, sentence = prompt[3] if len(prompt) > 3 else (None, None, None)
+            group = grouped.setdefault(template_id, ([], [], [], [], []))
+            for values, value in zip(group, (text, entity_pair, source, div, sentence)):
+                values.append(value)
+
+    prompts = [text for group in grouped.values() for text in group[0]]
+    columns = {'template_id': [template_id for template_id, group in grouped.items() for _ in group[0]]}
+    for position, column in enumerate(PROVENANCE_COLUMNS[1:], start=1):
+        columns[column] = [value for group in grouped.values() for value in group[position]]
+
+    return prompts, pd.DataFrame(columns)
+
+
+def attach_provenance(dataframe: pd.DataFrame, prompts: list, provenance: pd.DataFrame, tokenizer='bert') -> pd.DataFrame:
+    """Adds the provenance of its prompt to every row, and rebuilds the predicted_phrase column
+    from the prompt texts if the inference did not decode it.
+
+    Args:
+        dataframe (pd.DataFrame): The output of the embeddings extraction, with the prompt_index column.
+        prompts (list): The prompts returned by select_prompt_records.
+        provenance (pd.DataFrame): The provenance returned by select_prompt_records.
+        tokenizer: The tokenizer, or model family, whose special tokens fill the prompts. See special_tokens.
+            Default: 'bert'.
+    Returns:
+        pd.DataFrame: The rows ordered by prompt_index, with the PROVENANCE_COLUMNS. The predicted_phrase is
+        the prompt without its special tokens, the mask being replaced by the first predicted token."""
+    # The order is the one of the prompts, whatever the batching of the inference
+    dataframe = dataframe.sort_values('prompt_index', kind='stable').reset_index(drop=True)
+    prompt_indices = dataframe['prompt_index'].to_numpy()
 
-        inputs = tokenizer.batch_encode_plus(
-            prompt_type_list,
-            max_length=512,
-            truncation=True,
-            padding='max_length',
-            return_tensors='pt',
-            add_special_tokens=False
-        )
+    if 'predicted_phrase' not in dataframe:
+        tokens = special_tokens(tokenizer)
+        phrases = [
+            prompts[prompt_index].replace(tokens['cls'], '').replace(tokens['sep'], '')
+            .replace(tokens['mask'], predicted_tokens[0] if len(predicted_tokens) else '').strip()
+            for prompt_index, predicted_tokens in zip(prompt_indices.tolist(), dataframe['predicted_token'])
+        ]
+        dataframe.insert(1, 'predicted_phrase', phrases)
+
+    for column in PROVENANCE_COLUMNS:
+        dataframe[column] = provenance[column].to_numpy()[prompt_indices]
+
+    return dataframe
+
+def tokenize_prompts_beto(
+        prompt_dict: dict,
+        prompt_type: str = None,
+        full_extraction: bool = False,
+        tokenizer_name: str = DEFAULT_TOKENIZER,
+        spliced: bool = True,
+        token_cache_dir: str = None
+        ) -> dict:
+    """Compute PromptORE relation embedding for the list extracted from the json format.
+
+    Args:
+        prompt_dict (dict): The dictionary from where to extract the prompts, the
+            (template_id, entity_pair, text) tuples yielded by iter_prompts, or a list of prompts.
+        prompt_type (str): The type of prompt to analyse. Default: none.
+        full_extraction (bool): If True, a list appends all the prompts in one list.
+        tokenizer_name (str): The model directory or hub name of the tokenizer. Checkpoints without
+            tokenizer files use DEFAULT_TOKENIZER. Default: DEFAULT_TOKENIZER.
+        spliced (bool): Tokenize every phrase, entity and template fragment once and splice their
+            token ids, see SplicedTokenizer. The ids are the same as tokenizing every prompt. Default: True.
+        token_cache_dir (str): If given, the token ids are saved in a memory-mapped TokenShard of this directory,
+            and read back by any run with the same prompts and an identical tokenizer. Default: None.
+    Returns:
+        dict: inputs dictionary of the model, with one unpadded list of token ids per prompt,
+        or the opened TokenShard if token_cache_dir is given"""
+    prompts = select_prompts(prompt_dict, prompt_type, full_extraction)
 
-    return inputs
+    tokenizer = load_tokenizer(tokenizer_name)
 
+    if token_cache_dir is not None:
+        return _tokenize_to_shard(prompts, tokenizer, spliced, token_cache_dir)
 
+    return _tokenize(prompts, tokenizer, spliced)
+
+
+def prompt_encoder(tokenizer, sample: list, spliced: bool = True):
+    """Returns the function that tokenizes lists of prompts, without special tokens nor padding.
+
+    Args:
+        tokenizer: The fast tokenizer of the model.
+        sample (list): The first prompts, to check that SplicedTokenizer matches the tokenizer.
+        spliced (bool): Use SplicedTokenizer when it matches the tokenizer on the sample. Default: True.
+    Returns:
+        callable: Takes a list of prompts and returns their lists of token ids"""
+    if spliced:
+        if not verify_spliced_tokenization(sample[:VERIFY_SAMPLE], tokenizer):
+            spliced_tokenizer = SplicedTokenizer(tokenizer)
+            return lambda prompts: spliced_tokenizer(prompts)['input_ids']
+        print('The spliced tokenization does not match this tokenizer, the prompts are tokenized whole')
+
+    # No padding here: every batch is padded to its own longest prompt by pad_batch
+    return lambda prompts: tokenizer(prompts, max_length=512, truncation=True, padding=False, add_special_tokens=False)['input_ids']
+
+
+def iter_token_ids(prompts: list, tokenizer, spliced: bool = True, chunk_size: int = 65536):
+    """Tokenizes the prompts chunk by chunk, without special tokens nor padding.
+
+    Args:
+        prompts (list): The prompts.
+        tokenizer: The fast tokenizer of the model.
+        spliced (bool): Use SplicedTokenizer when it matches the tokenizer on the first prompts. Default: True.
+        chunk_size (int): Number of prompts per chunk. Default: 65536.
+    Returns:
+        generator: lists of input_ids, one list of token ids per prompt"""
+    encode = prompt_encoder(tokenizer, prompts, spliced)
+
+    for start in range(0, len(prompts), chunk_size):
+        yield encode(prompts[start:start + chunk_size])
+
+
+def _tokenize(prompts: list, tokenizer, spliced: bool) -> dict:
+    input_ids = [ids for chunk in iter_token_ids(prompts, tokenizer, spliced) for ids in chunk]
+    return {'input_ids': input_ids, 'attention_mask': [[1] * len(ids) for ids in input_ids]}
+
+
+def _tokenize_to_shard(prompts: list, tokenizer, spliced: bool, token_cache_dir: str) -> TokenShard:
+    shard = TokenShard.for_prompts(token_cache_dir, tokenizer, prompts)
+    if shard.is_complete():
+        print(f'Tokenized prompts read from {shard.directory}')
+    else:
+        shard.write(iter_token_ids(prompts, tokenizer, spliced))
+        print(f'Tokenized prompts saved at {shard.directory}')
+    return shard.open()
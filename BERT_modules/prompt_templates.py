@@ -0,0 +1,276 @@
+from functools import lru_cache
+
+
+# Special tokens of every model family. The templates only use the placeholders.
+SPECIAL_TOKENS = {
+    'bert': {'cls': '[CLS]', 'mask': '[MASK]', 'sep': '[SEP]'},
+    'roberta': {'cls': '<s>', 'mask': '<mask>', 'sep': '</s>'}
+}
+
+# Templates for the phrases with a single entity. {head} is the entity.
+UNIQUE_TEMPLATES = {
+    'prompt_0': ('{cls} {phrase} La relación entre {head} y la frase anterior es una relación de {mask}. {sep}',),
+    'prompt_1': ('{cls} {phrase} La relación entre {head} y la frase anterior es una relación de tipo {mask}. {sep}',)
+}
+
+# Templates for a pair of entities. A template with several variants yields one prompt per variant.
+PAIR_TEMPLATES = {
+    'prompt_0': ('{cls} {phrase} {head} {mask} {tail}. {sep}',),
+    'prompt_1': ('{cls} {phrase} La relación entre {head} y {tail} es una relación de tipo {mask}. {sep}',),
+    'prompt_2': ('{cls} {phrase} La relación entre {head} y {tail} es una relación de {mask}. {sep}',),
+    'prompt_3': ('{cls} {phrase} La relación entre {head} y {tail} es de naturaleza {mask}. {sep}',),
+    'prompt_4': ('{cls} {phrase} La relación entre {head} y {tail} es de carácter {mask}. {sep}',),
+    'prompt_5': (
+        '{cls} {phrase} ¿Cuál es la relación entre {head} y {tail}? La relación es el {mask}. {sep}',
+        '{cls} {phrase} ¿Cuál es la relación entre {head} y {tail}? La relación es la {mask}. {sep}'
+    )
+}
+
+
+# Endings of the templates in the prompts of the original prompt_generator,
+# which did not end every template with a period
+PERIOD = '{mask}. {sep}'
+NO_PERIOD = '{mask} {sep}'
+NO_SEP = '{mask}'
+
+# Ending of every template in the original prompts, by model family, full_extraction and
+# number of entities. A template with several endings was repeated once per ending, so the
+# original BERT prompt_0, prompt_1 and prompt_2 of two entities were generated twice.
+BERT_BASELINE_ENDINGS = {
+    1: {'prompt_0': (PERIOD,), 'prompt_1': (PERIOD,)},
+    2: {
+        'prompt_0': (PERIOD, PERIOD),
+        'prompt_1': (PERIOD, PERIOD),
+        'prompt_2': (PERIOD, PERIOD),
+        'prompt_3': (NO_PERIOD,),
+        'prompt_4': (NO_PERIOD,),
+        'prompt_5': (NO_PERIOD,)
+    },
+    3: {template_id: (PERIOD,) for template_id in PAIR_TEMPLATES}
+}
+BASELINE_ENDINGS = {
+    ('bert', True): BERT_BASELINE_ENDINGS,
+    ('bert', False): BERT_BASELINE_ENDINGS,
+    ('roberta', True): {
+        1: {'prompt_0': (PERIOD,), 'prompt_1': (PERIOD,)},
+        2: {'prompt_0': (PERIOD,), **{f'prompt_{index}': (NO_PERIOD,) for index in range(1, 6)}},
+        3: {template_id: (PERIOD,) for template_id in PAIR_TEMPLATES}
+    },
+    ('roberta', False): {
+        1: {'prompt_0': (PERIOD,), 'prompt_1': (PERIOD,)},
+        2: {
+            'prompt_0': (PERIOD,),
+            'prompt_1': (NO_PERIOD,),
+            'prompt_2': (NO_PERIOD,),
+            'prompt_3': (NO_PERIOD,),
+            'prompt_4': (NO_PERIOD,),
+            'prompt_5': (NO_SEP,)
+        },
+        3: {
+            'prompt_0': (PERIOD,),
+            'prompt_1': (PERIOD,),
+            'prompt_2': (PERIOD,),
+            'prompt_3': (NO_PERIOD,),
+            'prompt_4': (NO_PERIOD,),
+            'prompt_5': (NO_SEP,)
+        }
+    }
+}
+
+# 'baseline': the original prompts, only for phrases with 1, 2 or 3 entities, every prompt once.
+# 'uniform': every template ends with a period, for any number of entities.
+# 'legacy': the original prompts including their repetitions, byte for byte.
+TEMPLATE_SETS = ('baseline', 'uniform', 'legacy')
+
+# Strategies to combine the entities of a phrase, see entity_pairs
+PAIR_POLICIES = ('baseline', 'all', 'adjacent', 'window')
+
+# Entities combined by the original prompts. The first template put the third
+# entity after the first one, the other templates before it.
+BASELINE_PAIRS = {1: ((0,),), 2: ((0, 1),), 3: ((0, 1), (1, 2), (2, 0))}
+BASELINE_TEMPLATE_PAIRS = {('prompt_0', 3): ((0, 1), (1, 2), (0, 2))}
+
+
+def special_tokens(tokenizer) -> dict:
+    '''
+    DESCRIPTION:
+    Returns the CLS, MASK and SEP tokens used to fill the templates.
+
+    INPUTS:
+        tokenizer: a model family of SPECIAL_TOKENS ('bert' or 'roberta') or a
+        transformers tokenizer.
+
+    OUTPUTS: dictionary with the cls, mask and sep tokens.
+    '''
+    if isinstance(tokenizer, str):
+        if tokenizer not in SPECIAL_TOKENS:
+            raise ValueError(f"Unknown model family {tokenizer}. Use one of {list(SPECIAL_TOKENS)}")
+        return SPECIAL_TOKENS[tokenizer]
+
+    return {'cls': tokenizer.cls_token, 'mask': tokenizer.mask_token, 'sep': tokenizer.sep_token}
+
+
+def _compile(templates: dict, tokens: dict) -> dict:
+    # Only the model tokens are replaced, the entity and phrase fields stay for str.format
+    fields = {'phrase': '{phrase}', 'head': '{head}', 'tail': '{tail}'}
+    return {
+        template_id: tuple(variant.format(**tokens, **fields) for variant in variants)
+        for template_id, variants in templates.items()
+    }
+
+
+def template_variants(template_set: str, model_family: str, full_extraction: bool) -> dict:
+    '''
+    DESCRIPTION:
+    Returns the templates of a template set.
+
+    INPUTS:
+        template_set: one of TEMPLATE_SETS.
+
+        model_family: 'bert' or 'roberta', the original prompts were not the same.
+
+        full_extraction: the original prompts of RoBERTa were not the same with full_extraction.
+
+    OUTPUTS: dictionary with the number of entities as keys and the templates of the phrases
+    with that number of entities as values. The 'default' key holds the templates of any
+    other number of entities above 1.
+    '''
+    if template_set not in TEMPLATE_SETS:
+        raise ValueError(f"Unknown template_set {template_set}. Use one of {TEMPLATE_SETS}")
+
+    if template_set == 'uniform':
+        return {1: UNIQUE_TEMPLATES, 'default': PAIR_TEMPLATES}
+
+    if (model_family, full_extraction) not in BASELINE_ENDINGS:
+        raise ValueError(f"The {template_set} template set has no templates for the model family {model_family}")
+
+    return {
+        entity_count: {
+            template_id: tuple(
+                variant.replace(PERIOD, ending)
+                for variant in (UNIQUE_TEMPLATES if entity_count == 1 else PAIR_TEMPLATES)[template_id]
+                for ending in (template_endings if template_set == 'legacy' else dict.fromkeys(template_endings))
+            )
+            for template_id, template_endings in endings.items()
+        }
+        for entity_count, endings in BASELINE_ENDINGS[(model_family, bool(full_extraction))].items()
+    }
+
+
+def all_template_variants() -> list:
+    '''
+    DESCRIPTION:
+    Lists the variants of every template set, for all the model families.
+
+    OUTPUTS: list of distinct variants, with the model token placeholders.
+    '''
+    variants = []
+    for template_set in TEMPLATE_SETS:
+        configurations = [(None, None)] if template_set == 'uniform' else BASELINE_ENDINGS
+        for model_family, full_extraction in configurations:
+            for templates in template_variants(template_set, model_family, full_extraction).values():
+                for variants_of_template in templates.values():
+                    variants.extend(variants_of_template)
+    return list(dict.fromkeys(variants))
+
+
+@lru_cache(maxsize=None)
+def compile_templates(tokenizer='bert', template_set: str = 'baseline', full_extraction: bool = False) -> dict:
+    '''
+    DESCRIPTION:
+    Fills the model tokens of the templates once, so every prompt only
+    formats the phrase and the entities.
+
+    INPUTS:
+        tokenizer: see special_tokens. default: 'bert'
+        The baseline and legacy template sets need the model family name.
+
+        template_set: one of TEMPLATE_SETS. default: 'baseline'
+
+        full_extraction: see template_variants. default: False
+
+    OUTPUTS: dictionary with the compiled templates, as returned by template_variants.
+    '''
+    tokens = special_tokens(tokenizer)
+    model_family = tokenizer if isinstance(tokenizer, str) else None
+
+    return {
+        entity_count: _compile(templates, tokens)
+        for entity_count, templates in template_variants(template_set, model_family, full_extraction).items()
+    }
+
+
+def token_distance(text: str, first_span: tuple, second_span: tuple) -> int:
+    '''
+    DESCRIPTION:
+    Number of words between two entities of a phrase.
+
+    INPUTS:
+        text: the cleaned phrase.
+
+        first_span, second_span: the (start, end) offsets of the entities, in order.
+
+    OUTPUTS: the number of whitespace separated tokens between the entities.
+    '''
+    return len(text[first_span[1]:second_span[0]].split())
+
+
+def entity_pairs(
+    entity_count: int,
+    pair_policy: str = 'baseline',
+    spans: list = None,
+    text: str = None,
+    pair_window: int = None,
+    template_id: str = None
+):
+    '''
+    DESCRIPTION:
+    Lazily enumerates the positions of the entities combined in the prompts of a
+    phrase. Except for the 'baseline' policy, the pairs come by increasing distance
+    between positions, (0, 1), (1, 2), ..., then (0, 2), (1, 3), ..., so a prompt
+    budget keeps the closest entities.
+
+    INPUTS:
+        entity_count: number of entities of the phrase.
+
+        pair_policy: one of PAIR_POLICIES. default: 'baseline'
+            'baseline': the pairs of the original prompts, see BASELINE_PAIRS. Only
+            phrases with 1, 2 or 3 entities give pairs.
+            'all': every pair of entities.
+            'adjacent': only consecutive entities.
+            'window': the pairs separated by at most pair_window words.
+
+        spans, text: entity offsets and cleaned phrase, required by the 'window' policy.
+
+        pair_window: maximum number of words between the entities of a pair.
+
+        template_id: the template of the prompts, e.g. 'prompt_0'. Only used by the 'baseline' policy.
+
+    OUTPUTS: generator of tuples of entity positions. Phrases with one entity
+    give a single tuple with that entity.
+    '''
+    if pair_policy not in PAIR_POLICIES:
+        raise ValueError(f"Unknown pair_policy {pair_policy}. Use one of {PAIR_POLICIES}")
+    if pair_policy == 'window' and (pair_window is None or spans is None or text is None):
+        raise ValueError("The 'window' pair_policy requires pair_window, spans and text")
+
+    if pair_policy == 'baseline':
+        yield from BASELINE_TEMPLATE_PAIRS.get((template_id, entity_count), BASELINE_PAIRS.get(entity_count, ()))
+        return
+
+    if entity_count == 1:
+        yield (0,)
+        return
+
+    max_gap = 1 if pair_policy == 'adjacent' else entity_count - 1
+    for gap in range(1, max_gap + 1):
+        found = False
+        for first in range(entity_count - gap):
+            second = first + gap
+            if pair_policy == 'window' and token_distance(text, spans[first], spans[second]) > pair_window:
+                continue
+            found = True
+            yield (first, second)
+        # The distance grows with the gap, so no wider pair can fit in the window
+        if pair_policy == 'window' and not found:
+            return
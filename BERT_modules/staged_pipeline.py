@@ -0,0 +1,445 @@
+import time
+import queue
+import threading
+import numpy as np
+from functools import partial
+from tqdm import tqdm
+from corpus_ingestion import iter_corpus_phrases
+from prompt_generator import iter_prompts
+from prompt_preprocessing import prompt_encoder
+from model_cache import DEFAULT_TOKENIZER, PRECISIONS, load_tokenizer, load_model, model_device
+from embedding_cache import mask_keys
+from prediction_store import PredictionStore, EMBEDDING_DTYPES
+from inference import (
+    TOP_K, EMBEDDING_MODES, TokenBudgetSampler, InferenceStats, infer_adaptive, embedding_cache_table,
+    predictions_dataframe, predicted_tokens_of
+)
+
+
+# Number of items waiting in the queue between two stages
+QUEUE_SIZE = 8
+
+# Number of new prompts tokenized at a time by the tokenization stage
+TOKENIZE_CHUNK_SIZE = 1024
+
+# Number of new predictions written to the embedding cache at a time
+CACHE_CHUNK_SIZE = 65536
+
+
+class _StageFailure:
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+_END = object()
+
+
+class StageThread(threading.Thread):
+    """
+    Background stage of the staged pipeline. It iterates over an iterable, for example
+    the generator of the previous stage, and puts its items in a bounded queue, so it
+    never runs more than queue_size items ahead of the stage that consumes it.
+
+    The stage is consumed by iterating over it. An exception of the stage is raised
+    again in the consumer, and stop ends the stage early.
+
+    Args:
+        name (str): The name of the stage, for the timings.
+        items (iterable): The items produced by the stage.
+        queue_size (int): Maximum number of items waiting in the queue. Default: QUEUE_SIZE.
+
+    Usage:
+        prompts = StageThread('ingestion', iter_corpus_prompts(xml_input)).start_stage()
+        batches = StageThread('tokenization', iter_prompt_batches(prompts, tokenizer, TokenBudgetSampler(batch_size=32), records)).start_stage()
+        for unique_indices, items in batches:
+            ...
+    """
+
+    def __init__(self, name: str, items, queue_size: int = QUEUE_SIZE):
+        super().__init__(name=name, daemon=True)
+        self.items = items
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.stopped = threading.Event()
+        # Seconds the consumer waited for this stage
+        self.wait_time = 0.0
+
+    def start_stage(self):
+        self.start()
+        return self
+
+    def run(self):
+        try:
+            for item in self.items:
+                if not self._put(item):
+                    return
+        except BaseException as error:
+            self._put(_StageFailure(error))
+            return
+        self._put(_END)
+
+    def _put(self, item) -> bool:
+        # A stopped consumer no longer empties the queue
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def __iter__(self):
+        while True:
+            start = time.perf_counter()
+            item = self.queue.get()
+            self.wait_time += time.perf_counter() - start
+            if item is _END:
+                return
+            if isinstance(item, _StageFailure):
+                raise item.error
+            yield item
+
+    def stop(self):
+        self.stopped.set()
+
+
+def _entity_count(template_id: str) -> int:
+    # The keys of prompt_generator end with _unique or _ent_{number of entities}
+    return int(template_id.rsplit('_', 1)[1]) if '_ent_' in template_id else 1
+
+
+def iter_corpus_prompts(xml_input: str, max_workers: int = None, prompt_type: str = None, generated: list = None, **prompt_options):
+    """
+    Generates the prompts of a corpus file by file, as soon as every file is extracted.
+
+    The prompts of the merged corpus come by number of entities, then by file, so they
+    cannot be generated in that order before all the files are read. Every prompt is
+    yielded with its position in that order instead, see canonical_order. The global
+    max_prompts budget depends on that order, so it is not supported here.
+
+    Args:
+        xml_input (str): A XML file, a directory or a glob pattern. See resolve_xml_inputs.
+        max_workers (int): Number of processes extracting the files. Default: None (one per CPU).
+        prompt_type (str): If given, only the prompts of this template. Default: None.
+        generated (list): If given, every generated prompt is also appended to it with its key,
+            whatever its template, for example to save them. Default: None.
+        prompt_options: The full_extraction, entity_number, pair_policy, pair_window, template_set
+            and max_prompts_per_document of iter_prompts.
+
+    Returns:
+        generator: ((entity count, file position, prompt position), prompt) tuples, the prompt being the
+        (template_id, entity_pair, text, (source, div, sentence)) tuple of iter_prompts.
+    """
+    if prompt_options.get('max_prompts') is not None:
+        raise ValueError('max_prompts depends on the order of the whole corpus, use generate_prompts instead')
+
+    for file_position, (_, dictionary) in enumerate(iter_corpus_phrases(xml_input, max_workers, records=True)):
+        prompts = iter_prompts(phrase_input=dictionary, with_provenance=True, **prompt_options)
+        for prompt_position, prompt in enumerate(prompts):
+            key = (_entity_count(prompt[0]), file_position, prompt_position)
+            if generated is not None:
+                generated.append((key, prompt))
+            if prompt_type is None or prompt[0] == prompt_type:
+                yield key, prompt
+
+
+def iter_keyed_prompts(prompts, prompt_type: str = None):
+    """
+    Gives the prompts of an iterable already in the order of the corpus the keys of iter_corpus_prompts.
+
+    Args:
+        prompts (iterable): The (template_id, entity_pair, text, provenance) tuples, for example of generate_prompts.
+        prompt_type (str): If given, only the prompts of this template. Default: None.
+
+    Returns:
+        generator: ((0, 0, prompt position), prompt) tuples.
+    """
+    for prompt_position, prompt in enumerate(prompts):
+        if prompt_type is None or prompt[0] == prompt_type:
+            yield (0, 0, prompt_position), prompt
+
+
+def corpus_order(keys: list) -> np.ndarray:
+    """
+    Orders the keys of iter_corpus_prompts as the prompts of the merged corpus.
+
+    Args:
+        keys (list): The keys of the prompts.
+
+    Returns:
+        np.ndarray: The positions of the prompts, in the order of iter_prompts over the merged corpus.
+    """
+    if not keys:
+        return np.zeros(0, dtype=np.int64)
+    keys = np.asarray(keys, dtype=np.int64)
+    return np.lexsort((keys[:, 2], keys[:, 1], keys[:, 0]))
+
+
+def canonical_order(keys: list, template_ids: list) -> np.ndarray:
+    """
+    Orders the prompts received by the staged pipeline as select_prompt_records does:
+    by template, in order of first appearance, and in the order of the corpus within a template.
+
+    Args:
+        keys (list): The keys of iter_corpus_prompts of the prompts, in order of arrival.
+        template_ids (list): The template of every prompt.
+
+    Returns:
+        np.ndarray: The arrival positions of the prompts, in the order of select_prompt_records.
+    """
+    positions = corpus_order(keys)
+    template_rank = {}
+    ranks = np.fromiter(
+        (template_rank.setdefault(template_ids[position], len(template_rank)) for position in positions.tolist()),
+        dtype=np.int64,
+        count=len(positions)
+    )
+    return positions[np.argsort(ranks, kind='stable')]
+
+
+def iter_prompt_batches(
+        keyed_prompts,
+        tokenizer,
+        sampler: TokenBudgetSampler,
+        records: dict,
+        deduplicate: bool = True,
+        spliced: bool = True,
+        chunk_size: int = TOKENIZE_CHUNK_SIZE
+        ):
+    """
+    Tokenization stage: deduplicates the prompts as they arrive, tokenizes the new ones
+    chunk by chunk and groups them in batches.
+
+    Args:
+        keyed_prompts (iterable): The (key, prompt) tuples of iter_corpus_prompts.
+        tokenizer: The fast tokenizer of the model.
+        sampler (TokenBudgetSampler): Gives the size of the batches. With max_tokens, the prompts of
+            every tokenized chunk are packed by length, otherwise batches of batch_size prompts follow
+            the order of arrival.
+        records (dict): Filled with the 'keys', 'prompts' and 'inverse' lists of the received
+            prompts, inverse giving the unique prompt of every one. Read them once the stage is done.
+        deduplicate (bool): Infer every distinct prompt once. Default: True.
+        spliced (bool): See prompt_encoder. Default: True.
+        chunk_size (int): Number of new prompts tokenized at a time. Default: TOKENIZE_CHUNK_SIZE.
+
+    Returns:
+        generator: (unique prompt indices, items) tuples, the items being the unpadded input_ids taken by pad_batch.
+    """
+    keys = records.setdefault('keys', [])
+    prompts = records.setdefault('prompts', [])
+    inverse = records.setdefault('inverse', [])
+    unique_index = {}
+    encode = None
+    pending = []
+    token_ids = []
+    # Unique index of the first prompt of token_ids
+    next_unique = 0
+
+    def batches(final: bool):
+        nonlocal next_unique, token_ids
+        if sampler.max_tokens is not None:
+            for positions in sampler.pack([len(ids) for ids in token_ids]):
+                yield next_unique + positions, [{'input_ids': token_ids[position]} for position in positions.tolist()]
+            next_unique += len(token_ids)
+            token_ids = []
+            return
+        # Read at every batch, the sampler shrinks after an allocation failure
+        while len(token_ids) >= sampler.batch_size or (final and token_ids):
+            batch_ids = token_ids[:sampler.batch_size]
+            token_ids = token_ids[sampler.batch_size:]
+            unique_indices = np.arange(next_unique, next_unique + len(batch_ids))
+            next_unique += len(batch_ids)
+            yield unique_indices, [{'input_ids': ids} for ids in batch_ids]
+
+    for key, prompt in keyed_prompts:
+        keys.append(key)
+        prompts.append(prompt)
+        text = prompt[2]
+        if deduplicate:
+            if text in unique_index:
+                inverse.append(unique_index[text])
+                continue
+            unique_index[text] = len(unique_index)
+            inverse.append(unique_index[text])
+        else:
+            inverse.append(len(inverse))
+        pending.append(text)
+
+        if len(pending) >= chunk_size:
+            if encode is None:
+                encode = prompt_encoder(tokenizer, pending, spliced)
+            token_ids.extend(encode(pending))
+            pending = []
+            yield from batches(final=False)
+
+    if pending:
+        if encode is None:
+            encode = prompt_encoder(tokenizer, pending, spliced)
+        token_ids.extend(encode(pending))
+    yield from batches(final=True)
+
+    if deduplicate and prompts:
+        print(f'{len(prompts)} prompts, {len(unique_index)} unique '
+              f'({1 - len(unique_index) / len(prompts):.1%} deduplicated)')
+
+
+def run_staged_inference(
+        keyed_prompts,
+        model_name: str,
+        tokenizer_name: str = DEFAULT_TOKENIZER,
+        batch_size: int = 8,
+        embedding: str = 'logits',
+        layers=-1,
+        layer_pooling: str = 'mean',
+        mask_only: bool = True,
+        deduplicate: bool = True,
+        spliced: bool = True,
+        embedding_cache=None,
+        prediction_dir: str = None,
+        embedding_dtype: str = 'float32',
+        queue_size: int = QUEUE_SIZE,
+        max_tokens: int = None,
+        precision: str = 'float32',
+        quantized_cache_dir: str = None
+        ) -> tuple:
+    """
+    Runs the ingestion, the tokenization and the inference of the pipeline at the same time.
+
+    The prompts are generated in one background thread, deduplicated, tokenized and
+    batched in another one, and the batches are inferred in the calling thread as soon
+    as they are ready. The stages are connected by queues of queue_size items, so the
+    memory they use does not grow with the corpus. The rows follow the order in which
+    the unique prompts arrive.
+
+    Args:
+        keyed_prompts (iterable): The (key, prompt) tuples of iter_corpus_prompts or iter_keyed_prompts.
+            Consumed in the ingestion thread.
+        model_name (str): The model directory or hub name.
+        tokenizer_name (str): The tokenizer of the checkpoints without tokenizer files. Default: DEFAULT_TOKENIZER.
+        batch_size (int): Number of unique prompts per batch. Default: 8.
+        embedding, layers, layer_pooling, mask_only: See extract_bert_embeddings_dataframe.
+        deduplicate (bool): Infer every distinct prompt once. Default: True.
+        spliced (bool): See prompt_encoder. Default: True.
+        embedding_cache (EmbeddingCache or str): The embedding cache. The batches whose masks are all cached
+            skip the model. Default: None.
+        prediction_dir (str): If given, the predictions are appended to a PredictionStore of this directory
+            instead of being kept in memory. Default: None.
+        embedding_dtype (str): See extract_bert_embeddings_dataframe. Default: 'float32'.
+        queue_size (int): Maximum number of items waiting between two stages. Default: QUEUE_SIZE.
+        max_tokens (int): If given, the unique prompts of every tokenized chunk are packed in batches of
+            this number of padded tokens, see TokenBudgetSampler. Default: None (batch_size prompts).
+        precision, quantized_cache_dir: See extract_bert_embeddings_dataframe.
+
+    Returns:
+        tuple: The predictions (the DataFrame of extract_bert_embeddings_dataframe, or the PredictionStore),
+        with prompt_index pointing to the unique prompts, and the records of iter_prompt_batches.
+    """
+    if embedding not in EMBEDDING_MODES:
+        raise ValueError(f"Unknown embedding {embedding}. Use one of {EMBEDDING_MODES}")
+
+    if embedding_dtype not in EMBEDDING_DTYPES:
+        raise ValueError(f"Unknown embedding_dtype {embedding_dtype}. Use one of {EMBEDDING_DTYPES}")
+
+    if precision not in PRECISIONS:
+        raise ValueError(f"Unknown precision {precision}. Use one of {PRECISIONS}")
+
+    device = model_device(precision)
+    tokenizer = load_tokenizer(model_name, tokenizer_name)
+
+    store = None
+    if prediction_dir is not None:
+        store = PredictionStore(prediction_dir, partial(predicted_tokens_of, tokenizer))
+
+    cache_table = None
+    if embedding_cache is not None:
+        embedding_cache, cache_table = embedding_cache_table(embedding_cache, model_name, device, embedding, layers, layer_pooling, precision)
+
+    sampler = TokenBudgetSampler(batch_size=batch_size, max_tokens=max_tokens)
+    stats = InferenceStats()
+    records = {}
+    ingestion = StageThread('ingestion', keyed_prompts, queue_size).start_stage()
+    tokenization = StageThread(
+        'tokenization',
+        iter_prompt_batches(ingestion, tokenizer, sampler, records, deduplicate, spliced),
+        queue_size
+    ).start_stage()
+
+    model = None
+    vector_chunks, top_id_chunks, index_chunks = [], [], []
+    cache_buffer = []
+    cached_total = mask_total = 0
+    start = time.perf_counter()
+    first_batch = inference_time = None
+    try:
+        for unique_indices, items in tqdm(tokenization, leave=True):
+            if first_batch is None:
+                first_batch = time.perf_counter() - start
+                inference_time = 0.0
+            batch_start = time.perf_counter()
+
+            vectors = None
+            if cache_table is not None:
+                prompt_ids = [np.asarray(item['input_ids'], dtype=np.int32) for item in items]
+                mask_counts = np.array([np.count_nonzero(ids == tokenizer.mask_token_id) for ids in prompt_ids], dtype=np.int64)
+                keys = mask_keys(prompt_ids, mask_counts)
+                slots = cache_table.lookup(keys)
+                if len(slots) and (slots >= 0).all():
+                    vectors, top_ids = cache_table.read(slots)
+                    rows = np.repeat(np.arange(len(prompt_ids)), mask_counts)
+                    cached_total += len(slots)
+
+            if vectors is None:
+                if model is None:
+                    model = load_model(model_name, device, precision, quantized_cache_dir)
+                rows, vectors, top_ids = infer_adaptive(
+                    model, items, tokenizer.pad_token_id, tokenizer.mask_token_id,
+                    device, embedding, layers, layer_pooling, mask_only, sampler, stats
+                )
+                if cache_table is not None:
+                    new = slots < 0
+                    cache_buffer.append((keys[new], vectors[new], top_ids[new]))
+                    if sum(len(buffered[0]) for buffered in cache_buffer) >= CACHE_CHUNK_SIZE:
+                        cache_table.write(*(np.concatenate(arrays) for arrays in zip(*cache_buffer)))
+                        cache_buffer.clear()
+
+            prompt_indices = unique_indices[rows]
+            mask_total += len(rows)
+            if store is not None:
+                if store.shape is None:
+                    store.create(0, vectors.shape[1], TOP_K, embedding_dtype)
+                store.append(vectors, top_ids, prompt_indices)
+            else:
+                vector_chunks.append(vectors)
+                top_id_chunks.append(top_ids)
+                index_chunks.append(prompt_indices)
+            inference_time += time.perf_counter() - batch_start
+    finally:
+        ingestion.stop()
+        tokenization.stop()
+
+    if cache_table is not None:
+        if cache_buffer:
+            cache_table.write(*(np.concatenate(arrays) for arrays in zip(*cache_buffer)))
+        cache_table.flush()
+        embedding_cache.evict(keep=cache_table)
+        print(f'{cached_total} of {mask_total} mask predictions read from the embedding cache')
+
+    if stats.batches:
+        print(stats.report())
+    if first_batch is not None:
+        print(f'First batch ready after {first_batch:.1f} s. Inference {inference_time:.1f} s, '
+              f'waiting for the tokenization {tokenization.wait_time:.1f} s, '
+              f'total {time.perf_counter() - start:.1f} s')
+
+    if store is not None:
+        if store.shape is None:
+            store.create(0, 0, TOP_K, embedding_dtype)
+        return store.close(), records
+
+    width = vector_chunks[0].shape[1] if vector_chunks else 0
+    dataframe = predictions_dataframe(
+        tokenizer,
+        np.concatenate(vector_chunks) if vector_chunks else np.empty((0, width), dtype=np.float32),
+        np.concatenate(top_id_chunks) if top_id_chunks else np.zeros((0, TOP_K), dtype=np.int64),
+        np.concatenate(index_chunks) if index_chunks else np.zeros(0, dtype=np.int64)
+    )
+    return dataframe, records
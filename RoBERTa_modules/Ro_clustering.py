@@ -5,16 +5,29 @@ import torch
 import pandas as pd
 
 
+def mask_embeddings(relation_embeddings):
+    """Returns the embeddings to cluster
+    Args:
+        relation_embeddings (pd.DataFrame): relation embeddings, or the PredictionStore of the inference
+    Returns:
+        list or np.memmap: one embedding per row
+    """
+    if isinstance(relation_embeddings, pd.DataFrame):
+        return relation_embeddings['mask_embedding'].tolist()
+    # A PredictionStore: its memory-mapped embeddings are read by KMeans without building a DataFrame
+    return relation_embeddings.embeddings
+
+
 def compute_kmeans_clustering(relation_embeddings: pd.DataFrame, n_rel: int, \
     random_state: int):
     """Compute kmeans clustering with fixed nb of clusters
     Args:
-        relation_embeddings (pd.DataFrame): relation embeddings
+        relation_embeddings (pd.DataFrame): relation embeddings, or the PredictionStore of the inference
         n_rel (int): number of relations (nb of clusters)
     Returns:
         torch.Tensor: predicted labels
     """
-    embeddings = relation_embeddings['mask_embedding'].tolist()
+    embeddings = mask_embeddings(relation_embeddings)
 
     model = KMeans(init='k-means++', n_init=10, n_clusters=n_rel, random_state=random_state, algorithm='elkan')
     predicted_labels = model.fit(embeddings)
@@ -29,11 +42,11 @@ def plot_elbow_curve(data: pd.DataFrame, max_k: int):
     Plot the elbow curve for KMeans clustering using Seaborn.
     
     Args:
-        data (numpy.ndarray or torch.Tensor): The data for clustering.
+        data (pd.DataFrame): The data for clustering, or the PredictionStore of the inference.
         max_k (int): The maximum number of clusters to consider.
     """
     wcss = []
-    data = data['mask_embedding'].tolist()
+    data = mask_embeddings(data)
 
     for k in range(2, max_k):
         kmeans = KMeans(n_clusters=k, init='k-means++', random_state=42, n_init= 'auto', algorithm='elkan')
@@ -0,0 +1,409 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import numpy as np
+import torch
+from Ro_ingestion_cache import file_sha256
+
+
+EMBEDDING_CACHE_VERSION = 1
+
+VECTOR_DTYPE = np.float32
+TOP_ID_DTYPE = np.int32
+KEY_DTYPE = np.uint64
+
+# Default size of a cache directory, beyond it the least recently used predictions are evicted
+DEFAULT_MAX_BYTES = 8 << 30
+
+# Files of a checkpoint directory that determine its predictions
+MODEL_FILE_SUFFIXES = ('.safetensors', '.bin')
+MODEL_CONFIG_FILE = 'config.json'
+
+
+def state_dict_fingerprint(model) -> str:
+    '''
+    DESCRIPTION:
+    Identifies a model by the values of its parameters and buffers.
+
+    INPUTS:
+        model: the torch model.
+
+    OUTPUTS: the fingerprint.
+    '''
+    digest = hashlib.sha256()
+    for name, tensor in sorted(model.state_dict().items()):
+        digest.update(name.encode('utf-8'))
+        digest.update(str(tensor.dtype).encode('utf-8'))
+        digest.update(tensor.detach().cpu().contiguous().view(-1).view(torch.uint8).numpy().tobytes())
+    return digest.hexdigest()
+
+
+def mask_keys(prompt_ids, mask_counts: np.ndarray) -> np.ndarray:
+    '''
+    DESCRIPTION:
+    Identifies every mask of the prompts by the token ids of its prompt and its
+    position among the masks of the prompt.
+
+    INPUTS:
+        prompt_ids: iterable of int32 arrays, the unpadded token ids of every prompt.
+
+        mask_counts: the number of masks of every prompt.
+
+    OUTPUTS: one 64-bit key per mask, in the order of the prompts.
+    '''
+    keys = np.empty(int(np.sum(mask_counts)), dtype=KEY_DTYPE)
+    row = 0
+    for ids, mask_count in zip(prompt_ids, mask_counts.tolist()):
+        data = ids.tobytes()
+        for mask_number in range(mask_count):
+            digest = hashlib.blake2b(data, digest_size=8, salt=mask_number.to_bytes(8, 'little'))
+            keys[row] = int.from_bytes(digest.digest(), 'little')
+            row += 1
+    return keys
+
+
+def _directory_bytes(directory: str) -> int:
+    return sum(entry.stat().st_size for entry in os.scandir(directory) if entry.is_file())
+
+
+def _save_array(path: str, array: np.ndarray):
+    # Write to a temporary file first so an interrupted run never leaves a broken index
+    temporary_path = path + '.tmp.npy'
+    np.save(temporary_path, array)
+    os.replace(temporary_path, path)
+
+
+class EmbeddingTable:
+    """
+    Mask predictions of one model and one embedding configuration.
+
+    Every cached mask takes a row (slot) of two memory-mapped files: its embedding
+    in vectors.bin (float32) and its top predicted token ids in top_ids.bin (int32).
+    The index keeps the key of mask_keys and the last use of every slot, and the
+    metadata (meta.json) the shapes of the files. When the files reach max_bytes
+    the least recently used slots are overwritten. A table modified by a run that
+    did not flush it is discarded when opened again.
+
+    Args:
+        directory (str): Directory of the table files.
+        max_bytes (int): Maximum size of the table files. Default: None (no limit).
+        identity (dict): Saved in the metadata to identify the table, see EmbeddingCache.table. Default: None.
+
+    Usage:
+        slots = table.lookup(keys)
+        vectors, top_ids = table.read(slots[slots >= 0])
+        table.write(new_keys, new_vectors, new_top_ids)
+        table.flush()
+    """
+
+    def __init__(self, directory: str, max_bytes: int = None, identity: dict = None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.identity = identity or {}
+        self.meta_path = os.path.join(directory, 'meta.json')
+        self.vectors_path = os.path.join(directory, 'vectors.bin')
+        self.top_ids_path = os.path.join(directory, 'top_ids.bin')
+        self.keys_path = os.path.join(directory, 'keys.npy')
+        self.last_used_path = os.path.join(directory, 'last_used.npy')
+
+        self.width = None
+        self.top_k = None
+        self.capacity = 0
+        self.clock = 0
+        self.vectors = None
+        self.top_ids = None
+        self.keys = np.empty(0, dtype=KEY_DTYPE)
+        self.last_used = np.empty(0, dtype=np.int64)
+        self.index = {}
+        self.dirty = False
+        self._open()
+
+    def _open(self):
+        meta = None
+        if os.path.isfile(self.meta_path):
+            with open(self.meta_path, 'r', encoding='utf-8') as meta_file:
+                meta = json.load(meta_file)
+        if meta is None or not meta.get('clean') or meta.get('version') != EMBEDDING_CACHE_VERSION:
+            if os.path.isdir(self.directory):
+                shutil.rmtree(self.directory)
+            return
+
+        self.width = meta['width']
+        self.top_k = meta['top_k']
+        self.capacity = meta['capacity']
+        self.clock = meta['clock']
+        self.keys = np.load(self.keys_path)
+        self.last_used = np.load(self.last_used_path)
+        self._map()
+        used = np.flatnonzero(self.last_used)
+        self.index = dict(zip(self.keys[used].tolist(), used.tolist()))
+
+    def _map(self):
+        self.vectors = np.memmap(self.vectors_path, dtype=VECTOR_DTYPE, mode='r+', shape=(self.capacity, self.width))
+        self.top_ids = np.memmap(self.top_ids_path, dtype=TOP_ID_DTYPE, mode='r+', shape=(self.capacity, self.top_k))
+
+    def _write_meta(self, clean: bool):
+        meta = dict(
+            self.identity,
+            version=EMBEDDING_CACHE_VERSION,
+            width=self.width,
+            top_k=self.top_k,
+            capacity=self.capacity,
+            clock=self.clock,
+            clean=clean,
+            last_used=time.time()
+        )
+        with open(self.meta_path, 'w', encoding='utf-8') as meta_file:
+            json.dump(meta, meta_file)
+
+    def _resize(self, capacity: int):
+        self.vectors = None
+        self.top_ids = None
+        for path, row_bytes in (
+            (self.vectors_path, self.width * np.dtype(VECTOR_DTYPE).itemsize),
+            (self.top_ids_path, self.top_k * np.dtype(TOP_ID_DTYPE).itemsize)
+        ):
+            with open(path, 'ab') as table_file:
+                table_file.truncate(capacity * row_bytes)
+        self.keys = np.concatenate([self.keys, np.zeros(capacity - self.capacity, dtype=KEY_DTYPE)])
+        self.last_used = np.concatenate([self.last_used, np.zeros(capacity - self.capacity, dtype=np.int64)])
+        self.capacity = capacity
+        self._map()
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    @property
+    def max_rows(self) -> int:
+        if self.max_bytes is None or self.width is None:
+            return None
+        row_bytes = (
+            self.width * np.dtype(VECTOR_DTYPE).itemsize
+            + self.top_k * np.dtype(TOP_ID_DTYPE).itemsize
+            + np.dtype(KEY_DTYPE).itemsize + np.dtype(np.int64).itemsize
+        )
+        return max(self.max_bytes // row_bytes, 1)
+
+    def lookup(self, keys: np.ndarray) -> np.ndarray:
+        """
+        Finds the slots of the cached masks and marks them as used.
+
+        Args:
+            keys (np.ndarray): The keys of mask_keys.
+
+        Returns:
+            np.ndarray: The slot of every key, -1 for the masks that are not cached.
+        """
+        index = self.index
+        slots = np.fromiter((index.get(key, -1) for key in keys.tolist()), dtype=np.int64, count=len(keys))
+        self.clock += 1
+        self.last_used[slots[slots >= 0]] = self.clock
+        return slots
+
+    def read(self, slots: np.ndarray) -> tuple:
+        """
+        Reads cached masks.
+
+        Args:
+            slots (np.ndarray): Slots returned by lookup.
+
+        Returns:
+            tuple: The embeddings and the top predicted token ids of the slots, copied in memory.
+        """
+        return np.asarray(self.vectors[slots]), np.asarray(self.top_ids[slots])
+
+    def write(self, keys: np.ndarray, vectors: np.ndarray, top_ids: np.ndarray):
+        """
+        Adds masks to the table, evicting the least recently used ones if it is full.
+
+        Args:
+            keys (np.ndarray): The keys of mask_keys.
+            vectors (np.ndarray): The embedding of every mask.
+            top_ids (np.ndarray): The top predicted token ids of every mask.
+        """
+        if self.width is None:
+            self.width = int(vectors.shape[1])
+            self.top_k = int(top_ids.shape[1])
+            os.makedirs(self.directory, exist_ok=True)
+            open(self.vectors_path, 'wb').close()
+            open(self.top_ids_path, 'wb').close()
+            self.vectors = np.empty((0, self.width), dtype=VECTOR_DTYPE)
+            self.top_ids = np.empty((0, self.top_k), dtype=TOP_ID_DTYPE)
+        elif vectors.shape[1] != self.width or top_ids.shape[1] != self.top_k:
+            raise ValueError(f"The embedding table {self.directory} holds rows of another width")
+
+        keys, first = np.unique(keys, return_index=True)
+        vectors, top_ids = vectors[first], top_ids[first]
+        max_rows = self.max_rows
+        if max_rows is not None and len(keys) > max_rows:
+            keys, vectors, top_ids = keys[:max_rows], vectors[:max_rows], top_ids[:max_rows]
+        if not len(keys):
+            return
+
+        if not self.dirty:
+            # Until flush, an interrupted run leaves the table marked as broken
+            self._write_meta(clean=False)
+            self.dirty = True
+
+        slots = self.lookup(keys)
+        new = slots < 0
+        free = np.flatnonzero(self.last_used == 0)
+        needed = int(new.sum()) - len(free)
+        if needed > 0:
+            capacity = max(self.capacity * 2, self.capacity + needed, 1024)
+            if max_rows is not None:
+                capacity = min(capacity, max_rows)
+            if capacity > self.capacity:
+                self._resize(capacity)
+                free = np.flatnonzero(self.last_used == 0)
+        needed = int(new.sum()) - len(free)
+        if needed > 0:
+            # The least recently used slots are reused, except the ones used by this run
+            candidates = np.flatnonzero((self.last_used > 0) & (self.last_used < self.clock))
+            if len(candidates) < needed:
+                # The table is full of rows of this run: the last new rows are not cached
+                kept = np.ones(len(keys), dtype=bool)
+                kept[np.flatnonzero(new)[len(free) + len(candidates):]] = False
+                keys, vectors, top_ids, slots, new = keys[kept], vectors[kept], top_ids[kept], slots[kept], new[kept]
+                needed = len(candidates)
+        if needed > 0:
+            evicted = candidates[np.argpartition(self.last_used[candidates], needed - 1)[:needed]]
+            for key in self.keys[evicted].tolist():
+                self.index.pop(key, None)
+            self.last_used[evicted] = 0
+            free = np.flatnonzero(self.last_used == 0)
+
+        slots[new] = free[:int(new.sum())]
+        self.keys[slots] = keys
+        self.last_used[slots] = self.clock
+        self.vectors[slots] = vectors
+        self.top_ids[slots] = top_ids
+        self.index.update(zip(keys.tolist(), slots.tolist()))
+
+    def flush(self):
+        """
+        Saves the index and marks the table as complete.
+        """
+        if self.width is None:
+            return
+        self.vectors.flush()
+        self.top_ids.flush()
+        _save_array(self.keys_path, self.keys)
+        _save_array(self.last_used_path, self.last_used)
+        self._write_meta(clean=True)
+        self.dirty = False
+
+
+class EmbeddingCache:
+    """
+    On-disk cache of the mask predictions of the inference, shared by the runs of
+    the same models on overlapping prompts.
+
+    A prediction is identified by the fingerprint of the model weights, the embedding
+    configuration (mode, layers, pooling, number of predicted tokens) and the token
+    ids of its prompt. Every model and configuration has its own EmbeddingTable. The
+    size of the directory is bounded by max_bytes: whole tables are evicted from the
+    least recently used one, and a table larger than the bound overwrites its least
+    recently used masks.
+
+    Args:
+        cache_dir (str): Directory of the cache.
+        max_bytes (int): Maximum size of the directory. Default: DEFAULT_MAX_BYTES (8 GiB).
+
+    Usage:
+        cache = EmbeddingCache('embedding_cache')
+        table = cache.table(cache.model_key(model_path), {'embedding': 'hidden', 'layers': [-1]})
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.models_path = os.path.join(cache_dir, 'models.json')
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def model_key(self, model_path: str, load_model=None) -> str:
+        """
+        Fingerprints the weights of a model. The SHA-256 of the files of a checkpoint
+        directory are saved with their size and modification time, so unchanged
+        checkpoints are not read again.
+
+        Args:
+            model_path (str): The model directory or hub name.
+            load_model (callable): Returns the loaded model, to fingerprint the models that are
+                not a local directory. Default: None.
+
+        Returns:
+            str: The fingerprint.
+        """
+        if not os.path.isdir(model_path):
+            if load_model is None:
+                raise ValueError(f"The model {model_path} is not a local directory, load_model is required")
+            return state_dict_fingerprint(load_model())
+
+        models = {}
+        if os.path.isfile(self.models_path):
+            with open(self.models_path, 'r', encoding='utf-8') as models_file:
+                models = json.load(models_file)
+
+        file_digests = []
+        for name in sorted(os.listdir(model_path)):
+            if name != MODEL_CONFIG_FILE and not name.endswith(MODEL_FILE_SUFFIXES):
+                continue
+            path = os.path.abspath(os.path.join(model_path, name))
+            stat = os.stat(path)
+            entry = models.get(path)
+            if entry is None or entry[:2] != [stat.st_size, stat.st_mtime_ns]:
+                entry = [stat.st_size, stat.st_mtime_ns, file_sha256(path)]
+                models[path] = entry
+            file_digests.append([name, entry[2]])
+
+        temporary_path = self.models_path + '.tmp'
+        with open(temporary_path, 'w', encoding='utf-8') as models_file:
+            json.dump(models, models_file)
+        os.replace(temporary_path, self.models_path)
+
+        return hashlib.sha256(json.dumps(file_digests).encode('utf-8')).hexdigest()
+
+    def table(self, model_key: str, config: dict) -> EmbeddingTable:
+        """
+        Opens the table of a model and an embedding configuration.
+
+        Args:
+            model_key (str): The fingerprint of model_key.
+            config (dict): The embedding configuration, JSON serializable.
+
+        Returns:
+            EmbeddingTable: The table, empty if the model and configuration were never cached.
+        """
+        config_key = hashlib.sha256(json.dumps(config, sort_keys=True).encode('utf-8')).hexdigest()
+        directory = os.path.join(self.cache_dir, f'{model_key[:16]}-{config_key[:16]}')
+        return EmbeddingTable(directory, max_bytes=self.max_bytes, identity={'model': model_key, 'config': config})
+
+    def evict(self, keep: EmbeddingTable = None):
+        """
+        Removes the least recently used tables until the directory fits in max_bytes.
+
+        Args:
+            keep (EmbeddingTable): A table that is never removed, the one of the current run. Default: None.
+        """
+        tables = []
+        for entry in os.scandir(self.cache_dir):
+            if not entry.is_dir() or (keep is not None and os.path.abspath(entry.path) == os.path.abspath(keep.directory)):
+                continue
+            last_used = 0
+            meta_path = os.path.join(entry.path, 'meta.json')
+            if os.path.isfile(meta_path):
+                with open(meta_path, 'r', encoding='utf-8') as meta_file:
+                    last_used = json.load(meta_file).get('last_used', 0)
+            tables.append((last_used, entry.path))
+
+        total = sum(_directory_bytes(path) for _, path in tables)
+        if keep is not None and os.path.isdir(keep.directory):
+            total += _directory_bytes(keep.directory)
+        for _, path in sorted(tables):
+            if total <= self.max_bytes:
+                break
+            total -= _directory_bytes(path)
+            shutil.rmtree(path)
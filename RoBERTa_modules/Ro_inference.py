@@ -1,7 +1,13 @@
+import time
 import torch
+import numpy as np
 import pandas as pd
+from functools import partial
 from tqdm import tqdm  # tqdm for progress tracking
-from transformers import RobertaForMaskedLM, AutoTokenizer
+from Ro_model_cache import PRECISIONS, load_tokenizer, load_model, model_device
+from Ro_token_store import TokenShard, tokenizer_fingerprint
+from Ro_embedding_cache import EmbeddingCache, mask_keys
+from Ro_prediction_store import PredictionStore, DEFAULT_CHUNK_SIZE, EMBEDDING_DTYPES
 
 
 class MeditationsDataSet(torch.utils.data.Dataset):
@@ -9,84 +15,934 @@ class MeditationsDataSet(torch.utils.data.Dataset):
         self.encodings = encodings
     
     def __len__(self):
-        return self.encodings.input_ids.shape[0]
+        return len(self.encodings['input_ids'])
     
     def __getitem__(self, index):
         return {key: val[index] for key, val in self.encodings.items()}
 
+
+class TokenShardDataSet(torch.utils.data.Dataset):
+    """
+    Dataset of the prompts of a TokenShard. Every item is a view of the memory-mapped
+    token buffer, copied only when its batch is padded.
+    """
+
+    def __init__(self, shard: TokenShard):
+        self.shard = shard
+
+    def __len__(self):
+        return len(self.shard)
+
+    def __getitem__(self, index):
+        return {'input_ids': self.shard[index]}
+
+
+def pad_batch(batch: list, pad_token_id: int = 0) -> dict:
+    """
+    Collate function that pads the prompts of a batch to the longest one of the batch.
+
+    Args:
+        batch (list): Items of MeditationsDataSet, with unpadded or padded input_ids and attention_mask,
+            or of TokenShardDataSet, with only the unpadded input_ids.
+        pad_token_id (int): The padding token of the tokenizer. Default: 0.
+
+    Returns:
+        dict: input_ids and attention_mask tensors of shape (batch size, longest prompt).
+    """
+    lengths = [
+        int(sum(item['attention_mask'])) if 'attention_mask' in item else len(item['input_ids'])
+        for item in batch
+    ]
+    input_ids = np.full((len(batch), max(lengths)), pad_token_id, dtype=np.int64)
+    attention_mask = np.zeros((len(batch), max(lengths)), dtype=np.int64)
+
+    for row, (item, length) in enumerate(zip(batch, lengths)):
+        input_ids[row, :length] = item['input_ids'][:length]
+        attention_mask[row, :length] = 1
+
+    return {'input_ids': torch.from_numpy(input_ids), 'attention_mask': torch.from_numpy(attention_mask)}
+
+
+# What is stored in mask_embedding: the LM head scores of the vocabulary or the encoder hidden state
+EMBEDDING_MODES = ('logits', 'hidden')
+
+# How several hidden layers are combined into one embedding
+LAYER_POOLINGS = ('mean', 'concat')
+
+
+def pool_hidden_states(hidden_states: tuple, rows: torch.Tensor, columns: torch.Tensor, layers=-1, layer_pooling: str = 'mean') -> torch.Tensor:
+    """
+    Gathers the hidden states of some positions from the selected layers.
+
+    Args:
+        hidden_states (tuple): The hidden_states of the model output, the embedding layer first.
+        rows, columns (torch.Tensor): The batch rows and token positions to gather.
+        layers (int or list): Index of the layer in hidden_states, or indices of several layers. Default: -1 (last layer).
+        layer_pooling (str): One of LAYER_POOLINGS, to combine several layers. Default: 'mean'.
+
+    Returns:
+        torch.Tensor: One embedding per position, of the hidden size (or hidden size times the number of layers for 'concat').
+    """
+    if layer_pooling not in LAYER_POOLINGS:
+        raise ValueError(f"Unknown layer_pooling {layer_pooling}. Use one of {LAYER_POOLINGS}")
+
+    layers = [layers] if isinstance(layers, int) else list(layers)
+    selected = [hidden_states[layer][rows, columns] for layer in layers]
+    if len(selected) == 1:
+        return selected[0]
+    if layer_pooling == 'concat':
+        return torch.cat(selected, dim=-1)
+    return torch.stack(selected).mean(dim=0)
+
+
+# Number of predicted tokens kept for every mask
+TOP_K = 10
+
+
+# Number of prompts decoded at a time to rebuild their phrases
+DECODE_CHUNK_SIZE = 4096
+
+
+def prompt_token_ids(item: dict) -> np.ndarray:
+    """
+    Returns the unpadded token ids of an item of MeditationsDataSet or TokenShardDataSet.
+
+    Args:
+        item (dict): The item, with the input_ids and optionally the attention_mask of a prompt.
+
+    Returns:
+        np.ndarray: The int32 token ids, without the padding.
+    """
+    input_ids = item['input_ids']
+    if 'attention_mask' in item:
+        input_ids = input_ids[:int(sum(item['attention_mask']))]
+    return np.asarray(input_ids, dtype=np.int32)
+
+
+def count_masks(dataset, mask_token_id: int) -> np.ndarray:
+    """
+    Counts the masks of every prompt of a dataset.
+
+    Args:
+        dataset (MeditationsDataSet or TokenShardDataSet): The prompts.
+        mask_token_id (int): The mask token of the tokenizer.
+
+    Returns:
+        np.ndarray: The number of masks of every prompt.
+    """
+    if isinstance(dataset, TokenShardDataSet):
+        # Vectorized over the memory map: the prompt of a mask is the last offset before it
+        shard = dataset.shard
+        prompt_count = len(shard)
+        positions = np.flatnonzero(shard.tokens == mask_token_id)
+        prompts = np.searchsorted(shard.offsets, positions, side='right') - 1
+        return np.bincount(prompts, minlength=prompt_count).astype(np.int64)
+
+    return np.fromiter(
+        (np.count_nonzero(prompt_token_ids(dataset[index]) == mask_token_id) for index in range(len(dataset))),
+        dtype=np.int64,
+        count=len(dataset)
+    )
+
+
+def prompt_lengths(dataset) -> np.ndarray:
+    """
+    Returns the number of tokens of every prompt of a dataset, without the padding.
+
+    Args:
+        dataset (MeditationsDataSet or TokenShardDataSet): The prompts.
+
+    Returns:
+        np.ndarray: The length of every prompt.
+    """
+    if isinstance(dataset, TokenShardDataSet):
+        return np.diff(np.asarray(dataset.shard.offsets)).astype(np.int64)
+
+    return np.fromiter(
+        (len(prompt_token_ids(dataset[index])) for index in range(len(dataset))),
+        dtype=np.int64,
+        count=len(dataset)
+    )
+
+
+# Prompts whose lengths round up to the same multiple of BUCKET_WIDTH share a bucket
+BUCKET_WIDTH = 8
+
+
+class TokenBudgetSampler(torch.utils.data.Sampler):
+    """
+    Batch sampler of prompts of very different lengths. With max_tokens, the prompts are
+    grouped in length buckets and every batch is packed with prompts of one bucket until
+    its padded size, prompts times longest prompt, would exceed max_tokens. The longest
+    buckets come first, so a batch too large for the device fails at the start of the run.
+    Without max_tokens, the batches are the consecutive batch_size prompts.
+
+    After an allocation failure, shrink limits the batches not yet sampled to half the failed batch.
+
+    Args:
+        lengths (np.ndarray): The number of tokens of every prompt. Can be None if only pack is used.
+        batch_size (int): Number of prompts per batch when there is no max_tokens. Default: 8.
+        max_tokens (int): Maximum number of padded tokens per batch. Default: None (fixed batch_size).
+        bucket_width (int): Width of the length buckets. Default: BUCKET_WIDTH.
+
+    Usage:
+        sampler = TokenBudgetSampler(prompt_lengths(dataset), max_tokens=8192)
+        for positions in sampler:
+            batch = pad_batch([dataset[position] for position in positions])
+    """
+
+    def __init__(self, lengths: np.ndarray = None, batch_size: int = 8, max_tokens: int = None, bucket_width: int = BUCKET_WIDTH):
+        if max_tokens is not None and max_tokens < 1:
+            raise ValueError("max_tokens must be positive")
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+        self.bucket_width = bucket_width
+
+    def pack(self, lengths: np.ndarray):
+        """
+        Generates the batches of some prompts with the current budget.
+
+        Args:
+            lengths (np.ndarray): The number of tokens of every prompt.
+
+        Returns:
+            generator: The positions of the prompts of every batch, as np.ndarray.
+        """
+        lengths = np.asarray(lengths, dtype=np.int64)
+        if self.max_tokens is None:
+            start = 0
+            while start < len(lengths):
+                stop = min(start + self.batch_size, len(lengths))
+                yield np.arange(start, stop)
+                start = stop
+            return
+
+        buckets = -(-lengths // self.bucket_width)
+        # Longest bucket first, the prompts of a bucket in their order
+        order = np.argsort(-buckets, kind='stable')
+        batch = []
+        longest = 0
+        for position, bucket in zip(order.tolist(), buckets[order].tolist()):
+            length = int(lengths[position])
+            if batch and (bucket != batch_bucket or (len(batch) + 1) * max(longest, length) > self.max_tokens):
+                yield np.array(batch, dtype=np.int64)
+                batch = []
+                longest = 0
+            if not batch:
+                batch_bucket = bucket
+            batch.append(position)
+            longest = max(longest, length)
+        if batch:
+            yield np.array(batch, dtype=np.int64)
+
+    def __iter__(self):
+        return self.pack(self.lengths)
+
+    def shrink(self, prompts: int, padded_tokens: int):
+        """
+        Limits the next batches to half a batch that ran out of memory. The batches sampled
+        before the failure and still to be inferred do not shrink them further.
+
+        Args:
+            prompts (int): The number of prompts of the failed batch.
+            padded_tokens (int): Its number of tokens with the padding.
+        """
+        if self.max_tokens is None:
+            self.batch_size = min(self.batch_size, max(1, prompts // 2))
+        else:
+            self.max_tokens = min(self.max_tokens, max(1, padded_tokens // 2))
+
+
+class InferenceStats:
+    """
+    Throughput and padding of the batches inferred in a run.
+
+    Attributes:
+        batches (int): Number of batches run by the model.
+        prompts (int): Number of prompts inferred.
+        tokens (int): Number of tokens of the prompts.
+        padded_tokens (int): Number of tokens of the padded batches.
+        seconds (float): Time spent in the model.
+        retries (int): Number of batches split after an allocation failure.
+    """
+
+    def __init__(self):
+        self.batches = 0
+        self.prompts = 0
+        self.tokens = 0
+        self.padded_tokens = 0
+        self.seconds = 0.0
+        self.retries = 0
+
+    def add(self, batch: dict, seconds: float):
+        lengths = batch['attention_mask'].sum(dim=1)
+        self.batches += 1
+        self.prompts += len(lengths)
+        self.tokens += int(lengths.sum())
+        self.padded_tokens += batch['attention_mask'].numel()
+        self.seconds += seconds
+
+    def report(self) -> str:
+        tokens_per_second = self.tokens / self.seconds if self.seconds else 0.0
+        padding_efficiency = self.tokens / self.padded_tokens if self.padded_tokens else 1.0
+        return (f'{self.prompts} prompts in {self.batches} batches: {tokens_per_second:.0f} tokens/s, '
+                f'padding efficiency {padding_efficiency:.1%}, {self.retries} batches split after an allocation failure')
+
+
+def is_out_of_memory(error: BaseException) -> bool:
+    """
+    Tells whether an error of the model is an allocation failure of the device.
+
+    Args:
+        error (BaseException): The error raised by the model.
+
+    Returns:
+        bool: True for the out of memory errors of CUDA and of the CPU allocator.
+    """
+    if isinstance(error, (MemoryError, torch.cuda.OutOfMemoryError)):
+        return True
+    return isinstance(error, RuntimeError) and ('out of memory' in str(error) or "can't allocate memory" in str(error))
+
+
+def infer_adaptive(
+        model,
+        items: list,
+        pad_token_id: int,
+        mask_token_id: int,
+        device,
+        embedding: str = 'logits',
+        layers=-1,
+        layer_pooling: str = 'mean',
+        mask_only: bool = True,
+        sampler: TokenBudgetSampler = None,
+        stats: InferenceStats = None
+        ) -> tuple:
+    """
+    Pads and infers a batch with infer_batch. If the device runs out of memory, the batch is
+    split in two halves inferred one after the other, and the sampler shrinks the next batches.
+
+    Args:
+        model: The masked language model.
+        items (list): The items of the batch, as taken by pad_batch.
+        pad_token_id (int): The padding token of the tokenizer.
+        mask_token_id (int): The mask token of the tokenizer.
+        device: The device of the model.
+        embedding, layers, layer_pooling, mask_only: See extract_Roberta_embeddings_dataframe.
+        sampler (TokenBudgetSampler): The sampler of the batches, shrunk after an allocation failure. Default: None.
+        stats (InferenceStats): Gets every batch run by the model. Default: None.
+
+    Returns:
+        tuple: See infer_batch, the rows being the positions in items.
+    """
+    batch = pad_batch(items, pad_token_id)
+    start = time.perf_counter()
+    try:
+        result = infer_batch(model, batch, mask_token_id, device, embedding, layers, layer_pooling, mask_only)
+    except Exception as error:
+        if not is_out_of_memory(error) or len(items) == 1:
+            raise
+        if device.type == 'cuda':
+            torch.cuda.empty_cache()
+        if sampler is not None:
+            sampler.shrink(len(items), batch['input_ids'].numel())
+        if stats is not None:
+            stats.retries += 1
+        middle = len(items) // 2
+        first = infer_adaptive(model, items[:middle], pad_token_id, mask_token_id, device, embedding, layers, layer_pooling, mask_only, sampler, stats)
+        second = infer_adaptive(model, items[middle:], pad_token_id, mask_token_id, device, embedding, layers, layer_pooling, mask_only, sampler, stats)
+        return (
+            np.concatenate([first[0], second[0] + middle]),
+            np.concatenate([first[1], second[1]]),
+            np.concatenate([first[2], second[2]])
+        )
+
+    if stats is not None:
+        stats.add(batch, time.perf_counter() - start)
+    return result
+
+
+def infer_models_adaptive(
+        models: dict,
+        items: list,
+        pad_token_id: int,
+        mask_token_id: int,
+        device,
+        embedding: str = 'logits',
+        layers=-1,
+        layer_pooling: str = 'mean',
+        mask_only: bool = True,
+        sampler: TokenBudgetSampler = None,
+        stats: dict = None
+        ) -> tuple:
+    """
+    infer_adaptive for several models with the same tokenizer. The batch is padded, moved to
+    the device and its masks are found once, then every model runs it in turn. If a model runs
+    out of memory, the batch is split in two halves run again by all the models.
+
+    Args:
+        models (dict): The masked language models by name.
+        items, pad_token_id, mask_token_id, device, embedding, layers, layer_pooling, mask_only, sampler: See infer_adaptive.
+        stats (dict): The InferenceStats of every model name, gets the seconds of the model. Default: None.
+
+    Returns:
+        tuple: The batch row of every mask, the rows being the positions in items, and for every
+        model name the float32 embedding and the TOP_K predicted token ids of every mask.
+    """
+    batch = pad_batch(items, pad_token_id)
+    input_ids, attention_mask, mask_rows, mask_columns = batch_to_device(batch, mask_token_id, device)
+    outputs = {}
+    seconds = {}
+    try:
+        for name, model in models.items():
+            start = time.perf_counter()
+            outputs[name] = infer_masks(model, input_ids, attention_mask, mask_rows, mask_columns, embedding, layers, layer_pooling, mask_only)
+            seconds[name] = time.perf_counter() - start
+    except Exception as error:
+        if not is_out_of_memory(error) or len(items) == 1:
+            raise
+        del input_ids, attention_mask, outputs
+        if device.type == 'cuda':
+            torch.cuda.empty_cache()
+        if sampler is not None:
+            sampler.shrink(len(items), batch['input_ids'].numel())
+        if stats is not None:
+            for model_stats in stats.values():
+                model_stats.retries += 1
+        middle = len(items) // 2
+        first = infer_models_adaptive(models, items[:middle], pad_token_id, mask_token_id, device, embedding, layers, layer_pooling, mask_only, sampler, stats)
+        second = infer_models_adaptive(models, items[middle:], pad_token_id, mask_token_id, device, embedding, layers, layer_pooling, mask_only, sampler, stats)
+        return np.concatenate([first[0], second[0] + middle]), {
+            name: (
+                np.concatenate([first[1][name][0], second[1][name][0]]),
+                np.concatenate([first[1][name][1], second[1][name][1]])
+            )
+            for name in models
+        }
+
+    if stats is not None:
+        for name in models:
+            stats[name].add(batch, seconds[name])
+    return mask_rows.cpu().numpy(), outputs
+
+
+def predicted_tokens_of(tokenizer, top_ids: np.ndarray) -> list:
+    """
+    Converts the top predicted token ids of every mask into words.
+
+    Args:
+        tokenizer: The tokenizer of the model.
+        top_ids (np.ndarray): The TOP_K predicted token ids of every mask.
+
+    Returns:
+        list: The list of predicted words of every mask, the decoded ids split by whitespace.
+    """
+    return [decoded.split() for decoded in tokenizer.batch_decode(top_ids.tolist())]
+
+
+def predictions_dataframe(tokenizer, mask_embeddings: np.ndarray, top_ids: np.ndarray, prompt_indices: np.ndarray) -> pd.DataFrame:
+    """
+    Builds the DataFrame of the mask predictions.
+
+    Args:
+        tokenizer: The tokenizer of the model.
+        mask_embeddings (np.ndarray): The embedding of every mask.
+        top_ids (np.ndarray): The TOP_K predicted token ids of every mask.
+        prompt_indices (np.ndarray): The prompt of every mask.
+
+    Returns:
+        pd.DataFrame: The predicted_token, mask_embedding and prompt_index columns.
+    """
+    return pd.DataFrame({
+            'predicted_token': np.fromiter(predicted_tokens_of(tokenizer, top_ids), dtype=object, count=len(top_ids)),
+            'mask_embedding': list(mask_embeddings),
+            'prompt_index': prompt_indices
+            })
+
+
+def infer_batch(
+        model,
+        batch: dict,
+        mask_token_id: int,
+        device,
+        embedding: str = 'logits',
+        layers=-1,
+        layer_pooling: str = 'mean',
+        mask_only: bool = True
+        ) -> tuple:
+    """
+    Runs the model on a padded batch and gathers the predictions at the masks.
+
+    Args:
+        model: The masked language model.
+        batch (dict): The input_ids and attention_mask tensors of pad_batch.
+        mask_token_id (int): The mask token of the tokenizer.
+        device: The device of the model.
+        embedding, layers, layer_pooling, mask_only: See extract_Roberta_embeddings_dataframe.
+
+    Returns:
+        tuple: The batch row of every mask, in order, its float32 embedding and its TOP_K predicted token ids.
+    """
+    input_ids, attention_mask, mask_rows, mask_columns = batch_to_device(batch, mask_token_id, device)
+    vectors, top_ids = infer_masks(model, input_ids, attention_mask, mask_rows, mask_columns, embedding, layers, layer_pooling, mask_only)
+    return mask_rows.cpu().numpy(), vectors, top_ids
+
+
+def batch_to_device(batch: dict, mask_token_id: int, device) -> tuple:
+    """
+    Moves a padded batch to the device and finds its masks.
+
+    Args:
+        batch (dict): The input_ids and attention_mask tensors of pad_batch.
+        mask_token_id (int): The mask token of the tokenizer.
+        device: The device of the model.
+
+    Returns:
+        tuple: The input_ids and attention_mask on the device, and the row and column of every mask.
+    """
+    input_ids = batch['input_ids'].to(device)
+    attention_mask = batch['attention_mask'].to(device)
+    mask_rows, mask_columns = torch.where(input_ids == mask_token_id)
+    return input_ids, attention_mask, mask_rows, mask_columns
+
+
+def infer_masks(
+        model,
+        input_ids: torch.Tensor,
+        attention_mask: torch.Tensor,
+        mask_rows: torch.Tensor,
+        mask_columns: torch.Tensor,
+        embedding: str = 'logits',
+        layers=-1,
+        layer_pooling: str = 'mean',
+        mask_only: bool = True
+        ) -> tuple:
+    """
+    Runs the model on a batch of batch_to_device and gathers the predictions at the masks.
+
+    Returns:
+        tuple: The float32 embedding of every mask and its TOP_K predicted token ids.
+    """
+    model.eval()
+    with torch.no_grad():  # No need for gradient during evaluation
+        if mask_only:
+            # Only the mask rows go through the vocabulary projection of the LM head
+            model_outputs = model.base_model(input_ids, attention_mask = attention_mask, output_hidden_states = embedding == 'hidden')
+            outputs = model.lm_head(model_outputs.last_hidden_state[mask_rows, mask_columns])
+        else:
+            model_outputs = model(input_ids, attention_mask = attention_mask, output_hidden_states = embedding == 'hidden')
+            outputs = model_outputs.logits[mask_rows, mask_columns]
+
+    if embedding == 'hidden':
+        vectors = pool_hidden_states(model_outputs.hidden_states, mask_rows, mask_columns, layers, layer_pooling)
+    else:
+        vectors = outputs
+
+    return vectors.float().cpu().numpy(), torch.topk(outputs, TOP_K, dim=-1).indices.cpu().numpy()
+
+
+def embedding_cache_table(embedding_cache, model_name: str, device, embedding: str = 'logits', layers=-1, layer_pooling: str = 'mean', precision: str = 'float32') -> tuple:
+    """
+    Opens the table of the embedding cache for a model and an embedding configuration.
+
+    Args:
+        embedding_cache (EmbeddingCache or str): The cache, or its directory.
+        model_name (str): The model directory or hub name.
+        device: The device to load the model on, if it has to be fingerprinted from its weights.
+        embedding, layers, layer_pooling, precision: See extract_Roberta_embeddings_dataframe.
+
+    Returns:
+        tuple: The EmbeddingCache and its EmbeddingTable.
+    """
+    if isinstance(embedding_cache, str):
+        embedding_cache = EmbeddingCache(embedding_cache)
+    hidden = embedding == 'hidden'
+    config = {
+        'family': 'roberta',
+        'embedding': embedding,
+        'layers': ([layers] if isinstance(layers, int) else list(layers)) if hidden else None,
+        'layer_pooling': layer_pooling if hidden else None,
+        'top_k': TOP_K
+    }
+    if precision != 'float32':
+        # The float32 tables keep their configuration
+        config['precision'] = precision
+    cache_table = embedding_cache.table(
+        embedding_cache.model_key(model_name, partial(load_model, model_name, device)),
+        config
+    )
+    return embedding_cache, cache_table
+
+
+def allocate_predictions(mask_counts: np.ndarray, mask_offsets: np.ndarray, width: int, store: PredictionStore = None, embedding_dtype: str = 'float32') -> tuple:
+    """
+    Allocates the embedding and the top predicted token ids of every mask, in memory or in a PredictionStore.
+
+    Args:
+        mask_counts (np.ndarray): The number of masks of every prompt, see count_masks.
+        mask_offsets (np.ndarray): The first row of every prompt, and the number of rows at the end.
+        width (int): The size of the embeddings.
+        store (PredictionStore): If given, the arrays are the memory maps of the store, which also
+            gets the prompt_index of every row. Default: None.
+        embedding_dtype (str): The embedding type of the store, 'float32' or 'float16'. Default: 'float32'.
+
+    Returns:
+        tuple: The embeddings and the top token ids arrays, one row per mask.
+    """
+    mask_total = int(mask_offsets[-1])
+    if store is None:
+        return np.empty((mask_total, width), dtype=np.float32), np.zeros((mask_total, TOP_K), dtype=np.int64)
+
+    store.create(mask_total, width, TOP_K, embedding_dtype)
+    for start in range(0, len(mask_counts), DEFAULT_CHUNK_SIZE):
+        counts = mask_counts[start:start + DEFAULT_CHUNK_SIZE]
+        store.prompt_index[mask_offsets[start]:mask_offsets[start + len(counts)]] = np.repeat(
+            np.arange(start, start + len(counts)), counts
+        )
+    return store.embeddings, store.top_ids
+
+
+def flush_predictions(store: PredictionStore, cache_table, cache_buffer: list):
+    """
+    Writes the predictions of the last chunk of batches to disk.
+
+    Args:
+        store (PredictionStore): The store of the run, or None if the predictions are kept in memory.
+        cache_table (EmbeddingTable): The table of the embedding cache, or None.
+        cache_buffer (list): The (keys, vectors, top_ids) of every batch not yet in the cache. It is emptied.
+    """
+    if store is not None and store.embeddings is not None:
+        store.flush()
+    if cache_table is not None and cache_buffer:
+        keys, vectors, top_ids = (np.concatenate(arrays) for arrays in zip(*cache_buffer))
+        cache_table.write(keys, vectors, top_ids)
+        cache_buffer.clear()
+
+
 def extract_Roberta_embeddings_dataframe(
         inputs_tokenized= None,
         model_size: str = 'base',
         batch_size: int = 8,
-        model_name: str = 'PlanTL-GOB-ES/roberta-large-bne'
+        model_name: str = 'PlanTL-GOB-ES/roberta-large-bne',
+        tokenizer_name: str = None,
+        embedding: str = 'logits',
+        layers=-1,
+        layer_pooling: str = 'mean',
+        mask_only: bool = True,
+        decode_phrases: bool = True,
+        embedding_cache=None,
+        prediction_dir: str = None,
+        embedding_dtype: str = 'float32',
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        max_tokens: int = None,
+        precision: str = 'float32',
+        quantized_cache_dir: str = None
         ) -> pd.DataFrame:
     """
     Extracts RoBERTa embeddings for masked tokens in the context of phrases from a JSON file.
     
     Args:
-        inputs_tokenized (dict): toeknized imputs for beto.
+        inputs_tokenized (dict): toeknized imputs for beto, or the TokenShard of tokenize_prompts_Roberta.
         model_name (str): Name of the RoBERTa model to use. Default: 'PlanTL-GOB-ES/roberta-large-bne'
-        tokenizer_name (str): Name of the RoBERTa tokenizer to use. Default: 'PlanTL-GOB-ES/roberta-large-bne'.
+        tokenizer_name (str): Name of the RoBERTa tokenizer to use, used when model_name has no tokenizer files. Default: None (PlanTL-GOB-ES/roberta-{model_size}-bne).
         prompt_type (str): The type of prompt that the tokenize_prompts_beto processes. Default: "prompt_1".
         full_extraction: (bool): This parameter returns a full list for all the prompts in the json file.
         batch_size (int): Batch size for processing.
+        embedding (str): One of EMBEDDING_MODES. 'logits' stores the vocabulary scores of the LM head at the mask,
+            'hidden' the encoder hidden state at the mask as a float32 array, many times smaller. The predicted
+            tokens come from the LM head in both modes. Default: 'logits'.
+        layers (int or list): The hidden layers of the 'hidden' mode, see pool_hidden_states. Default: -1 (last layer).
+        layer_pooling (str): How several layers are combined, 'mean' or 'concat'. Default: 'mean'.
+        mask_only (bool): Run the encoder and apply the LM head only to the mask positions, instead of
+            projecting every token of the batch to the vocabulary. Same predictions. Default: True.
+        decode_phrases (bool): Decode the token ids of every prompt into the predicted_phrase column. Without it
+            the column is left out, and can be rebuilt from the prompt texts with attach_provenance. Default: True.
+        embedding_cache (EmbeddingCache or str): The cache, or its directory, of the predictions of previous runs.
+            Only the prompts not cached for the same model weights and embedding configuration are inferred,
+            once per distinct prompt, and the model is not even loaded if all of them are. Default: None.
+        prediction_dir (str): If given, the predictions are written to a PredictionStore in this directory as the
+            batches are inferred, instead of being kept in memory, and the opened store is returned. With
+            decode_phrases, the store keeps the decoded prompts to rebuild the predicted_phrase. Default: None.
+        embedding_dtype (str): The embedding type of the PredictionStore, 'float32' or 'float16'. Default: 'float32'.
+        chunk_size (int): Number of masks written to the PredictionStore and the embedding cache at a time. Default: DEFAULT_CHUNK_SIZE.
+        max_tokens (int): If given, the prompts are grouped by length and every batch is packed up to this number
+            of padded tokens instead of taking batch_size prompts, see TokenBudgetSampler. In both cases a batch
+            that runs out of memory is split and the next batches shrink. Default: None.
+        precision (str): One of PRECISIONS. 'int8' runs the model on the cpu with its Linear layers quantized
+            to int8, see quantize_model, faster on CPU nodes with slightly different predictions. The
+            embedding cache keeps the predictions of every precision apart. Default: 'float32'.
+        quantized_cache_dir (str): Directory where the int8 models are saved, see load_model. Default: None.
         
     Returns:
-        pd.DataFrame: A DataFrame containing predicted tokens, mask predictions, and mask embeddings.
+        pd.DataFrame: A DataFrame containing predicted tokens, mask predictions, mask embeddings
+        and the index of the input prompt of every mask, or the PredictionStore if prediction_dir is given.
     """
     if inputs_tokenized is None:
         raise ValueError("inputs_tokenized is required")
 
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    if embedding not in EMBEDDING_MODES:
+        raise ValueError(f"Unknown embedding {embedding}. Use one of {EMBEDDING_MODES}")
+
+    if embedding_dtype not in EMBEDDING_DTYPES:
+        raise ValueError(f"Unknown embedding_dtype {embedding_dtype}. Use one of {EMBEDDING_DTYPES}")
+
+    if precision not in PRECISIONS:
+        raise ValueError(f"Unknown precision {precision}. Use one of {PRECISIONS}")
+
+    device = model_device(precision)
     
-    tokenizer = AutoTokenizer.from_pretrained(f'PlanTL-GOB-ES/roberta-{model_size}-bne')
-    model = RobertaForMaskedLM.from_pretrained(model_name).to(device)
+    # Shared with the tokenization stage and the other pipeline runs of the process
+    tokenizer = load_tokenizer(model_name, tokenizer_name or f'PlanTL-GOB-ES/roberta-{model_size}-bne')
 
     inputs = inputs_tokenized
     
-    predicted_tokens_list = []
-    mask_predictions = []
-    mask_embeddings = []
-    
-    dataset = MeditationsDataSet(inputs)
-    loader = torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=True)
-    
-    # Use tqdm instead of tqdm_notebook for progress tracking
-    loop = tqdm(loader, leave=True)
-
-    for batch in loop:
-        model.eval()
-        input_ids = batch['input_ids'].to(device)
-        attention_mask = batch['attention_mask'].to(device)
-        with torch.no_grad():  # No need for gradient during evaluation
-            outputs = model(input_ids, attention_mask = attention_mask)[0]
-
-        # Assuming you want the last layer's hidden state
-        hidden_states = outputs
-
-        for batch_idx in range(len(outputs)):
-            input_ids_batch = input_ids[batch_idx]  # Get input_ids for the current batch
-            mask_positions = torch.where(input_ids_batch == tokenizer.mask_token_id)[0]  # Find mask positions
-            
-            for mask_idx in mask_positions:
-                idxs = torch.argsort(outputs[batch_idx, mask_idx], descending=True)
-                masked_embedding = hidden_states[batch_idx, mask_idx].tolist()
-                predicted_token_ids = idxs[:10]
-                predicted_tokens = tokenizer.decode(predicted_token_ids).split()
-                
-                mask_prediction = tokenizer.decode(input_ids_batch.tolist(), skip_special_tokens=True)  # Original input phrase
-                mask_prediction = mask_prediction.replace(tokenizer.mask_token, predicted_tokens[0])  # Replace [MASK] with predicted token
-                
-                predicted_tokens_list.append(predicted_tokens )
-                mask_predictions.append(mask_prediction)
-                mask_embeddings.append(masked_embedding)
-
-    df = pd.DataFrame({
-            'predicted_token': predicted_tokens_list,
-            'predicted_phrase': mask_predictions,
-            'mask_embedding': mask_embeddings
-            })
+    if isinstance(inputs, TokenShard):
+        dataset = TokenShardDataSet(inputs)
+    else:
+        dataset = MeditationsDataSet(inputs)
+
+    # One row per mask, in the order of the prompts. The width of the embeddings is known
+    # after the first batch or the cached rows.
+    mask_counts = count_masks(dataset, tokenizer.mask_token_id)
+    mask_offsets = np.concatenate([[0], np.cumsum(mask_counts)])
+    mask_total = int(mask_offsets[-1])
+    mask_embeddings = top_ids = None
+    pending = np.arange(len(dataset))
+
+    store = None
+    if prediction_dir is not None:
+        store = PredictionStore(prediction_dir, partial(predicted_tokens_of, tokenizer))
+
+    cache_table = None
+    if embedding_cache is not None:
+        embedding_cache, cache_table = embedding_cache_table(embedding_cache, model_name, device, embedding, layers, layer_pooling, precision)
+        keys = mask_keys((prompt_token_ids(dataset[index]) for index in range(len(dataset))), mask_counts)
+        # A prompt repeated in the run is inferred once and copied, as a cache hit is read once
+        _, first_rows, inverse = np.unique(keys, return_index=True, return_inverse=True)
+        source_rows = first_rows[inverse]
+        repeated_rows = np.flatnonzero(source_rows != np.arange(mask_total))
+        slots = cache_table.lookup(keys)
+        cached = slots >= 0
+        cached_rows = np.flatnonzero(cached)
+        for chunk_start in range(0, len(cached_rows), chunk_size):
+            chunk = cached_rows[chunk_start:chunk_start + chunk_size]
+            cached_vectors, cached_top_ids = cache_table.read(slots[chunk])
+            if mask_embeddings is None:
+                mask_embeddings, top_ids = allocate_predictions(mask_counts, mask_offsets, cached_vectors.shape[1], store, embedding_dtype)
+            mask_embeddings[chunk] = cached_vectors
+            top_ids[chunk] = cached_top_ids
+        # A prompt runs again if any of its masks is missing
+        missing = ~cached
+        missing[repeated_rows] = False
+        pending = np.unique(np.repeat(np.arange(len(dataset)), mask_counts)[missing])
+        print(f'{int(cached.sum())} of {mask_total} mask predictions read from the embedding cache')
+
+    if len(pending):
+        model = load_model(model_name, device, precision, quantized_cache_dir)
+
+        # The batches can come in any order, every row is traced back to its prompt
+        sampler = TokenBudgetSampler(prompt_lengths(dataset)[pending], batch_size, max_tokens)
+        stats = InferenceStats()
+        # Rows written since the last flush, and the new predictions not yet added to the cache
+        unflushed = 0
+        cache_buffer = []
+        
+        # Use tqdm instead of tqdm_notebook for progress tracking
+        loop = tqdm(sampler, leave=True)
+
+        for batch_positions in loop:
+            batch_prompts = pending[batch_positions]
+            rows, vectors, batch_top_ids = infer_adaptive(
+                model, [dataset[index] for index in batch_prompts.tolist()], tokenizer.pad_token_id, tokenizer.mask_token_id,
+                device, embedding, layers, layer_pooling, mask_only, sampler, stats
+            )
+
+            # Row of every mask: the first row of its prompt plus its position among the masks of the prompt
+            positions = mask_offsets[batch_prompts[rows]] + np.arange(len(rows)) - np.searchsorted(rows, rows)
+
+            if mask_embeddings is None:
+                mask_embeddings, top_ids = allocate_predictions(mask_counts, mask_offsets, vectors.shape[1], store, embedding_dtype)
+            mask_embeddings[positions] = vectors
+            top_ids[positions] = batch_top_ids
+
+            unflushed += len(positions)
+            if cache_table is not None:
+                # The cache gets the float32 vectors, whatever the embedding_dtype of the store
+                new = ~cached[positions]
+                cache_buffer.append((keys[positions[new]], vectors[new], batch_top_ids[new]))
+            if unflushed >= chunk_size:
+                flush_predictions(store, cache_table, cache_buffer)
+                unflushed = 0
+
+        flush_predictions(store, cache_table, cache_buffer)
+        print(stats.report())
+        if cache_table is not None:
+            cache_table.flush()
+            embedding_cache.evict(keep=cache_table)
+
+    if mask_embeddings is None:
+        mask_embeddings, top_ids = allocate_predictions(mask_counts, mask_offsets, 0, store, embedding_dtype)
+
+    if cache_table is not None:
+        for chunk_start in range(0, len(repeated_rows), chunk_size):
+            chunk = repeated_rows[chunk_start:chunk_start + chunk_size]
+            mask_embeddings[chunk] = mask_embeddings[source_rows[chunk]]
+            top_ids[chunk] = top_ids[source_rows[chunk]]
+
+    if store is not None:
+        store = store.close()
+        if decode_phrases:
+            # Decoded as the phrases of the DataFrame, the store replaces their mask on demand
+            prompts = []
+            for chunk_start in range(0, len(dataset), DECODE_CHUNK_SIZE):
+                prompts.extend(tokenizer.batch_decode([
+                    prompt_token_ids(dataset[index]).tolist()
+                    for index in range(chunk_start, min(chunk_start + DECODE_CHUNK_SIZE, len(dataset)))
+                ], skip_special_tokens=True))
+            store.save_prompts(prompts, tokenizer=tokenizer)
+        return store
+
+    df = predictions_dataframe(tokenizer, mask_embeddings, top_ids, np.repeat(np.arange(len(dataset)), mask_counts))
+
+    if decode_phrases:
+        # The phrase of a prompt is decoded once, whatever its number of masks
+        phrase_prompts = np.flatnonzero(mask_counts)
+        phrases = []
+        for chunk_start in range(0, len(phrase_prompts), DECODE_CHUNK_SIZE):
+            chunk = phrase_prompts[chunk_start:chunk_start + DECODE_CHUNK_SIZE].tolist()
+            phrases.extend(tokenizer.batch_decode(
+                [prompt_token_ids(dataset[index]).tolist() for index in chunk],
+                skip_special_tokens=True  # Original input phrases
+            ))
+        phrase_of_mask = np.repeat(np.arange(len(phrase_prompts)), mask_counts[phrase_prompts])
+        df.insert(1, 'predicted_phrase', [
+            phrases[phrase].replace(tokenizer.mask_token, predicted[0])  # Replace the mask with the predicted token
+            for phrase, predicted in zip(phrase_of_mask.tolist(), df['predicted_token'])
+        ])
 
     return df
 
 
+def extract_multi_model_predictions(
+        inputs_tokenized=None,
+        model_names: dict = None,
+        model_size: str = 'base',
+        tokenizer_name: str = None,
+        batch_size: int = 8,
+        embedding: str = 'logits',
+        layers=-1,
+        layer_pooling: str = 'mean',
+        mask_only: bool = True,
+        prediction_dirs: dict = None,
+        embedding_dtype: str = 'float32',
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        max_tokens: int = None,
+        stats: dict = None,
+        precision: str = 'float32',
+        quantized_cache_dir: str = None
+        ) -> dict:
+    """
+    Runs several checkpoints with the same tokenizer over the same batches. Every batch is
+    collated, moved to the device and its masks found once, then inferred by all the models, and
+    the rows of its masks are computed once for the predictions of all of them. All the models
+    are loaded at the same time.
+
+    Args:
+        inputs_tokenized (dict): The tokenized prompts, or the TokenShard of tokenize_prompts_Roberta.
+        model_names (dict): The model directory or hub name of every model name.
+        model_size, tokenizer_name, batch_size, embedding, layers, layer_pooling, mask_only, embedding_dtype, chunk_size, max_tokens:
+            See extract_Roberta_embeddings_dataframe.
+        prediction_dirs (dict): If given, the predictions of every model name are written to a PredictionStore
+            in its directory, see the prediction_dir of extract_Roberta_embeddings_dataframe. Default: None.
+        stats (dict): If given, it gets the InferenceStats of every model name. Default: None.
+        precision, quantized_cache_dir: See extract_Roberta_embeddings_dataframe.
+
+    Returns:
+        dict: For every model name, the DataFrame of extract_Roberta_embeddings_dataframe without the
+        predicted_phrase column, or its opened PredictionStore if prediction_dirs is given.
+    """
+    if inputs_tokenized is None:
+        raise ValueError("inputs_tokenized is required")
+
+    if not model_names:
+        raise ValueError("model_names is required")
+
+    if embedding not in EMBEDDING_MODES:
+        raise ValueError(f"Unknown embedding {embedding}. Use one of {EMBEDDING_MODES}")
+
+    if embedding_dtype not in EMBEDDING_DTYPES:
+        raise ValueError(f"Unknown embedding_dtype {embedding_dtype}. Use one of {EMBEDDING_DTYPES}")
+
+    if precision not in PRECISIONS:
+        raise ValueError(f"Unknown precision {precision}. Use one of {PRECISIONS}")
+
+    device = model_device(precision)
+
+    default_tokenizer = tokenizer_name or f'PlanTL-GOB-ES/roberta-{model_size}-bne'
+    tokenizers = {name: load_tokenizer(model_name, default_tokenizer) for name, model_name in model_names.items()}
+    if len({tokenizer_fingerprint(tokenizer) for tokenizer in tokenizers.values()}) > 1:
+        raise ValueError("The models do not share the same tokenizer, their batches cannot be shared")
+    tokenizer = next(iter(tokenizers.values()))
+
+    if isinstance(inputs_tokenized, TokenShard):
+        dataset = TokenShardDataSet(inputs_tokenized)
+    else:
+        dataset = MeditationsDataSet(inputs_tokenized)
+
+    mask_counts = count_masks(dataset, tokenizer.mask_token_id)
+    mask_offsets = np.concatenate([[0], np.cumsum(mask_counts)])
+    pending = np.arange(len(dataset))
+
+    stores = {name: None for name in model_names}
+    if prediction_dirs is not None:
+        stores = {name: PredictionStore(prediction_dirs[name], partial(predicted_tokens_of, tokenizer)) for name in model_names}
+
+    models = {name: load_model(model_name, device, precision, quantized_cache_dir) for name, model_name in model_names.items()}
+    predictions = {name: None for name in model_names}
+    if stats is None:
+        stats = {}
+    stats.update({name: InferenceStats() for name in model_names})
+
+    sampler = TokenBudgetSampler(prompt_lengths(dataset)[pending], batch_size, max_tokens)
+    unflushed = 0
+    start = time.perf_counter()
+
+    for batch_positions in tqdm(sampler, leave=True):
+        batch_prompts = pending[batch_positions]
+        rows, outputs = infer_models_adaptive(
+            models, [dataset[index] for index in batch_prompts.tolist()], tokenizer.pad_token_id, tokenizer.mask_token_id,
+            device, embedding, layers, layer_pooling, mask_only, sampler, stats
+        )
+
+        # The same rows for all the models, see extract_Roberta_embeddings_dataframe
+        positions = mask_offsets[batch_prompts[rows]] + np.arange(len(rows)) - np.searchsorted(rows, rows)
+
+        for name, (vectors, batch_top_ids) in outputs.items():
+            if predictions[name] is None:
+                predictions[name] = allocate_predictions(mask_counts, mask_offsets, vectors.shape[1], stores[name], embedding_dtype)
+            mask_embeddings, top_ids = predictions[name]
+            mask_embeddings[positions] = vectors
+            top_ids[positions] = batch_top_ids
+
+        unflushed += len(positions)
+        if unflushed >= chunk_size:
+            for store in stores.values():
+                flush_predictions(store, None, [])
+            unflushed = 0
+
+    for name in model_names:
+        print(f'{name}: {1000 * stats[name].seconds / max(stats[name].batches, 1):.1f} ms per batch, ' + stats[name].report())
+    shared_seconds = time.perf_counter() - start - sum(stats[name].seconds for name in model_names)
+    print(f'Collation, transfer, mask lookup and writes shared by the {len(models)} models: {shared_seconds:.1f} s')
+
+    results = {}
+    for name in model_names:
+        if predictions[name] is None:
+            predictions[name] = allocate_predictions(mask_counts, mask_offsets, 0, stores[name], embedding_dtype)
+        if stores[name] is not None:
+            flush_predictions(stores[name], None, [])
+            results[name] = stores[name].close()
+        else:
+            mask_embeddings, top_ids = predictions[name]
+            results[name] = predictions_dataframe(tokenizer, mask_embeddings, top_ids, np.repeat(np.arange(len(dataset)), mask_counts))
+    return results
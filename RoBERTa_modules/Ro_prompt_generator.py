@@ -1,7 +1,243 @@
 import regex as re
 import json
 import lxml.etree as ET
-from Ro_auxiliary_function_XML_process import entity_sort_dictionary, counter
+from itertools import islice
+from Ro_auxiliary_function_XML_process import entity_sort_dictionary, counter, PhraseNormalizer, PhraseRecordBuilder, phrase_entities, entity_spans
+from Ro_prompt_templates import compile_templates, entity_pairs
+
+
+MODEL_FAMILY = 'roberta'
+
+TEI_NAMESPACE = {'tei': 'http://www.tei-c.org/ns/1.0'}
+
+PARRAGRAPH_OBJETIVES = ['{http://www.tei-c.org/ns/1.0}pb', '{http://www.tei-c.org/ns/1.0}p']
+
+ENTITY_OBJETIVES = [
+    "{http://www.tei-c.org/ns/1.0}persName",
+    "{http://www.tei-c.org/ns/1.0}orgName",
+    "{http://www.tei-c.org/ns/1.0}placeName",
+    "{http://www.tei-c.org/ns/1.0}date",
+    "{http://www.tei-c.org/ns/1.0}rs",
+    "{http://www.tei-c.org/ns/1.0}fw"  # Include fw element
+]
+
+
+def paragraph_text_extraction(element, entity_objetives: list = ENTITY_OBJETIVES, mark_types: list = None) -> str:
+    '''
+    DESCRIPTION:
+    Builds the text of a paragraph element, marking the entities
+    found inside it between $ symbols and adding the tail of the paragraph.
+
+    INPUTS:
+        element: the lxml paragraph element. Its text must not be None.
+
+        entity_objetives: the tag of the entities to mark.
+
+        mark_types: optional list where the type of every $ of the paragraph text is
+        appended: the tag name (persName, placeName, ...) of the entity it marks, or
+        None for a $ of the text itself.
+
+    OUTPUTS: the paragraph text with the entities marked.
+    '''
+    # Include all text content within the <p> element, with the entity of every piece
+    pieces = [(element.text, None)]
+    for entity in element:
+        if entity.tag in entity_objetives and entity.text is not None:
+            # Include entity tags as well
+            pieces.append((' $' + re.sub(r'\s+', ' ', entity.text) + '$ ', ET.QName(entity).localname))
+        if entity.tail is not None:
+            # Include tail text of entities
+            pieces.append((entity.tail, None))
+    pieces.append((element.tail or '', None))
+
+    if mark_types is not None:
+        for piece, entity_type in pieces:
+            marks = [None] * piece.count('$')
+            if entity_type is not None:
+                marks[0] = marks[-1] = entity_type
+            mark_types.extend(marks)
+
+    return ''.join(piece for piece, _ in pieces)
+
+
+def _release_element(element):
+    '''Clears a finished element and drops the already processed siblings before it.'''
+    element.clear()
+    parent = element.getparent()
+    if parent is not None:
+        while element.getprevious() is not None:
+            del parent[0]
+
+
+def iter_paragraphs(
+    xml_path: str,
+    ns: dict = TEI_NAMESPACE,
+    parragraph_objetives: list = PARRAGRAPH_OBJETIVES,
+    entity_objetives: list = ENTITY_OBJETIVES,
+    with_div: bool = False,
+    mark_types: list = None,
+    tree_order: bool = False
+):
+    '''
+    DESCRIPTION:
+    Streams the paragraphs of a XML-TEI file with lxml iterparse.
+    Only the paragraphs that are direct children of a tei:div are yielded,
+    as in phrase_extraction. Every element is cleared once it has been
+    processed, so the memory used does not grow with the size of the file.
+
+    INPUTS:
+        xml_path: The XML directory path.
+
+        ns: name space dictionary. default: {'tei': 'http://www.tei-c.org/ns/1.0'}
+
+        parragraph_objetives: the paragraph tags to look for.
+
+        entity_objetives: The tag of the entities to mark.
+
+        with_div: if True yields (div number, paragraph text) tuples, the divs being
+        numbered by order of appearance in the file. default: False
+
+        mark_types: optional list where the type of every $ of a paragraph, see
+        paragraph_text_extraction, is appended as the paragraph is yielded. default: None
+
+        tree_order: if True the paragraphs come in the order of the tree parse of
+        phrase_extraction: div by div, a div being followed by the divs nested inside it.
+        The paragraphs of the nested divs are then held in memory until their outermost
+        div is closed, which for a file wrapped in a single div is the whole file.
+        default: False (document order, the memory does not grow with the file)
+
+    OUTPUTS: generator of paragraph texts with the entities marked between $.
+    '''
+    div_tag = '{%s}div' % ns['tei']
+    pending = None
+    pending_div = None
+    paragraph_depth = 0
+    div_count = 0
+    div_stack = []
+    # With tree_order, the paragraphs of nested divs wait until their outermost div is closed
+    nested_paragraphs = {}
+
+    def emit(div, paragraph_text, types):
+        if mark_types is not None:
+            mark_types.extend(types)
+        return (div, paragraph_text) if with_div else paragraph_text
+
+    def flush_nested():
+        for div in sorted(nested_paragraphs):
+            for paragraph_text, types in nested_paragraphs[div]:
+                yield emit(div, paragraph_text, types)
+        nested_paragraphs.clear()
+
+    for event, element in ET.iterparse(xml_path, events=('start', 'end')):
+        # The tail of a paragraph is only complete once the parser reaches the next tag
+        if pending is not None:
+            types = []
+            paragraph_text = paragraph_text_extraction(pending, entity_objetives, types)
+            if not tree_order or pending_div == div_stack[0]:
+                yield emit(pending_div, paragraph_text, types)
+            else:
+                nested_paragraphs.setdefault(pending_div, []).append((paragraph_text, types))
+            _release_element(pending)
+            pending = None
+
+        if element.tag == div_tag and not paragraph_depth:
+            if event == 'start':
+                div_count += 1
+                div_stack.append(div_count)
+            else:
+                div_stack.pop()
+                if not div_stack:
+                    yield from flush_nested()
+
+        if element.tag in parragraph_objetives:
+            if event == 'start':
+                paragraph_depth += 1
+                continue
+            paragraph_depth -= 1
+            if paragraph_depth:
+                # Nested inside another paragraph, its tail belongs to the parent
+                continue
+            parent = element.getparent()
+            if parent is not None and parent.tag == div_tag and element.text is not None:
+                pending = element
+                pending_div = div_stack[-1]
+            else:
+                _release_element(element)
+
+        elif event == 'end' and not paragraph_depth:
+            _release_element(element)
+
+    if pending is not None:
+        types = []
+        paragraph_text = paragraph_text_extraction(pending, entity_objetives, types)
+        nested_paragraphs.setdefault(pending_div, []).append((paragraph_text, types))
+    yield from flush_nested()
+
+
+def iter_phrases(
+    xml_path: str,
+    ns: dict = TEI_NAMESPACE,
+    parragraph_objetives: list = PARRAGRAPH_OBJETIVES,
+    entity_objetives: list = ENTITY_OBJETIVES,
+    tree_order: bool = False
+):
+    '''
+    DESCRIPTION:
+    Streaming version of phrase_extraction. The paragraphs are read one
+    at a time with iter_paragraphs and normalized with PhraseNormalizer,
+    so the phrases are yielded as soon as their closing period is found.
+    The phrases are the same as the ones of phrase_extraction, except for
+    the divs with paragraphs after a nested div unless tree_order is True.
+
+    INPUTS:
+        xml_path: The XML directory path.
+
+        ns, parragraph_objetives, entity_objetives, tree_order: see iter_paragraphs.
+
+    OUTPUTS: generator of phrases, split by '.' as in phrase_extraction.
+    '''
+    normalizer = PhraseNormalizer()
+
+    for paragraph_text in iter_paragraphs(
+        xml_path, ns, parragraph_objetives, entity_objetives, tree_order=tree_order
+    ):
+        yield from normalizer.feed(paragraph_text)
+
+    yield from normalizer.close()
+
+
+def iter_phrase_records(
+    xml_path: str,
+    ns: dict = TEI_NAMESPACE,
+    parragraph_objetives: list = PARRAGRAPH_OBJETIVES,
+    entity_objetives: list = ENTITY_OBJETIVES,
+    tree_order: bool = False
+):
+    '''
+    DESCRIPTION:
+    Streaming version of phrase_extraction returning PhraseRecord objects
+    instead of phrases with the entities marked between $.
+
+    INPUTS:
+        xml_path: The XML directory path.
+
+        ns, parragraph_objetives, entity_objetives, tree_order: see iter_paragraphs.
+
+    OUTPUTS: generator of PhraseRecord objects, with the entity types and the
+    file, div and position of every phrase.
+    '''
+    normalizer = PhraseNormalizer(paragraphs=True)
+    builder = PhraseRecordBuilder(xml_path)
+    mark_types = []
+
+    for div, paragraph_text in iter_paragraphs(
+        xml_path, ns, parragraph_objetives, entity_objetives, with_div=True, mark_types=mark_types, tree_order=tree_order
+    ):
+        builder.add_paragraph(paragraph_text, mark_types)
+        mark_types.clear()
+        yield from builder.build(normalizer.feed(paragraph_text, div))
+
+    yield from builder.build(normalizer.close())
 
 
 def phrase_extraction(
@@ -10,7 +246,10 @@ def phrase_extraction(
     ns: str = None,
     parragraph_objetives: str = None,
     entity_objetives: str = None,
-    count: bool = False
+    count: bool = False,
+    streaming: bool = False,
+    records: bool = False,
+    tree_order: bool = False
 ) -> dict:
     '''
     DESCRIPTION: 
@@ -45,54 +284,59 @@ def phrase_extraction(
         optional parameter that returns a numerical dictionary for the keys.
         default: False
 
+        streaming:
+        if True the file is read with iter_phrases instead of loading the
+        full tree in memory. Recommended for large XML files. The paragraphs
+        are read in document order: a div with paragraphs after a nested div
+        can split other phrases than the tree parse.
+        default: False
+
+        records:
+        if True the phrases are returned as PhraseRecord objects, with the
+        entities and their types already located. The file is streamed.
+        default: False
+
+        tree_order:
+        if True the streaming and records modes read the paragraphs in the order
+        of the tree parse, holding the paragraphs of nested divs in memory until
+        their outermost div is closed. See iter_paragraphs.
+        default: False
+
     OUTPUTS: dictionary with keys for the number of entities and the list of phrases attached.
     '''
 
-    tree = ET.parse(xml_path)
-    root = tree.getroot()
+    if records:
+        result_list = iter_phrase_records(xml_path, tree_order=tree_order)
+        if not return_dict:
+            result_list = list(result_list)
+            return (counter(entity_sort_dictionary(result_list)), result_list) if count else result_list
+    elif streaming:
+        result_list = iter_phrases(xml_path, tree_order=tree_order)
+        if not return_dict:
+            result_list = list(result_list)
+    else:
+        tree = ET.parse(xml_path)
+        root = tree.getroot()
 
-    ns = {'tei': 'http://www.tei-c.org/ns/1.0'}
+        ns = TEI_NAMESPACE
 
-    parragraph_objetives = ['{http://www.tei-c.org/ns/1.0}pb', '{http://www.tei-c.org/ns/1.0}p']
+        parragraph_objetives = PARRAGRAPH_OBJETIVES
 
-    entity_objetives = [
-        "{http://www.tei-c.org/ns/1.0}persName",
-        "{http://www.tei-c.org/ns/1.0}orgName",
-        "{http://www.tei-c.org/ns/1.0}placeName",
-        "{http://www.tei-c.org/ns/1.0}date",
-        "{http://www.tei-c.org/ns/1.0}rs",
-        "{http://www.tei-c.org/ns/1.0}fw"  # Include fw element
-    ]
-
-    result = ''
-
-    for div in root.xpath('//tei:div', namespaces=ns):
-        for element in div:
-            if element.tag in parragraph_objetives and element.text is not None:
-                # Include all text content within the <p> element
-                paragraph_text = element.text
-                for entity in element:
-                    if entity.tag in entity_objetives and entity.text is not None:
-                        # Include entity tags as well
-                        paragraph_text += ' $' + re.sub(r'\s+', ' ', entity.text) + '$ '
-                    if entity.tail is not None:
-                        # Include tail text of entities
-                        paragraph_text += entity.tail
-                paragraph_text += (element.tail or '')
-
-                result += paragraph_text  # Add the entire text
-
-    result = ' '.join(result.split())
-    result = re.sub(r'\s+\-', '', result)
-    result = re.sub(r'[\[\]\(\)]', '', result)
-    result = re.sub(r'\:.', ': ', result)
-    result = re.sub(r'\ , ', ', ', result)
-    result = re.sub(r'\* * * ', '', result)
-
-    result_list = re.sub(r'\[\S+\]', '', result).split('.')
+        entity_objetives = ENTITY_OBJETIVES
+
+        normalizer = PhraseNormalizer()
+        result_list = []
+
+        for div in root.xpath('//tei:div', namespaces=ns):
+            for element in div:
+                if element.tag in parragraph_objetives and element.text is not None:
+                    result_list.extend(normalizer.feed(paragraph_text_extraction(element, entity_objetives)))
+
+        result_list.extend(normalizer.close())
 
     if count and return_dict:
-        return entity_sort_dictionary(result_list), counter(entity_sort_dictionary(result_list))
+        sorted_phrases = entity_sort_dictionary(result_list)
+        return sorted_phrases, counter(sorted_phrases)
     elif not count and return_dict:
         return entity_sort_dictionary(result_list)
     elif count and not return_dict:
@@ -104,12 +348,144 @@ def phrase_extraction(
 
 
 
+def iter_prompts(
+        phrase_input: dict = None,
+        full_extraction: bool = False,
+        entity_number: int = 2,
+        templates: dict = None,
+        pair_policy: str = 'baseline',
+        pair_window: int = None,
+        max_prompts: int = None,
+        max_prompts_per_document: int = None,
+        with_provenance: bool = False,
+        template_set: str = 'baseline'
+        ):
+    '''
+    DESCRIPTION:
+
+    Lazy version of prompt_generator. It yields the prompts one by one, so
+    the next stage can consume them without holding the full prompt dictionary.
+
+    Args::
+
+    phrase_input: The input dictionary containing phrases for each entity number.
+
+    full_extraction: A boolean flag indicating whether full extraction should be done.
+
+    entity_number: The number of entities key objective for the prompting when full_extraction is False.
+
+    templates: The templates returned by compile_templates. Default: the template_set compiled for MODEL_FAMILY.
+
+    pair_policy: How the entities of a phrase are combined: 'baseline', 'all', 'adjacent' or 'window'.
+    The default 'baseline' gives the pairs of the original prompts. See entity_pairs.
+
+    pair_window: The maximum number of words between two entities for the 'window' policy.
+
+    max_prompts: Maximum number of prompts of the run. Default: None (no limit).
+
+    max_prompts_per_document: Maximum number of prompts of every source file. Only PhraseRecord
+    phrases know their source, plain phrases count as a single document. Default: None (no limit).
+
+    with_provenance: If True every tuple also carries the (source, div, sentence) of its
+    phrase. They are None for plain phrases. Default: False.
+
+    template_set: 'baseline' for the original prompts, 'uniform' for the same templates, all
+    ending with a period, for any number of entities, or 'legacy' for the original prompts with
+    the repetitions of BERT prompt_0, prompt_1 and prompt_2. Ignored if templates is given. Default: 'baseline'.
+
+    Returns:
+
+    Generator of (template_id, entity_pair, text) tuples, where template_id is the
+    key of prompt_generator, for example 'prompt_1_ent_2'.
+    '''
+    if phrase_input is None:
+        raise ValueError('The output dictionary from phrase_extraction function is required')
+
+    if templates is None:
+        templates = compile_templates(MODEL_FAMILY, template_set, full_extraction)
+
+    entity_counts = phrase_input.keys() if full_extraction else [entity_number]
+    generated = 0
+    document_prompts = {}
+
+    for entity_count in entity_counts:
+        if entity_count < 1:
+            continue
+
+        suffix = 'unique' if entity_count == 1 else f'ent_{entity_count}'
+        group = [
+            (template_id, f'{template_id}_{suffix}', variants)
+            for template_id, variants in templates.get(entity_count, templates.get('default', {})).items()
+        ]
+        if not group:
+            continue
+
+        for phrase in phrase_input.get(entity_count, []):
+            source = getattr(phrase, 'source', None)
+            limits = []
+            if max_prompts is not None:
+                limits.append(max_prompts - generated)
+            if max_prompts_per_document is not None:
+                limits.append(max_prompts_per_document - document_prompts.get(source, 0))
+            remaining = min(limits) if limits else None
+
+            if remaining is not None and remaining <= 0:
+                if max_prompts is not None and generated >= max_prompts:
+                    print(f'Prompt budget of {max_prompts} prompts reached')
+                    return
+                continue
+
+            entity_names, cleaned_phrase = phrase_entities(phrase)
+            spans = entity_spans(phrase)
+            if entity_count == 1:
+                # As the original prompts, join the names in case of $ symbols in the text
+                entity_names = [''.join(entity_names)]
+
+            def phrase_pairs(template_id=None):
+                # The phrases are paired by the number of entities of their key, as the original prompts
+                pairs = entity_pairs(
+                    entity_count,
+                    pair_policy,
+                    spans=spans,
+                    text=cleaned_phrase,
+                    pair_window=pair_window,
+                    template_id=template_id
+                )
+                # Every pair gives at least one prompt, so no more pairs than the budget are needed
+                return [tuple(entity_names[position] for position in pair) for pair in islice(pairs, remaining)]
+
+            # Only the baseline pairs depend on the template
+            shared_tuples = None if pair_policy == 'baseline' else phrase_pairs()
+
+            prompts = (
+                (key, entity_pair, variant.format(
+                    phrase=cleaned_phrase,
+                    head=entity_pair[0],
+                    tail=entity_pair[-1]
+                ))
+                for template_id, key, variants in group
+                for entity_tuples in [phrase_pairs(template_id) if shared_tuples is None else shared_tuples]
+                for variant in variants
+                for entity_pair in entity_tuples
+            )
+            provenance = (source, getattr(phrase, 'div', None), getattr(phrase, 'sentence', None))
+            for prompt in islice(prompts, remaining):
+                yield prompt + (provenance,) if with_provenance else prompt
+                generated += 1
+                document_prompts[source] = document_prompts.get(source, 0) + 1
+
+
 def prompt_generator(
         
         phrase_input: dict = None,
         full_extraction: bool = False,
         entity_number: int = 2,
         json_file_path_name: str = None,
+        pair_policy: str = 'baseline',
+        pair_window: int = None,
+        max_prompts: int = None,
+        max_prompts_per_document: int = None,
+        template_set: str = 'baseline'
         
         )-> dict:
     '''
@@ -117,6 +493,7 @@ def prompt_generator(
 
     This function takes a dictionary which has the number of entities as keys
     and returns a dictionary of phrases with a PromptORE structure attached.
+    The prompts come from the templates of prompt_templates, see iter_prompts.
     
     Args::
 
@@ -124,328 +501,57 @@ def prompt_generator(
     
     full_extraction: A boolean flag indicating whether full extraction should be done.
 
-    entity_number: The number of entities key objective for the prompting. Now it supports 1, 2, and 3 entities.
+    entity_number: The number of entities key objective for the prompting. The baseline templates
+    support 1, 2 and 3 entities, the uniform ones any number of entities.
     
     json_file_path_name: The name of the path to save the dictionary in a JSON format.
+
+    pair_policy, pair_window, max_prompts, max_prompts_per_document, template_set: See iter_prompts.
+    The defaults give the prompts of the original prompt_generator.
     
     Returns: 
     
     prompt_dict: A dictionary with the prompt structure as keys and the list of phrases with the prompts as values.
     '''
-    if phrase_input is None:
-        raise ValueError('The output dictionary from phrase_extraction function is required')
-    
-    entity_dictionary = phrase_input
-    prompt_dict = {}
-
-    if full_extraction:
-        for k, v in entity_dictionary.items():
-
-            if k == 2:
-                phrases = entity_dictionary.get(k, v)
-
-                prompt_0_list_2_ent = []
-                prompt_1_list_2_ent = []
-                prompt_2_list_2_ent = []
-                prompt_3_list_2_ent = []
-                prompt_4_list_2_ent = []
-                prompt_5_list_2_ent = []
-
-                for phrase in phrases:
-
-                    entities = re.findall(r'\$(.*?)\$', phrase)
-                    entity_names = [entity.strip() for entity in entities]
-                    cleaned_phrase = re.sub(r'\$', '', phrase)
-
-                    prompt_0 = f'<s> {cleaned_phrase} {entity_names[0]} <mask> {entity_names[1]}. </s>'
-                    prompt_1 = f'<s> {cleaned_phrase} La relación entre {entity_names[0]} y {entity_names[1]} es una relación de tipo <mask> </s>'
-                    prompt_2 = f'<s> {cleaned_phrase} La relación entre {entity_names[0]} y {entity_names[1]} es una relación de <mask> </s>'   
-                    prompt_3 = f'<s> {cleaned_phrase} La relación entre {entity_names[0]} y {entity_names[1]} es de naturaleza <mask> </s>'
-                    prompt_4 = f'<s> {cleaned_phrase} La relación entre {entity_names[0]} y {entity_names[1]} es de carácter <mask> </s>'
-                    prompt_5_1 = f'<s> {cleaned_phrase} ¿Cuál es la relación entre {entity_names[0]} y {entity_names[1]}? La relación es el <mask> </s>'
-                    prompt_5_2 = f'<s> {cleaned_phrase} ¿Cuál es la relación entre {entity_names[0]} y {entity_names[1]}? La relación es la <mask> </s>'    
-                    prompt_0_list_2_ent.append(prompt_0)
-                    prompt_1_list_2_ent.append(prompt_1)
-                    prompt_2_list_2_ent.append(prompt_2)
-                    prompt_3_list_2_ent.append(prompt_3)
-                    prompt_4_list_2_ent.append(prompt_4)
-                    prompt_5_list_2_ent.append(prompt_5_1)
-                    prompt_5_list_2_ent.append(prompt_5_2)
-                prompt_dict['prompt_0_ent_2'] = prompt_0_list_2_ent
-                prompt_dict['prompt_1_ent_2'] = prompt_1_list_2_ent 
-                prompt_dict['prompt_2_ent_2'] = prompt_2_list_2_ent
-                prompt_dict['prompt_3_ent_2'] = prompt_3_list_2_ent
-                prompt_dict['prompt_4_ent_2'] = prompt_4_list_2_ent
-                prompt_dict['prompt_5_ent_2'] = prompt_5_list_2_ent
-
-            elif k == 3:
-
-                phrases = entity_dictionary.get(k, v)
-
-                prompt_0_list_3_ent = []
-                prompt_1_list_3_ent  = []
-                prompt_2_list_3_ent = []
-                prompt_3_list_3_ent = []
-                prompt_4_list_3_ent = []
-                prompt_5_list_3_ent = []   
-
-                for phrase in phrases:
-
-                    entities = re.findall(r'\$(.*?)\$', phrase)
-                    entity_names = [entity.strip() for entity in entities]
-                    cleaned_phrase = re.sub(r'\$', '', phrase)
-
-                    prompt_0_0 = f'<s> {cleaned_phrase} {entity_names[0]} <mask> {entity_names[1]}. </s>'
-                    prompt_0_1 = f'<s> {cleaned_phrase} {entity_names[1]} <mask> {entity_names[2]}. </s>'
-                    prompt_0_2 = f'<s> {cleaned_phrase} {entity_names[0]} <mask> {entity_names[2]}. </s>'
-                        
-                    prompt_1_0 = f'<s> {cleaned_phrase} La relación entre {entity_names[0]} y {entity_names[1]} es una relación de tipo <mask>. </s>'
-                    prompt_1_1 = f'<s> {cleaned_phrase} La relación entre {entity_names[1]} y {entity_names[2]} es una relación de tipo <mask>. </s>'
-                    prompt_1_2 = f'<s> {cleaned_phrase} La relación entre {entity_names[2]} y {entity_names[0]} es una relación de tipo <mask>. </s>'
-
-                    prompt_2_0 = f'<s> {cleaned_phrase} La relación entre {entity_names[0]} y {entity_names[1]} es una relación de <mask>. </s>'
-                    prompt_2_1 = f'<s> {cleaned_phrase} La relación entre {entity_names[1]} y {entity_names[2]} es una relación de <mask>. </s>'
-                    prompt_2_2 = f'<s> {cleaned_phrase} La relación entre {entity_names[2]} y {entity_names[0]} es una relación de <mask>. </s>'
-
-                    prompt_3_0 = f'<s> {cleaned_phrase} La relación entre {entity_names[0]} y {entity_names[1]} es de naturaleza <mask>. </s>'
-                    prompt_3_1 = f'<s> {cleaned_phrase} La relación entre {entity_names[1]} y {entity_names[2]} es de naturaleza <mask>. </s>'
-                    prompt_3_2 = f'<s> {cleaned_phrase} La relación entre {entity_names[2]} y {entity_names[0]} es de naturaleza <mask>. </s>'
-
-                    prompt_4_0 = f'<s> {cleaned_phrase} La relación entre {entity_names[0]} y {entity_names[1]} es de carácter <mask>. </s>'
-                    prompt_4_1 = f'<s> {cleaned_phrase} La relación entre {entity_names[1]} y {entity_names[2]} es de carácter <mask>. </s>'
-                    prompt_4_2 = f'<s> {cleaned_phrase} La relación entre {entity_names[2]} y {entity_names[0]} es de carácter <mask>. </s>'
-
-                    prompt_5_1_0 = f'<s> {cleaned_phrase} ¿Cuál es la relación entre {entity_names[0]} y {entity_names[1]}? La relación es el <mask>. </s>'
-                    prompt_5_1_1 = f'<s> {cleaned_phrase} ¿Cuál es la relación entre {entity_names[1]} y {entity_names[2]}? La relación es el <mask>. </s>'
-                    prompt_5_1_2 = f'<s> {cleaned_phrase} ¿Cuál es la relación entre {entity_names[2]} y {entity_names[0]}? La relación es el <mask>. </s>'
-                    prompt_5_2_0 = f'<s> {cleaned_phrase} ¿Cuál es la relación entre {entity_names[0]} y {entity_names[1]}? La relación es la <mask>. </s>'
-                    prompt_5_2_1 = f'<s> {cleaned_phrase} ¿Cuál es la relación entre {entity_names[1]} y {entity_names[2]}? La relación es la <mask>. </s>'
-                    prompt_5_2_2 = f'<s> {cleaned_phrase} ¿Cuál es la relación entre {entity_names[2]} y {entity_names[0]}? La relación es la <mask>. </s>'
-                    
-                    prompt_0_list_3_ent.append(prompt_0_0)
-                    prompt_0_list_3_ent.append(prompt_0_1)
-                    prompt_0_list_3_ent.append(prompt_0_2)
-
-                    prompt_1_list_3_ent.append(prompt_1_0)
-                    prompt_1_list_3_ent.append(prompt_1_1)
-                    prompt_1_list_3_ent.append(prompt_1_2)
-
-                    prompt_2_list_3_ent.append(prompt_2_0)
-                    prompt_2_list_3_ent.append(prompt_2_1)  
-                    prompt_2_list_3_ent.append(prompt_2_2) 
-
-                    prompt_3_list_3_ent.append(prompt_3_0)
-                    prompt_3_list_3_ent.append(prompt_3_1)  
-                    prompt_3_list_3_ent.append(prompt_3_2) 
-
-                    prompt_4_list_3_ent.append(prompt_4_0)
-                    prompt_4_list_3_ent.append(prompt_4_1)  
-                    prompt_4_list_3_ent.append(prompt_4_2) 
-
-                    prompt_5_list_3_ent.append(prompt_5_1_0)
-                    prompt_5_list_3_ent.append(prompt_5_1_1)  
-                    prompt_5_list_3_ent.append(prompt_5_1_2) 
-                    prompt_5_list_3_ent.append(prompt_5_2_0)
-                    prompt_5_list_3_ent.append(prompt_5_2_1)  
-                    prompt_5_list_3_ent.append(prompt_5_2_2) 
-
-                prompt_dict['prompt_0_ent_3'] = prompt_0_list_3_ent
-                prompt_dict['prompt_1_ent_3'] = prompt_1_list_3_ent
-                prompt_dict['prompt_2_ent_3'] = prompt_2_list_3_ent
-                prompt_dict['prompt_3_ent_3'] = prompt_3_list_3_ent
-                prompt_dict['prompt_4_ent_3'] = prompt_4_list_3_ent
-                prompt_dict['prompt_5_ent_3'] = prompt_5_list_3_ent
-
-            elif k == 1:
-
-                phrases = entity_dictionary.get(k, v)
-                    
-                prompt_list_unique = []
-                prompt_list_unique_1 = []
-
-                for phrase in phrases:
-
-                    entities = re.findall(r'\$(.*?)\$', phrase)
-                    entity_names = [str(entity.strip()) for entity in entities]
-                    cleaned_phrase = re.sub(r'\$', '', phrase)
-                        
-
-                        
-                    prompt_0_unique = f"<s> {cleaned_phrase} La relación entre {''.join(entity_names)} y la frase anterior es una relación de <mask>. </s>"
-                    prompt_1_unique= f"<s> {cleaned_phrase} La relación entre {''.join(entity_names)} y la frase anterior es una relación de tipo <mask>. </s>"
-
-                    prompt_list_unique.append(prompt_0_unique)        
-                    prompt_list_unique_1.append(prompt_1_unique)
-
-                prompt_dict['prompt_0_unique'] = prompt_list_unique
-                prompt_dict['prompt_1_unique'] = prompt_list_unique_1
-
-        if json_file_path_name:
-
-            with open(json_file_path_name, 'w', encoding='utf-8') as json_file:
-
-                json.dump(prompt_dict, json_file)
-
-        return prompt_dict
-    
-    else:
-          # If full_extraction is False
-        if entity_number in entity_dictionary and entity_number == 2:
-
-            phrases = entity_dictionary.get(entity_number, [])
-
-
-
-            prompt_0_list_2_ent = []
-            prompt_1_list_2_ent = []
-            prompt_2_list_2_ent = []
-            prompt_3_list_2_ent = []
-            prompt_4_list_2_ent = []
-            prompt_5_list_2_ent = []
-
-            for phrase in phrases:
-
-                entities = re.findall(r'\$(.*?)\$', phrase)
-                entity_names = [entity.strip() for entity in entities]
-                cleaned_phrase = re.sub(r'\$', '', phrase)
-
-                prompt_0 = f'<s> {cleaned_phrase} {entity_names[0]} <mask> {entity_names[1]}. </s>'
-                prompt_1 = f'<s> {cleaned_phrase} La relación entre {entity_names[0]} y {entity_names[1]} es una relación de tipo <mask> </s>'
-
-                prompt_2 = f'<s> {cleaned_phrase} La relación entre {entity_names[0]} y {entity_names[1]} es una relación de <mask> </s>'   
-                prompt_3 = f'<s> {cleaned_phrase} La relación entre {entity_names[0]} y {entity_names[1]} es de naturaleza <mask> </s>'
-
-                prompt_4 = f'<s> {cleaned_phrase} La relación entre {entity_names[0]} y {entity_names[1]} es de carácter <mask> </s>'
-
-                prompt_5_1 = f'<s> {cleaned_phrase} ¿Cuál es la relación entre {entity_names[0]} y {entity_names[1]}? La relación es el <mask>'
-                prompt_5_2 = f'<s> {cleaned_phrase} ¿Cuál es la relación entre {entity_names[0]} y {entity_names[1]}? La relación es la <mask>'
-
-                prompt_0_list_2_ent.append(prompt_0)
-                prompt_1_list_2_ent.append(prompt_1)
-                prompt_2_list_2_ent.append(prompt_2)
-                prompt_3_list_2_ent.append(prompt_3)
-                prompt_4_list_2_ent.append(prompt_4)
-                prompt_5_list_2_ent.append(prompt_5_1)
-                prompt_5_list_2_ent.append(prompt_5_2)
-                
-            prompt_dict['prompt_0_ent_2'] = prompt_0_list_2_ent
-            prompt_dict['prompt_1_ent_2'] = prompt_1_list_2_ent 
-            prompt_dict['prompt_2_ent_2'] = prompt_2_list_2_ent
-            prompt_dict['prompt_3_ent_2'] = prompt_3_list_2_ent
-            prompt_dict['prompt_4_ent_2'] = prompt_4_list_2_ent
-            prompt_dict['prompt_5_ent_2'] = prompt_5_list_2_ent
-
-                
-
-        elif entity_number in entity_dictionary and entity_number == 3:
-                
-                phrases = entity_dictionary.get(entity_number, [])
-
-                prompt_0_list_3_ent = []
-                prompt_1_list_3_ent  = []
-                prompt_2_list_3_ent = []
-                prompt_3_list_3_ent = []
-                prompt_4_list_3_ent = []
-                prompt_5_list_3_ent = []   
-
-                for phrase in phrases:
+    prompts = iter_prompts(
+        phrase_input,
+        full_extraction,
+        entity_number,
+        pair_policy=pair_policy,
+        pair_window=pair_window,
+        max_prompts=max_prompts,
+        max_prompts_per_document=max_prompts_per_document,
+        template_set=template_set
+    )
 
-                    entities = re.findall(r'\$(.*?)\$', phrase)
-                    entity_names = [entity.strip() for entity in entities]
-                    cleaned_phrase = re.sub(r'\$', '', phrase)
+    return save_prompt_dictionary(prompts, json_file_path_name)
 
-                    prompt_0_0 = f'<s> {cleaned_phrase} {entity_names[0]} <mask> {entity_names[1]}. </s>'
-                    prompt_0_1 = f'<s> {cleaned_phrase} {entity_names[1]} <mask> {entity_names[2]}. </s>'
-                    prompt_0_2 = f'<s> {cleaned_phrase} {entity_names[0]} <mask> {entity_names[2]}. </s>'
-                        
-                    prompt_1_0 = f'<s> {cleaned_phrase} La relación entre {entity_names[0]} y {entity_names[1]} es una relación de tipo <mask>. </s>'
-                    prompt_1_1 = f'<s> {cleaned_phrase} La relación entre {entity_names[1]} y {entity_names[2]} es una relación de tipo <mask>. </s>'
-                    prompt_1_2 = f'<s> {cleaned_phrase} La relación entre {entity_names[2]} y {entity_names[0]} es una relación de tipo <mask>. </s>'
 
-                    prompt_2_0 = f'<s> {cleaned_phrase} La relación entre {entity_names[0]} y {entity_names[1]} es una relación de <mask>. </s>'
-                    prompt_2_1 = f'<s> {cleaned_phrase} La relación entre {entity_names[1]} y {entity_names[2]} es una relación de <mask>. </s>'
-                    prompt_2_2 = f'<s> {cleaned_phrase} La relación entre {entity_names[2]} y {entity_names[0]} es una relación de <mask>. </s>'
-
-                    prompt_3_0 = f'<s> {cleaned_phrase} La relación entre {entity_names[0]} y {entity_names[1]} es de naturaleza <mask> </s>'
-                    prompt_3_1 = f'<s> {cleaned_phrase} La relación entre {entity_names[1]} y {entity_names[2]} es de naturaleza <mask> </s>'
-                    prompt_3_2 = f'<s> {cleaned_phrase} La relación entre {entity_names[2]} y {entity_names[0]} es de naturaleza <mask> </s>'
-
-                    prompt_4_0 = f'<s> {cleaned_phrase} La relación entre {entity_names[0]} y {entity_names[1]} es de carácter <mask> </s>'
-                    prompt_4_1 = f'<s> {cleaned_phrase} La relación entre {entity_names[1]} y {entity_names[2]} es de carácter <mask> </s>'
-                    prompt_4_2 = f'<s> {cleaned_phrase} La relación entre {entity_names[2]} y {entity_names[0]} es de carácter <mask> </s>'
-
-                    prompt_5_1_0 = f'<s> {cleaned_phrase} ¿Cuál es la relación entre {entity_names[0]} y {entity_names[1]}? La relación es el <mask>'
-                    prompt_5_1_1 = f'<s> {cleaned_phrase} ¿Cuál es la relación entre {entity_names[1]} y {entity_names[2]}? La relación es el <mask>'
-                    prompt_5_1_2 = f'<s> {cleaned_phrase} ¿Cuál es la relación entre {entity_names[2]} y {entity_names[0]}? La relación es el <mask>'
-                    prompt_5_2_0 = f'<s> {cleaned_phrase} ¿Cuál es la relación entre {entity_names[0]} y {entity_names[1]}? La relación es la <mask>'
-                    prompt_5_2_1 = f'<s> {cleaned_phrase} ¿Cuál es la relación entre {entity_names[1]} y {entity_names[2]}? La relación es la <mask>'
-                    prompt_5_2_2 = f'<s> {cleaned_phrase} ¿Cuál es la relación entre {entity_names[2]} y {entity_names[0]}? La relación es la <mask>'
-                    
-                    prompt_0_list_3_ent.append(prompt_0_0)
-                    prompt_0_list_3_ent.append(prompt_0_1)
-                    prompt_0_list_3_ent.append(prompt_0_2)
-
-                    prompt_1_list_3_ent.append(prompt_1_0)
-                    prompt_1_list_3_ent.append(prompt_1_1)
-                    prompt_1_list_3_ent.append(prompt_1_2)
-
-                    prompt_2_list_3_ent.append(prompt_2_0)
-                    prompt_2_list_3_ent.append(prompt_2_1)  
-                    prompt_2_list_3_ent.append(prompt_2_2) 
-
-                    prompt_3_list_3_ent.append(prompt_3_0)
-                    prompt_3_list_3_ent.append(prompt_3_1)  
-                    prompt_3_list_3_ent.append(prompt_3_2) 
-
-                    prompt_4_list_3_ent.append(prompt_4_0)
-                    prompt_4_list_3_ent.append(prompt_4_1)  
-                    prompt_4_list_3_ent.append(prompt_4_2) 
-
-                    prompt_5_list_3_ent.append(prompt_5_1_0)
-                    prompt_5_list_3_ent.append(prompt_5_1_1)  
-                    prompt_5_list_3_ent.append(prompt_5_1_2) 
-                    prompt_5_list_3_ent.append(prompt_5_2_0)
-                    prompt_5_list_3_ent.append(prompt_5_2_1)  
-                    prompt_5_list_3_ent.append(prompt_5_2_2) 
-
-                prompt_dict['prompt_0_ent_3'] = prompt_0_list_3_ent
-                prompt_dict['prompt_1_ent_3'] = prompt_1_list_3_ent
-                prompt_dict['prompt_2_ent_3'] = prompt_2_list_3_ent
-                prompt_dict['prompt_3_ent_3'] = prompt_3_list_3_ent
-                prompt_dict['prompt_4_ent_3'] = prompt_4_list_3_ent
-                prompt_dict['prompt_5_ent_3'] = prompt_5_list_3_ent
-
-
-        elif entity_number in entity_dictionary and entity_number == 1:
-
-            phrases = entity_dictionary.get(entity_number, [])
-                    
-            prompt_list_unique = []
-            prompt_list_unique_1 = []    
-            for phrase in phrases:
-
-                entities = re.findall(r'\$(.*?)\$', phrase)
-                entity_names = [str(entity.strip()) for entity in entities]
-                cleaned_phrase = re.sub(r'\$', '', phrase)
-                        
+def save_prompt_dictionary(prompts, json_file_path_name: str = None) -> dict:
+    '''
+    DESCRIPTION:
 
-                        
-                prompt_0_unique = f"<s> {cleaned_phrase} La relación entre {''.join(entity_names)} y la frase anterior es una relación de <mask>. </s>"
-                prompt_1_unique= f"<s> {cleaned_phrase} La relación entre {''.join(entity_names)} y la frase anterior es una relación de tipo <mask>. </s>"
+    Groups the prompts of iter_prompts by template, as prompt_generator returns them,
+    and saves them in JSON format.
 
-                prompt_list_unique.append(prompt_0_unique)        
-                prompt_list_unique_1.append(prompt_1_unique)
+    Args::
 
-                prompt_dict['prompt_0_unique'] = prompt_list_unique
-                prompt_dict['prompt_1_unique'] = prompt_list_unique_1
+    prompts: The tuples yielded by iter_prompts, with or without provenance.
 
-        if json_file_path_name:
+    json_file_path_name: The name of the path to save the dictionary in a JSON format. Default: None (not saved).
 
-            with open(json_file_path_name, 'w', encoding='utf-8') as json_file:
-                    json.dump(prompt_dict, json_file)
+    Returns:
 
-        return prompt_dict
+    prompt_dict: A dictionary with the prompt structure as keys and the list of phrases with the prompts as values.
+    '''
+    prompt_dict = {}
+    for template_id, _, prompt, *_ in prompts:
+        prompt_dict.setdefault(template_id, []).append(prompt)
 
+    if json_file_path_name:
 
+        with open(json_file_path_name, 'w', encoding='utf-8') as json_file:
 
+            json.dump(prompt_dict, json_file)
 
+    return prompt_dict
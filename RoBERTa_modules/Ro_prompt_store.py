@@ -0,0 +1,209 @@
+import os
+import json
+import hashlib
+from itertools import islice
+from Ro_corpus_ingestion import resolve_xml_inputs
+from Ro_ingestion_cache import prompt_config_key
+
+
+STORE_VERSION = 1
+
+STORE_FIELDS = ('template_id', 'entities', 'text', 'source', 'div', 'sentence')
+
+
+def store_config_key(xml_input: str, prompt_options: dict) -> str:
+    '''
+    DESCRIPTION:
+    Identifies the prompts of a corpus and a configuration without parsing the
+    XML files: it uses the path, size and modification time of every file.
+
+    INPUTS:
+        xml_input: a XML file, a directory or a glob pattern. See resolve_xml_inputs.
+
+        prompt_options: the entity_number, full_extraction, pair_policy, pair_window, template_set,
+        max_prompts and max_prompts_per_document of iter_prompts.
+
+    OUTPUTS: the configuration key.
+    '''
+    files = []
+    for xml_path in resolve_xml_inputs(xml_input):
+        stat = os.stat(xml_path)
+        files.append([os.path.abspath(xml_path), stat.st_size, stat.st_mtime_ns])
+
+    options = dict(prompt_options)
+    options['templates'] = prompt_config_key(
+        options.get('entity_number', 2),
+        options.get('full_extraction', False),
+        options.get('pair_policy', 'baseline'),
+        options.get('pair_window'),
+        options.get('template_set', 'baseline')
+    )
+    content = json.dumps([STORE_VERSION, files, options], sort_keys=True)
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()[:16]
+
+
+class PromptStore:
+    """
+    Append-only store of prompts in JSON Lines format, one prompt per line with its
+    template, entities and provenance (source file, div and phrase position).
+
+    The prompts are written as they are generated and read back lazily in chunks,
+    so neither side holds all the prompts in memory. A store is complete once
+    commit is called, and a later run with the same configuration reads it
+    instead of extracting the XML files again.
+
+    Args:
+        path (str): Path of the .jsonl file. The metadata is saved next to it in path + '.meta.json'.
+
+    Usage:
+        store = PromptStore('prompts_roberta.jsonl')
+        store.write(iter_prompts(entity_dictionary, with_provenance=True), config_key=key)
+        for chunk in store.iter_chunks(chunk_size=10000):
+            ...
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.partial_path = path + '.partial'
+        self.meta_path = path + '.meta.json'
+
+    def meta(self) -> dict:
+        if not os.path.isfile(self.meta_path):
+            return None
+        with open(self.meta_path, 'r', encoding='utf-8') as meta_file:
+            return json.load(meta_file)
+
+    def is_complete(self, config_key: str = None) -> bool:
+        """
+        Checks if the store holds all the prompts of a configuration.
+
+        Args:
+            config_key (str): The key of store_config_key. Default: None (any configuration).
+
+        Returns:
+            bool: True if the store was committed with that configuration.
+        """
+        meta = self.meta()
+        if meta is None or not os.path.isfile(self.path) or meta.get('version') != STORE_VERSION:
+            return False
+        return config_key is None or meta.get('config') == config_key
+
+    def __len__(self) -> int:
+        meta = self.meta()
+        return meta['prompts'] if meta else 0
+
+    def clear(self):
+        for path in (self.path, self.partial_path, self.meta_path):
+            if os.path.isfile(path):
+                os.remove(path)
+
+    def append(self, prompts) -> int:
+        """
+        Appends prompts to the store. The store is not complete until commit is called.
+
+        Args:
+            prompts (iterable): (template_id, entity_pair, text) tuples, optionally with a fourth
+                (source, div, sentence) provenance tuple, as yielded by iter_prompts.
+
+        Returns:
+            int: The number of prompts appended.
+        """
+        count = 0
+        with open(self.partial_path, 'a', encoding='utf-8') as store_file:
+            for prompt in prompts:
+                template_id, entity_pair, text = prompt[:3]
+                source, div, sentence = prompt[3] if len(prompt) > 3 else (None, None, None)
+                row = [template_id, list(entity_pair), text, source, div, sentence]
+                store_file.write(json.dumps(dict(zip(STORE_FIELDS, row)), ensure_ascii=False))
+                store_file.write('\n')
+                count += 1
+        return count
+
+    def commit(self, config_key: str = None):
+        """
+        Marks the appended prompts as a complete store for a configuration.
+
+        Args:
+            config_key (str): The key of store_config_key. Default: None.
+        """
+        if not os.path.isfile(self.partial_path):
+            # Nothing was appended: the store is empty
+            open(self.partial_path, 'w', encoding='utf-8').close()
+
+        prompt_count = 0
+        with open(self.partial_path, 'r', encoding='utf-8') as store_file:
+            for _ in store_file:
+                prompt_count += 1
+
+        os.replace(self.partial_path, self.path)
+        with open(self.meta_path, 'w', encoding='utf-8') as meta_file:
+            json.dump({'version': STORE_VERSION, 'config': config_key, 'prompts': prompt_count}, meta_file)
+
+    def write(self, prompts, config_key: str = None) -> int:
+        """
+        Replaces the content of the store with the given prompts and commits it.
+
+        Args:
+            prompts (iterable): See append.
+            config_key (str): See commit.
+
+        Returns:
+            int: The number of prompts written.
+        """
+        self.clear()
+        count = self.append(prompts)
+        self.commit(config_key)
+        return count
+
+    def iter_rows(self, template_id: str = None):
+        """
+        Reads the stored prompts lazily.
+
+        Args:
+            template_id (str): If given, only the prompts of that template. Default: None.
+
+        Returns:
+            generator: Dictionaries with the STORE_FIELDS keys.
+        """
+        if not os.path.isfile(self.path):
+            raise ValueError(f"The prompt store {self.path} is empty or was not committed")
+
+        with open(self.path, 'r', encoding='utf-8') as store_file:
+            for line in store_file:
+                row = json.loads(line)
+                if template_id is None or row['template_id'] == template_id:
+                    yield row
+
+    def iter_chunks(self, chunk_size: int = 10000, template_id: str = None):
+        """
+        Reads the stored prompts in lists of at most chunk_size rows.
+
+        Args:
+            chunk_size (int): Number of rows per chunk. Default: 10000.
+            template_id (str): See iter_rows.
+
+        Returns:
+            generator: Lists of rows.
+        """
+        rows = self.iter_rows(template_id)
+        chunk = list(islice(rows, chunk_size))
+        while chunk:
+            yield chunk
+            chunk = list(islice(rows, chunk_size))
+
+    def iter_prompts(self, template_id: str = None, with_provenance: bool = False):
+        """
+        Reads the stored prompts as the (template_id, entity_pair, text) tuples of iter_prompts,
+        so they can be passed to the tokenizers.
+
+        Args:
+            template_id (str): See iter_rows.
+            with_provenance (bool): If True every tuple also carries the (source, div, sentence)
+                of its phrase, as iter_prompts does. Default: False.
+
+        Returns:
+            generator: (template_id, entity_pair, text) tuples.
+        """
+        for row in self.iter_rows(template_id):
+            prompt = (row['template_id'], tuple(row['entities']), row['text'])
+            yield prompt + ((row['source'], row['div'], row['sentence']),) if with_provenance else prompt
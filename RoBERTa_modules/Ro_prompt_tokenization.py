@@ -0,0 +1,215 @@
+import re
+import unicodedata
+from Ro_prompt_templates import all_template_variants, special_tokens
+
+
+# Fields of the templates that change from prompt to prompt, see prompt_templates
+TEMPLATE_FIELDS = ('phrase', 'head', 'tail')
+
+# Left context of the pieces that do not start with whitespace. Any letter works: the
+# piece starts with punctuation, so the tokenizers always cut between them.
+ANCHOR = 'a'
+
+
+def _is_punctuation(character: str) -> bool:
+    # The characters that BERT splits from the previous word and the byte-level BPE
+    # pre-tokenizer never merges with letters or numbers
+    if character.isascii():
+        return not character.isalnum() and not character.isspace()
+    return unicodedata.category(character).startswith('P')
+
+
+def _template_pattern(variant: str):
+    # The phrase ends at the first period that lets the rest of the template match,
+    # so it is the same piece for all the prompts of the phrase
+    groups = {'phrase': r'(.*?\.)', 'head': '(.*?)', 'tail': '(.*?)'}
+    parts = re.split(r'\{(' + '|'.join(TEMPLATE_FIELDS) + r')\}', variant)
+    pattern = ''.join(groups[part] if index % 2 else re.escape(part) for index, part in enumerate(parts))
+    return re.compile(pattern, re.DOTALL)
+
+
+class SplicedTokenizer:
+    """
+    Tokenizes the prompts of the templates encoding every phrase, entity name and
+    template fragment only once.
+
+    A prompt is cut in the pieces of its template: the literal fragments, the phrase
+    and the entities. The leading whitespace of every piece stays with it, and every
+    piece is tokenized once and cached. The input_ids of the prompt are the cached
+    ids of its pieces, concatenated. Splicing is exact only where the tokenizer
+    cannot merge the two sides of a cut: before whitespace, or between a letter or
+    number and a punctuation mark. Prompts with any other cut, or that match no
+    template, are tokenized as a whole, so the result is always the one of the
+    full-string tokenization.
+
+    Args:
+        tokenizer: The fast tokenizer of the model.
+        max_length (int): Maximum number of tokens of a prompt. Default: 512.
+        cache_size (int): Maximum number of cached pieces. The cache is emptied when it is full. Default: 1000000.
+
+    Usage:
+        spliced_tokenizer = SplicedTokenizer(load_tokenizer(model_name))
+        inputs = spliced_tokenizer(prompts)
+    """
+
+    def __init__(self, tokenizer, max_length: int = 512, cache_size: int = 1000000):
+        self.tokenizer = tokenizer
+        self.max_length = max_length
+        self.cache_size = cache_size
+        self.cache = {}
+        self.stats = {'spliced': 0, 'full': 0}
+
+        tokens = special_tokens(tokenizer)
+        variants = [
+            variant.format(**tokens, **{field: '{' + field + '}' for field in TEMPLATE_FIELDS})
+            for variant in all_template_variants()
+        ]
+        self.patterns = [_template_pattern(variant) for variant in dict.fromkeys(variants)]
+
+        # A special token that absorbs the whitespace at its right changes the piece after it
+        self.rstrip_tokens = tuple(
+            token.content for token in getattr(tokenizer, 'added_tokens_decoder', {}).values()
+            if getattr(token, 'rstrip', False)
+        )
+        self.anchor_ids = self._encode([ANCHOR])[0]
+
+    def _encode(self, texts: list) -> list:
+        if not texts:
+            return []
+        return self.tokenizer(texts, add_special_tokens=False)['input_ids']
+
+    def split(self, prompt: str) -> list:
+        """
+        Cuts a prompt in the pieces that can be tokenized on their own.
+
+        Args:
+            prompt (str): The prompt.
+
+        Returns:
+            list: (piece, anchored) tuples, anchored being True for the pieces tokenized after ANCHOR.
+            None if the prompt matches no template or has a cut that could change its tokens.
+        """
+        for position, pattern in enumerate(self.patterns):
+            match = pattern.fullmatch(prompt)
+            if match is not None:
+                if position:
+                    # Consecutive prompts usually share the template
+                    self.patterns.insert(0, self.patterns.pop(position))
+                break
+        else:
+            return None
+
+        pieces = []
+        end = 0
+        for group in range(1, len(match.groups()) + 1):
+            pieces.append(prompt[end:match.start(group)])
+            pieces.append(match.group(group))
+            end = match.end(group)
+        pieces.append(prompt[end:])
+
+        # The whitespace at the end of a piece goes to the start of the next one
+        for index in range(len(pieces) - 1):
+            stripped = pieces[index].rstrip()
+            if len(stripped) < len(pieces[index]):
+                pieces[index + 1] = pieces[index][len(stripped):] + pieces[index + 1]
+                pieces[index] = stripped
+
+        split_pieces = []
+        previous = None
+        for piece in pieces:
+            if not piece:
+                continue
+            if previous is None:
+                split_pieces.append((piece, False))
+            elif piece[0].isspace() and not previous[-1].isspace() and not (
+                self.rstrip_tokens and previous.endswith(self.rstrip_tokens)
+            ):
+                split_pieces.append((piece, False))
+            elif previous[-1].isalnum() and _is_punctuation(piece[0]):
+                split_pieces.append((piece, True))
+            else:
+                return None
+            previous = piece
+
+        return split_pieces
+
+    def _fill_cache(self, pieces: set):
+        plain = [piece for piece, anchored in pieces if not anchored]
+        anchored = [piece for piece, anchored in pieces if anchored]
+        for piece, ids in zip(plain, self._encode(plain)):
+            self.cache[(piece, False)] = ids
+        anchor_length = len(self.anchor_ids)
+        for piece, ids in zip(anchored, self._encode([ANCHOR + piece for piece in anchored])):
+            # None marks a piece that the tokenizer merges with the anchor
+            self.cache[(piece, True)] = ids[anchor_length:] if ids[:anchor_length] == self.anchor_ids else None
+
+    def __call__(self, prompts: list, chunk_size: int = 4096) -> dict:
+        """
+        Tokenizes the prompts without special tokens nor padding, as the tokenizer does with
+        add_special_tokens=False, truncation=True and max_length.
+
+        Args:
+            prompts (list): The prompts.
+            chunk_size (int): Number of prompts whose new pieces are tokenized in a single call. Default: 4096.
+
+        Returns:
+            dict: input_ids and attention_mask, one unpadded list per prompt.
+        """
+        input_ids = []
+        for start in range(0, len(prompts), chunk_size):
+            chunk = prompts[start:start + chunk_size]
+            if len(self.cache) > self.cache_size:
+                self.cache.clear()
+            splits = [self.split(prompt) for prompt in chunk]
+            missing = {piece for split in splits if split is not None for piece in split if piece not in self.cache}
+            if missing:
+                self._fill_cache(missing)
+
+            full_positions = []
+            for prompt_position, split in enumerate(splits):
+                ids = None
+                if split is not None:
+                    ids = []
+                    for piece in split:
+                        piece_ids = self.cache.get(piece)
+                        if piece_ids is None:
+                            ids = None
+                            break
+                        ids.extend(piece_ids)
+                if ids is None:
+                    full_positions.append(prompt_position)
+                    input_ids.append(None)
+                else:
+                    input_ids.append(ids[:self.max_length])
+
+            if full_positions:
+                full_ids = self.tokenizer(
+                    [chunk[position] for position in full_positions],
+                    max_length=self.max_length,
+                    truncation=True,
+                    add_special_tokens=False
+                )['input_ids']
+                for position, ids in zip(full_positions, full_ids):
+                    input_ids[start + position] = ids
+
+            self.stats['spliced'] += len(chunk) - len(full_positions)
+            self.stats['full'] += len(full_positions)
+
+        return {'input_ids': input_ids, 'attention_mask': [[1] * len(ids) for ids in input_ids]}
+
+
+def verify_spliced_tokenization(prompts: list, tokenizer, max_length: int = 512) -> list:
+    """
+    Compares the spliced tokenization of the prompts with the tokenization of the full strings.
+
+    Args:
+        prompts (list): The prompts.
+        tokenizer: The fast tokenizer of the model.
+        max_length (int): See SplicedTokenizer. Default: 512.
+
+    Returns:
+        list: The positions of the prompts whose input_ids differ. Empty if all of them match.
+    """
+    spliced_ids = SplicedTokenizer(tokenizer, max_length=max_length)(prompts)['input_ids']
+    full_ids = tokenizer(prompts, max_length=max_length, truncation=True, add_special_tokens=False)['input_ids']
+    return [position for position, (spliced, full) in enumerate(zip(spliced_ids, full_ids)) if spliced != full]
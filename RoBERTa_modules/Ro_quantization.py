@@ -0,0 +1,121 @@
+import time
+import numpy as np
+from sklearn.metrics import adjusted_rand_score
+from Ro_model_cache import PRECISIONS, load_model, model_device
+from Ro_token_store import TokenShard
+from Ro_inference import MeditationsDataSet, TokenShardDataSet, prompt_token_ids, extract_Roberta_embeddings_dataframe
+from Ro_clustering import compute_kmeans_clustering
+
+
+# Number of prompts compared by quantization_agreement
+AGREEMENT_SAMPLE = 1000
+
+
+def sample_prompts(inputs_tokenized, sample_size: int = AGREEMENT_SAMPLE, seed: int = 42) -> dict:
+    """
+    Draws a random sample of tokenized prompts.
+
+    Args:
+        inputs_tokenized (dict): The tokenized prompts, or the TokenShard of tokenize_prompts_Roberta.
+        sample_size (int): Number of prompts, all of them if there are fewer. Default: AGREEMENT_SAMPLE.
+        seed (int): Seed of the sample. Default: 42.
+
+    Returns:
+        dict: The input_ids of the sampled prompts, in their order.
+    """
+    if isinstance(inputs_tokenized, TokenShard):
+        dataset = TokenShardDataSet(inputs_tokenized)
+    else:
+        dataset = MeditationsDataSet(inputs_tokenized)
+
+    indices = np.arange(len(dataset))
+    if sample_size < len(dataset):
+        indices = np.sort(np.random.default_rng(seed).choice(len(dataset), sample_size, replace=False))
+    return {'input_ids': [prompt_token_ids(dataset[index]).tolist() for index in indices.tolist()]}
+
+
+def quantization_agreement(
+        inputs_tokenized,
+        model_name: str,
+        model_size: str = 'base',
+        tokenizer_name: str = None,
+        sample_size: int = AGREEMENT_SAMPLE,
+        num_clusters: int = 4,
+        batch_size: int = 8,
+        embedding: str = 'logits',
+        layers=-1,
+        layer_pooling: str = 'mean',
+        max_tokens: int = None,
+        quantized_cache_dir: str = None,
+        seed: int = 42
+        ) -> dict:
+    """
+    Compares the int8 model of load_model with the float32 one on a sample of the prompts, to
+    judge the speed and quality trade-off of the int8 precision. Both models infer the sample,
+    and their predictions are clustered with compute_kmeans_clustering.
+
+    Args:
+        inputs_tokenized (dict): The tokenized prompts, or the TokenShard of tokenize_prompts_Roberta.
+        model_name (str): The model directory or hub name.
+        model_size (str): Size of the RoBERTa model ('base' or 'large'). Default: 'base'.
+        tokenizer_name (str): The tokenizer of the checkpoints without tokenizer files. Default: None (PlanTL-GOB-ES/roberta-{model_size}-bne).
+        sample_size (int): Number of prompts compared, see sample_prompts. Default: AGREEMENT_SAMPLE.
+        num_clusters (int): Number of clusters of the comparison. Default: 4.
+        batch_size, embedding, layers, layer_pooling, max_tokens, quantized_cache_dir: See extract_Roberta_embeddings_dataframe.
+        seed (int): Seed of the sample. Default: 42.
+
+    Returns:
+        dict: The number of prompts and masks compared, the top1_agreement (share of masks with the same
+        first predicted token), the adjusted Rand index (ari) of the two clusterings, and the seconds of
+        the inference of every precision. Loading and quantizing the models is not counted.
+    """
+    sample = sample_prompts(inputs_tokenized, sample_size, seed)
+
+    predictions = {}
+    seconds = {}
+    for precision in PRECISIONS:
+        load_model(model_name, model_device(precision), precision, quantized_cache_dir)
+        start = time.perf_counter()
+        predictions[precision] = extract_Roberta_embeddings_dataframe(
+            inputs_tokenized=sample,
+            model_name=model_name,
+            model_size=model_size,
+            tokenizer_name=tokenizer_name,
+            batch_size=batch_size,
+            embedding=embedding,
+            layers=layers,
+            layer_pooling=layer_pooling,
+            decode_phrases=False,
+            max_tokens=max_tokens,
+            precision=precision,
+            quantized_cache_dir=quantized_cache_dir
+        )
+        seconds[precision] = time.perf_counter() - start
+
+    reference, quantized = predictions['float32'], predictions['int8']
+    top1_agreement = float(np.mean([
+        reference_tokens[0] == quantized_tokens[0]
+        for reference_tokens, quantized_tokens in zip(reference['predicted_token'], quantized['predicted_token'])
+    ])) if len(reference) else 1.0
+
+    ari = 1.0
+    if len(reference) > 1:
+        clusters = min(num_clusters, len(reference))
+        ari = float(adjusted_rand_score(
+            compute_kmeans_clustering(reference, n_rel=clusters, random_state=42),
+            compute_kmeans_clustering(quantized, n_rel=clusters, random_state=42)
+        ))
+
+    agreement = {
+        'prompts': len(sample['input_ids']),
+        'masks': len(reference),
+        'top1_agreement': top1_agreement,
+        'ari': ari,
+        'float32_seconds': seconds['float32'],
+        'int8_seconds': seconds['int8']
+    }
+    speedup = seconds['float32'] / seconds['int8'] if seconds['int8'] else 0.0
+    print(f"int8 against float32 on {agreement['masks']} masks of {agreement['prompts']} prompts: "
+          f"top-1 agreement {top1_agreement:.1%}, ARI {ari:.3f}, "
+          f"{seconds['float32']:.1f} s against {seconds['int8']:.1f} s ({speedup:.2f}x)")
+    return agreement
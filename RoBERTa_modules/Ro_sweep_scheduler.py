@@ -0,0 +1,161 @@
+import os
+import time
+import traceback
+import multiprocessing
+from multiprocessing.connection import wait
+import torch
+
+
+# Resident memory of a model during the inference, as a multiple of the size of its weight files
+MEMORY_FACTOR = 3.0
+
+WEIGHT_EXTENSIONS = ('.safetensors', '.bin', '.pt', '.pth')
+
+# The workers inherit the prompts and the token ids of the parent instead of receiving a copy.
+# The parent only tokenizes, so torch has not started its thread pools when it forks.
+START_METHOD = 'fork' if 'fork' in multiprocessing.get_all_start_methods() else 'spawn'
+
+
+def estimate_model_memory(model_path: str, memory_factor: float = MEMORY_FACTOR) -> int:
+    """
+    Estimates the memory of a worker that infers with a checkpoint.
+
+    Args:
+        model_path (str): The checkpoint directory.
+        memory_factor (float): Memory of the worker as a multiple of the weight files. Default: MEMORY_FACTOR.
+
+    Returns:
+        int: The estimated bytes, 0 if model_path is not a directory (a hub name).
+    """
+    if not os.path.isdir(model_path):
+        return 0
+    weight_bytes = sum(
+        os.path.getsize(os.path.join(model_path, name))
+        for name in os.listdir(model_path)
+        if name.endswith(WEIGHT_EXTENSIONS)
+    )
+    return int(weight_bytes * memory_factor)
+
+
+def _run_worker(connection, task, args: tuple, num_threads: int, interop_threads: int):
+    # A new process: the thread pools of torch have not started yet
+    torch.set_num_threads(num_threads)
+    if interop_threads is not None:
+        torch.set_num_interop_threads(interop_threads)
+    try:
+        message = ('done', task(*args))
+    except BaseException:
+        message = ('failed', traceback.format_exc())
+    try:
+        connection.send(message)
+    finally:
+        connection.close()
+
+
+class SweepScheduler:
+    """
+    Runs the models of a sweep at the same time, one worker process per model. A model
+    starts when a worker is free and its estimated memory fits in the budget left by the
+    running models, so the workers never oversubscribe the CPU cores nor the memory.
+
+    A model that raises an exception or whose process dies, for example killed by the
+    system when it runs out of memory, is reported as failed and the sweep goes on.
+
+    Args:
+        workers (int): Maximum number of models running at the same time. Default: 2.
+        threads_per_worker (int): torch intra-op threads of every worker. Default: None
+            (the CPU cores divided by the workers).
+        interop_threads (int): torch inter-op threads of every worker, None keeps the torch default. Default: 1.
+        memory_budget (int): Bytes of memory shared by the running workers, see estimate_model_memory.
+            A model larger than the budget runs alone. Default: None (no budget).
+        start_method (str): The multiprocessing start method. Default: START_METHOD.
+
+    Usage:
+        scheduler = SweepScheduler(workers=4, threads_per_worker=16, memory_budget=64 * 1024 ** 3)
+        outcomes = scheduler.run(run_model, {'checkpoint_1': ('models/checkpoint_1',)})
+    """
+
+    def __init__(
+        self,
+        workers: int = 2,
+        threads_per_worker: int = None,
+        interop_threads: int = 1,
+        memory_budget: int = None,
+        start_method: str = START_METHOD
+    ):
+        if workers < 1:
+            raise ValueError(f"workers must be at least 1, got {workers}")
+        self.workers = workers
+        self.threads_per_worker = threads_per_worker or max(1, (os.cpu_count() or 1) // workers)
+        self.interop_threads = interop_threads
+        self.memory_budget = memory_budget
+        self.context = multiprocessing.get_context(start_method)
+
+    def run(self, task, jobs: dict, memory: dict = None) -> dict:
+        """
+        Runs task(*args) for every job in its own worker process.
+
+        Args:
+            task (callable): The function run by the workers. Its result is sent back to
+                this process, so it should be small, for example the timings of the model.
+            jobs (dict): The arguments of task by job name, started in this order.
+            memory (dict): The estimated bytes of every job name. Default: None (0 bytes).
+
+        Returns:
+            dict: For every job name, a dictionary with the status ('done' or 'failed'), the
+            seconds of the worker, and the result of task or the error.
+        """
+        memory = memory or {}
+        pending = list(jobs)
+        running = {}
+        used_memory = 0
+        outcomes = {}
+
+        while pending or running:
+            while pending and len(running) < self.workers:
+                name = pending[0]
+                needed = memory.get(name, 0)
+                if self.memory_budget is not None and running and used_memory + needed > self.memory_budget:
+                    # Wait for a running model to free its memory
+                    break
+                pending.pop(0)
+                if self.memory_budget is not None and needed > self.memory_budget:
+                    print(f'{name}: the estimated {needed / 1024 ** 3:.1f} GB exceed the memory budget, it runs alone')
+
+                receiver, sender = self.context.Pipe(duplex=False)
+                process = self.context.Process(
+                    target=_run_worker,
+                    args=(sender, task, jobs[name], self.threads_per_worker, self.interop_threads),
+                    name=f'sweep-{name}'
+                )
+                process.start()
+                # Only the worker holds the sending end: its end of the pipe closes when it exits
+                sender.close()
+                running[receiver] = (name, process, time.perf_counter(), needed)
+                used_memory += needed
+                print(f'{name}: started with {self.threads_per_worker} threads ({len(running)} models running)')
+
+            # The result is received before the worker exits, a large one would fill the pipe otherwise
+            for receiver in wait(list(running)):
+                name, process, start, needed = running.pop(receiver)
+                try:
+                    status, result = receiver.recv()
+                except EOFError:
+                    status, result = 'failed', None
+                receiver.close()
+                process.join()
+                used_memory -= needed
+
+                if status == 'failed' and result is None:
+                    result = f'the worker process exited with code {process.exitcode}'
+                outcomes[name] = {
+                    'status': status,
+                    'seconds': time.perf_counter() - start,
+                    'result' if status == 'done' else 'error': result
+                }
+                if status == 'done':
+                    print(f'{name}: done in {outcomes[name]["seconds"]:.1f} s')
+                else:
+                    print(f'{name}: failed after {outcomes[name]["seconds"]:.1f} s\n{result}')
+
+        return outcomes
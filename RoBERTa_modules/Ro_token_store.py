@@ -0,0 +1,182 @@
+import os
+import json
+import hashlib
+import numpy as np
+
+
+TOKEN_STORE_VERSION = 1
+
+TOKEN_DTYPE = np.int32
+OFFSET_DTYPE = np.int64
+
+
+def tokenizer_fingerprint(tokenizer) -> str:
+    '''
+    DESCRIPTION:
+    Identifies a tokenizer by its content: vocabulary, normalization, pre-tokenization
+    and special tokens. Checkpoints fine-tuned from the same model share it, so they
+    share their tokenized prompts.
+
+    INPUTS:
+        tokenizer: a fast (Rust) transformers tokenizer.
+
+    OUTPUTS: the fingerprint.
+    '''
+    content = json.loads(tokenizer.backend_tokenizer.to_str())
+    # Truncation and padding are call settings that the tokenizer keeps from its last call
+    content.pop('truncation', None)
+    content.pop('padding', None)
+    content['special_tokens'] = tokenizer.special_tokens_map
+    return hashlib.sha256(json.dumps(content, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def prompts_fingerprint(prompts: list) -> str:
+    '''
+    DESCRIPTION:
+    Identifies a list of prompts by their texts and order.
+
+    INPUTS:
+        prompts: the prompts.
+
+    OUTPUTS: the fingerprint.
+    '''
+    digest = hashlib.sha256()
+    for prompt in prompts:
+        digest.update(prompt.encode('utf-8'))
+        digest.update(b'\x00')
+    return digest.hexdigest()
+
+
+class TokenShard:
+    """
+    Tokenized prompts stored on disk and read through memory maps.
+
+    The token ids of all the prompts are concatenated in a single int32 buffer
+    (tokens.bin). The prompt i is tokens[offsets[i]:offsets[i + 1]], offsets being
+    an int64 array of len(prompts) + 1 values (offsets.bin). The metadata sidecar
+    (meta.json) records the tokenizer and prompts fingerprints, so a shard is only
+    reused by runs that would tokenize the same prompts the same way. Reading a
+    prompt returns a view of the memory map, without copying the buffer.
+
+    Args:
+        directory (str): Directory of the shard files.
+
+    Usage:
+        shard = TokenShard.for_prompts('token_cache', tokenizer, prompts)
+        if not shard.is_complete():
+            shard.write(chunks_of_input_ids)
+        input_ids = shard[0]
+    """
+
+    def __init__(self, directory: str, tokenizer_key: str = None, prompts_key: str = None, max_length: int = 512):
+        self.directory = directory
+        self.tokens_path = os.path.join(directory, 'tokens.bin')
+        self.offsets_path = os.path.join(directory, 'offsets.bin')
+        self.meta_path = os.path.join(directory, 'meta.json')
+        self.expected_meta = {
+            'version': TOKEN_STORE_VERSION,
+            'tokenizer': tokenizer_key,
+            'prompts': prompts_key,
+            'max_length': max_length
+        }
+        self.tokens = None
+        self.offsets = None
+
+    @classmethod
+    def for_prompts(cls, cache_dir: str, tokenizer, prompts: list, max_length: int = 512):
+        """
+        Returns the shard of the cache directory for a tokenizer and a list of prompts.
+
+        Args:
+            cache_dir (str): Directory of the shards, one subdirectory per tokenizer and prompts.
+            tokenizer: The fast tokenizer.
+            prompts (list): The prompts.
+            max_length (int): Maximum number of tokens of a prompt. Default: 512.
+
+        Returns:
+            TokenShard: The shard, complete if a previous run already tokenized the prompts.
+        """
+        tokenizer_key = tokenizer_fingerprint(tokenizer)
+        prompts_key = prompts_fingerprint(prompts)
+        name = f'{tokenizer_key[:16]}-{prompts_key[:16]}-{max_length}'
+        return cls(os.path.join(cache_dir, name), tokenizer_key, prompts_key, max_length)
+
+    def meta(self) -> dict:
+        if not os.path.isfile(self.meta_path):
+            return None
+        with open(self.meta_path, 'r', encoding='utf-8') as meta_file:
+            return json.load(meta_file)
+
+    def is_complete(self) -> bool:
+        """
+        Checks if the shard holds the prompts of its tokenizer and prompts fingerprints.
+
+        Returns:
+            bool: True if the shard was written with the same fingerprints.
+        """
+        meta = self.meta()
+        if meta is None or not os.path.isfile(self.tokens_path) or not os.path.isfile(self.offsets_path):
+            return False
+        return all(meta.get(key) == value for key, value in self.expected_meta.items())
+
+    def write(self, input_id_chunks) -> int:
+        """
+        Writes the token ids chunk by chunk, so the ids of all the prompts are never in memory.
+
+        Args:
+            input_id_chunks (iterable): Lists of input_ids, one list of token ids per prompt.
+
+        Returns:
+            int: The number of prompts written.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        if os.path.isfile(self.meta_path):
+            os.remove(self.meta_path)
+
+        total_tokens = 0
+        offsets = [0]
+        with open(self.tokens_path, 'wb') as tokens_file:
+            for chunk in input_id_chunks:
+                lengths = [len(ids) for ids in chunk]
+                tokens = np.fromiter((token for ids in chunk for token in ids), dtype=TOKEN_DTYPE, count=sum(lengths))
+                tokens.tofile(tokens_file)
+                offsets.extend((total_tokens + np.cumsum(lengths, dtype=OFFSET_DTYPE)).tolist())
+                total_tokens += int(tokens.size)
+        np.asarray(offsets, dtype=OFFSET_DTYPE).tofile(self.offsets_path)
+
+        # The metadata is written last: a shard without it is incomplete
+        meta = dict(self.expected_meta, prompt_count=len(offsets) - 1, token_count=total_tokens)
+        with open(self.meta_path, 'w', encoding='utf-8') as meta_file:
+            json.dump(meta, meta_file)
+
+        self.tokens = None
+        self.offsets = None
+        return len(offsets) - 1
+
+    def open(self):
+        """
+        Maps the shard files in memory.
+
+        Returns:
+            TokenShard: The shard itself.
+        """
+        if not self.is_complete():
+            raise ValueError(f"The token shard {self.directory} is incomplete or was written for other prompts")
+
+        self.offsets = np.memmap(self.offsets_path, dtype=OFFSET_DTYPE, mode='r')
+        if self.offsets[-1]:
+            self.tokens = np.memmap(self.tokens_path, dtype=TOKEN_DTYPE, mode='r')
+        else:
+            # numpy cannot map an empty file
+            self.tokens = np.empty(0, dtype=TOKEN_DTYPE)
+        return self
+
+    def __len__(self) -> int:
+        if self.offsets is None:
+            self.open()
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index: int) -> np.ndarray:
+        if self.offsets is None:
+            self.open()
+        return self.tokens[self.offsets[index]:self.offsets[index + 1]]
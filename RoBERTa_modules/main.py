@@ -1,16 +1,43 @@
 from Ro_promptORE import pipeline_PromptORE_Roberta
+from Ro_corpus_ingestion import resolve_xml_inputs
 import argparse
 import os
 
 parser = argparse.ArgumentParser(description="Runs the complete pipeline for generating prompts, extracting RoBERTa embeddings,\
         and performing clustering using the PromptORE approach and based for xml-tie files.")
 
-parser.add_argument("--xml_file", help="Path to the input XML file", required=True)
+parser.add_argument("--xml_file", help="Path to the input XML file, or a directory or glob pattern of XML files", required=True)
 parser.add_argument("--models_path", help="Path to the models directory", required=True)
 parser.add_argument("--output_dir", help="Path to the models output directory for CSV files", required=True)
 parser.add_argument("--model_size", type=str, default='base', help='Model size for roberta. it handles base and large')
 parser.add_argument("--entity_number", type=int, default=3, help="number of entities to extract with the method")
 parser.add_argument("--batch_size", type=int, default=32, help="number of sentences per batch")
+parser.add_argument("--max_workers", type=int, default=None, help="number of processes to extract the phrases of a corpus")
+parser.add_argument("--cache_dir", default=None, help="Directory of the ingestion cache, to reprocess only the XML files changed since the last run")
+parser.add_argument("--pair_policy", choices=['baseline', 'all', 'adjacent', 'window'], default='baseline', help="how the entities of a phrase are paired, baseline gives the pairs of the original prompts")
+parser.add_argument("--pair_window", type=int, default=None, help="maximum number of words between the entities of a pair for the window policy")
+parser.add_argument("--template_set", choices=['baseline', 'uniform', 'legacy'], default='baseline', help="baseline for the original prompts, uniform for the same templates ending with a period for any number of entities, legacy for the original prompts with their repetitions")
+parser.add_argument("--max_prompts", type=int, default=None, help="maximum number of prompts of the run")
+parser.add_argument("--max_prompts_per_document", type=int, default=None, help="maximum number of prompts of every XML file")
+parser.add_argument("--prompt_store", default=None, help="JSON Lines file where the prompts are stored, and read back by later runs with the same options")
+parser.add_argument("--token_cache_dir", default=None, help="Directory where the tokenized prompts are stored, and shared by the models with the same tokenizer")
+parser.add_argument("--embedding", choices=['logits', 'hidden'], default='logits', help="cluster the LM head scores or the encoder hidden state at the mask")
+parser.add_argument("--hidden_layers", type=int, nargs='+', default=[-1], help="hidden layers of the hidden embedding, several layers are pooled")
+parser.add_argument("--layer_pooling", choices=['mean', 'concat'], default='mean', help="how several hidden layers are combined")
+parser.add_argument("--embedding_cache_dir", default=None, help="Directory where the mask predictions are cached, so unchanged models skip the inference of the prompts already seen")
+parser.add_argument("--prediction_dir", default=None, help="Directory where the predictions of every model are streamed to disk instead of kept in memory")
+parser.add_argument("--embedding_dtype", choices=['float32', 'float16'], default='float32', help="type of the embeddings streamed to the prediction_dir")
+parser.add_argument("--staged", action='store_true', help="Run the ingestion and the tokenization in background threads that feed the inference")
+parser.add_argument("--queue_size", type=int, default=8, help="maximum number of items waiting between two stages of the staged pipeline")
+parser.add_argument("--max_tokens", type=int, default=None, help="pack the batches by prompt length up to this number of padded tokens instead of batch_size prompts")
+parser.add_argument("--workers", type=int, default=1, help="number of models inferred at the same time, each one in its own process")
+parser.add_argument("--threads_per_worker", type=int, default=None, help="torch threads of every worker, by default the CPU cores divided by the workers")
+parser.add_argument("--interop_threads", type=int, default=1, help="torch inter-op threads of every worker")
+parser.add_argument("--memory_budget", type=float, default=None, help="gigabytes of memory shared by the workers, a model starts only when its estimated memory fits")
+parser.add_argument("--shared_batches", action='store_true', help="Load the models with the same tokenizer together and run every batch through all of them")
+parser.add_argument("--precision", choices=['float32', 'int8'], default='float32', help="int8 quantizes the Linear layers of the models for a faster CPU inference")
+parser.add_argument("--quantized_cache_dir", default=None, help="Directory where the int8 models are saved to skip their quantization in the next runs")
+parser.add_argument("--agreement_sample", type=int, default=None, help="with int8, number of prompts inferred with both precisions to print their agreement and speed")
 
 args = parser.parse_args()
 
@@ -20,9 +47,35 @@ output_dir = args.output_dir
 model_size = args.model_size
 entity_number = args.entity_number
 batch_size =  args.batch_size
-# Check if the XML file exists
-if not os.path.isfile(xml_file):
-    print(f"Error: The XML file '{xml_file}' does not exist.")
+max_workers = args.max_workers
+cache_dir = args.cache_dir
+pair_policy = args.pair_policy
+pair_window = args.pair_window
+template_set = args.template_set
+max_prompts = args.max_prompts
+max_prompts_per_document = args.max_prompts_per_document
+prompt_store = args.prompt_store
+token_cache_dir = args.token_cache_dir
+embedding = args.embedding
+hidden_layers = args.hidden_layers
+layer_pooling = args.layer_pooling
+embedding_cache_dir = args.embedding_cache_dir
+prediction_dir = args.prediction_dir
+embedding_dtype = args.embedding_dtype
+staged = args.staged
+queue_size = args.queue_size
+max_tokens = args.max_tokens
+workers = args.workers
+threads_per_worker = args.threads_per_worker
+interop_threads = args.interop_threads
+memory_budget = args.memory_budget
+shared_batches = args.shared_batches
+precision = args.precision
+quantized_cache_dir = args.quantized_cache_dir
+agreement_sample = args.agreement_sample
+# Check if the XML files exist
+if not resolve_xml_inputs(xml_file):
+    print(f"Error: No XML files found at '{xml_file}'.")
     exit(1)
 
 pipeline = pipeline_PromptORE_Roberta()
@@ -34,7 +87,33 @@ if model_size == 'base':
                 models_path = models_path,
                 output_folder = output_dir,
                 entity_number = entity_number,
-                batch_size = batch_size
+                batch_size = batch_size,
+                max_workers = max_workers,
+                cache_dir = cache_dir,
+                pair_policy = pair_policy,
+                pair_window = pair_window,
+                template_set = template_set,
+                max_prompts = max_prompts,
+                max_prompts_per_document = max_prompts_per_document,
+                prompt_store = prompt_store,
+                token_cache_dir = token_cache_dir,
+                embedding = embedding,
+                hidden_layers = hidden_layers,
+                layer_pooling = layer_pooling,
+                embedding_cache_dir = embedding_cache_dir,
+                prediction_dir = prediction_dir,
+                embedding_dtype = embedding_dtype,
+                staged = staged,
+                queue_size = queue_size,
+                max_tokens = max_tokens,
+                workers = workers,
+                threads_per_worker = threads_per_worker,
+                interop_threads = interop_threads,
+                memory_budget = memory_budget,
+                shared_batches = shared_batches,
+                precision = precision,
+                quantized_cache_dir = quantized_cache_dir,
+                agreement_sample = agreement_sample
                 )
 elif model_size == 'large':
     pipeline.run_models_large(
@@ -42,7 +121,33 @@ elif model_size == 'large':
                 models_path = models_path,
                 output_folder = output_dir,
                 entity_number = entity_number,
-                batch_size = batch_size
+                batch_size = batch_size,
+                max_workers = max_workers,
+                cache_dir = cache_dir,
+                pair_policy = pair_policy,
+                pair_window = pair_window,
+                template_set = template_set,
+                max_prompts = max_prompts,
+                max_prompts_per_document = max_prompts_per_document,
+                prompt_store = prompt_store,
+                token_cache_dir = token_cache_dir,
+                embedding = embedding,
+                hidden_layers = hidden_layers,
+                layer_pooling = layer_pooling,
+                embedding_cache_dir = embedding_cache_dir,
+                prediction_dir = prediction_dir,
+                embedding_dtype = embedding_dtype,
+                staged = staged,
+                queue_size = queue_size,
+                max_tokens = max_tokens,
+                workers = workers,
+                threads_per_worker = threads_per_worker,
+                interop_threads = interop_threads,
+                memory_budget = memory_budget,
+                shared_batches = shared_batches,
+                precision = precision,
+                quantized_cache_dir = quantized_cache_dir,
+                agreement_sample = agreement_sample
                 )
 else:
     print('Error: Please introduce "large" or "base" to perform the extraction.')
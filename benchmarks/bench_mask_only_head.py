@@ -0,0 +1,149 @@
+'''
+Compares the inference of the prompts of a synthetic corpus applying the LM head
+to every token of the batch (mask_only=False) with applying it only to the mask
+positions (mask_only=True), on the cpu. The predicted tokens and embeddings of
+both methods are checked to be equal.
+
+The real BETO and RoBERTa-BNE checkpoints are used when they can be loaded without
+network access, from the paths in the BETO_MODEL and ROBERTA_BNE_MODEL environment
+variables or from the Hugging Face cache. Otherwise a random model of the same
+size and vocabulary is used, with the offline tokenizer of the family (see
+tests/offline_tokenizers.py): the cost of the LM head only depends on the shapes.
+
+Usage: python benchmarks/bench_mask_only_head.py [--paragraphs 2000] [--prompts 512] [--repeat 3] [--model beto]
+'''
+import argparse
+import importlib
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(ROOT, 'BERT_modules'), os.path.join(ROOT, 'RoBERTa_modules'), os.path.join(ROOT, 'tests')]
+
+import numpy as np
+import torch
+
+from offline_tokenizers import offline_tokenizer
+from synthetic_tei import write_corpus
+
+PREFIXES = {'bert': '', 'roberta': 'Ro_'}
+
+# Name: (environment variable, hub name, model family, vocabulary size, offline tokenizer)
+MODELS = {
+    'beto': ('BETO_MODEL', 'dccuchile/bert-base-spanish-wwm-uncased', 'bert', 31002, 'beto-uncased-offline'),
+    'roberta-bne': ('ROBERTA_BNE_MODEL', 'PlanTL-GOB-ES/roberta-base-bne', 'roberta', 50262, 'roberta-bne-offline')
+}
+
+
+def best_time(function, repeat: int):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        timings.append(time.perf_counter() - start)
+    return min(timings), result
+
+
+def corpus_prompts(model_family: str, xml_path: str) -> list:
+    prefix = PREFIXES[model_family]
+    prompt_generator = importlib.import_module(prefix + 'prompt_generator')
+    entity_dictionary = prompt_generator.phrase_extraction(xml_path=xml_path, records=True)
+    return [text for _, _, text in prompt_generator.iter_prompts(entity_dictionary, full_extraction=True)]
+
+
+def real_model(name: str):
+    '''The directory of the real checkpoint, or None if it cannot be loaded without network access.'''
+    from huggingface_hub import snapshot_download
+
+    variable, hub_name = MODELS[name][:2]
+    if variable in os.environ:
+        return os.environ[variable]
+    try:
+        return snapshot_download(hub_name, local_files_only=True)
+    except Exception:
+        return None
+
+
+def random_model(name: str, prompts: list, directory: str) -> str:
+    '''Saves a random model of the size and vocabulary of name, with the offline tokenizer of its family.'''
+    import transformers
+
+    _, _, model_family, vocab_size, tokenizer_name = MODELS[name]
+    tokenizer = offline_tokenizer(tokenizer_name, prompts, vocab_size=8000)
+    if model_family == 'bert':
+        config_class, model_class = transformers.BertConfig, transformers.BertForMaskedLM
+    else:
+        config_class, model_class = transformers.RobertaConfig, transformers.RobertaForMaskedLM
+    # Base size, as the default configurations
+    config = config_class(vocab_size=vocab_size, pad_token_id=tokenizer.pad_token_id, max_position_embeddings=514)
+    torch.manual_seed(0)
+    model_path = os.path.join(directory, tokenizer_name)
+    model_class(config).save_pretrained(model_path)
+    tokenizer.save_pretrained(model_path)
+    return model_path
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--paragraphs', type=int, default=2000)
+    parser.add_argument('--prompts', type=int, default=512)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--model', action='append', choices=list(MODELS), help='Default: beto and roberta-bne')
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    # The head runs on the cpu, as in the CPU nodes
+    os.environ['CUDA_VISIBLE_DEVICES'] = ''
+
+    with tempfile.TemporaryDirectory() as directory:
+        xml_path = write_corpus(os.path.join(directory, 'corpus.xml'), args.paragraphs)
+
+        for name in args.model or list(MODELS):
+            model_family = MODELS[name][2]
+            prefix = PREFIXES[model_family]
+            prompts = corpus_prompts(model_family, xml_path)[:args.prompts]
+
+            model_path = real_model(name)
+            label = name
+            if model_path is None:
+                print(f'{MODELS[name][1]} not available, using a random model of the same size')
+                model_path = random_model(name, prompts, directory)
+                label = f'{name} (random)'
+
+            prompt_preprocessing = importlib.import_module(prefix + 'prompt_preprocessing')
+            inference = importlib.import_module(prefix + 'inference')
+            if model_family == 'bert':
+                inputs = prompt_preprocessing.tokenize_prompts_beto(prompts, tokenizer_name=model_path)
+                extract = inference.extract_bert_embeddings_dataframe
+            else:
+                inputs = prompt_preprocessing.tokenize_prompts_Roberta(prompts, tokenizer_name=model_path)
+                extract = inference.extract_Roberta_embeddings_dataframe
+
+            def run(mask_only):
+                return extract(
+                    inputs, model_name=model_path, tokenizer_name=model_path, batch_size=args.batch_size,
+                    mask_only=mask_only, decode_phrases=False
+                )
+
+            # Loads the model, so both methods are timed with it in memory
+            run(True)
+            full_seconds, expected = best_time(lambda: run(False), args.repeat)
+            mask_seconds, result = best_time(lambda: run(True), args.repeat)
+
+            assert result['predicted_token'].tolist() == expected['predicted_token'].tolist()
+            difference = np.abs(np.stack(result['mask_embedding']) - np.stack(expected['mask_embedding'])).max()
+            assert difference < 1e-3, difference
+
+            tokens = sum(len(ids) for ids in inputs['input_ids'])
+            print(f'{label:>22}  {len(prompts)} prompts, {len(result)} masks, {tokens / len(prompts):.1f} tokens per prompt')
+            print(f'{"":>22}  every token {full_seconds:7.3f} s   mask only {mask_seconds:7.3f} s   '
+                  f'x{full_seconds / mask_seconds:.2f}   max logit difference {difference:.1e}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+'''
+Compares the baseline phrase extraction (concatenating every paragraph and
+applying the regex normalization to the whole text) with PhraseNormalizer
+and the tree and streaming modes of phrase_extraction, on a synthetic
+corpus of 100k paragraphs. The phrases of every method are checked against
+the baseline.
+
+Usage: python benchmarks/bench_phrase_normalizer.py [--paragraphs 100000] [--repeat 3]
+'''
+import argparse
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(ROOT, 'BERT_modules'), os.path.join(ROOT, 'tests')]
+
+from auxiliary_function_XML_process import PhraseNormalizer
+from prompt_generator import iter_paragraphs, phrase_extraction
+from baseline import baseline_phrase_extraction, baseline_split
+from synthetic_tei import write_corpus
+
+
+def best_time(function, repeat: int):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        timings.append(time.perf_counter() - start)
+    return min(timings), result
+
+
+def peak_memory(function) -> float:
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak / 2 ** 20
+
+
+def normalize(paragraph_texts: list) -> list:
+    normalizer = PhraseNormalizer()
+    phrases = []
+    for paragraph_text in paragraph_texts:
+        phrases.extend(normalizer.feed(paragraph_text))
+    return phrases + normalizer.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--paragraphs', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        xml_path = write_corpus(os.path.join(directory, 'corpus.xml'), args.paragraphs)
+        paragraph_texts = list(iter_paragraphs(xml_path))
+        print(f'{len(paragraph_texts)} paragraphs, {os.path.getsize(xml_path) / 2 ** 20:.1f} MiB')
+
+        # Normalization only, over the paragraphs already read
+        baseline_seconds, expected = best_time(lambda: baseline_split(''.join(paragraph_texts)), args.repeat)
+        seconds, phrases = best_time(lambda: normalize(paragraph_texts), args.repeat)
+        assert phrases == expected
+        print(f'normalization  baseline {baseline_seconds:7.3f} s   PhraseNormalizer {seconds:7.3f} s   '
+              f'x{baseline_seconds / seconds:.2f}')
+
+        # Whole extraction from the XML file
+        expected_dictionary = baseline_phrase_extraction(xml_path)
+        baseline_seconds, _ = best_time(lambda: baseline_phrase_extraction(xml_path), args.repeat)
+        baseline_peak = peak_memory(lambda: baseline_phrase_extraction(xml_path))
+        print(f'extraction     baseline {baseline_seconds:7.3f} s   peak {baseline_peak:7.1f} MiB')
+        for streaming in (False, True):
+            seconds, dictionary = best_time(lambda: phrase_extraction(xml_path=xml_path, streaming=streaming), args.repeat)
+            assert dictionary == expected_dictionary
+            peak = peak_memory(lambda: phrase_extraction(xml_path=xml_path, streaming=streaming))
+            mode = 'streaming' if streaming else 'tree'
+            print(f'extraction  {mode:>11} {seconds:7.3f} s   peak {peak:7.1f} MiB   x{baseline_seconds / seconds:.2f}')
+
+
+if __name__ == '__main__':
+    main()
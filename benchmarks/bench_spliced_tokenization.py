@@ -0,0 +1,105 @@
+'''
+Compares the tokenization of the prompts of a synthetic corpus as whole strings
+with SplicedTokenizer, which tokenizes every phrase, entity and template piece
+once. The input_ids of both methods are checked to be equal.
+
+The real BETO and RoBERTa-BNE tokenizers are used when they can be loaded without
+network access (see tests/offline_tokenizers.py), otherwise the offline tokenizers
+with the same pipelines.
+
+Usage: python benchmarks/bench_spliced_tokenization.py [--paragraphs 20000] [--repeat 3] [--tokenizer beto]
+'''
+import argparse
+import importlib
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(ROOT, 'BERT_modules'), os.path.join(ROOT, 'RoBERTa_modules'), os.path.join(ROOT, 'tests')]
+
+from offline_tokenizers import OFFLINE_TOKENIZERS, REAL_TOKENIZERS, offline_tokenizer, real_tokenizer
+from synthetic_tei import write_corpus
+
+PREFIXES = {'bert': '', 'roberta': 'Ro_'}
+
+# Offline tokenizer used when a real one cannot be loaded
+OFFLINE_FALLBACK = {'beto': 'beto-uncased-offline', 'roberta-bne': 'roberta-bne-offline'}
+
+
+def best_time(function, repeat: int):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        timings.append(time.perf_counter() - start)
+    return min(timings), result
+
+
+def corpus_prompts(model_family: str, xml_path: str) -> list:
+    prefix = PREFIXES[model_family]
+    prompt_generator = importlib.import_module(prefix + 'prompt_generator')
+    entity_dictionary = prompt_generator.phrase_extraction(xml_path=xml_path, records=True)
+    return [text for _, _, text in prompt_generator.iter_prompts(entity_dictionary, full_extraction=True)]
+
+
+def load_tokenizer(name: str, xml_path: str):
+    if name in REAL_TOKENIZERS:
+        tokenizer = real_tokenizer(name)
+        if tokenizer is not None:
+            return name, REAL_TOKENIZERS[name][2], tokenizer
+        print(f'{REAL_TOKENIZERS[name][1]} not available, using {OFFLINE_FALLBACK[name]}')
+        name = OFFLINE_FALLBACK[name]
+
+    model_family = OFFLINE_TOKENIZERS[name]
+    return name, model_family, offline_tokenizer(name, corpus_prompts(model_family, xml_path), vocab_size=8000)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--paragraphs', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--max_length', type=int, default=512)
+    parser.add_argument(
+        '--tokenizer',
+        action='append',
+        choices=list(REAL_TOKENIZERS) + list(OFFLINE_TOKENIZERS),
+        help='Default: beto and roberta-bne'
+    )
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        xml_path = write_corpus(os.path.join(directory, 'corpus.xml'), args.paragraphs)
+
+        for name in args.tokenizer or list(REAL_TOKENIZERS):
+            name, model_family, tokenizer = load_tokenizer(name, xml_path)
+            SplicedTokenizer = importlib.import_module(PREFIXES[model_family] + 'prompt_tokenization').SplicedTokenizer
+            prompts = corpus_prompts(model_family, xml_path)
+
+            full_seconds, expected = best_time(
+                lambda: tokenizer(prompts, max_length=args.max_length, truncation=True, add_special_tokens=False)['input_ids'],
+                args.repeat
+            )
+            # A new tokenizer every time, so the cache of pieces starts empty
+            cold_seconds, spliced = best_time(
+                lambda: SplicedTokenizer(tokenizer, max_length=args.max_length)(prompts)['input_ids'],
+                args.repeat
+            )
+            assert spliced == expected
+
+            spliced_tokenizer = SplicedTokenizer(tokenizer, max_length=args.max_length)
+            spliced_tokenizer(prompts)
+            warm_seconds, spliced = best_time(lambda: spliced_tokenizer(prompts)['input_ids'], args.repeat)
+            assert spliced == expected
+
+            tokens = sum(len(ids) for ids in expected)
+            print(f'{name:>22}  {len(prompts)} prompts, {tokens / len(prompts):.1f} tokens per prompt')
+            print(f'{"":>22}  full {full_seconds:7.3f} s   spliced {cold_seconds:7.3f} s   x{full_seconds / cold_seconds:.2f}   '
+                  f'warm cache {warm_seconds:7.3f} s   x{full_seconds / warm_seconds:.2f}')
+            stats = spliced_tokenizer.stats
+            print(f'{"":>22}  {stats["spliced"] / (stats["spliced"] + stats["full"]):.1%} of the prompts spliced')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+'''
+Writes a synthetic XML-TEI corpus shaped like the notarial documents of the
+project, for the benchmarks.
+
+Usage: python benchmarks/synthetic_tei.py corpus.xml --paragraphs 100000
+'''
+import argparse
+import random
+
+WORDS = [
+    'el', 'dicho', 'licenciado', 'Su', 'Majestad', 'que', 'en', 'la', 'ciudad', 'de', 'a', 'dio', 'poder',
+    'escribano', 'público', 'vecino', 'otorgó', 'carta', 'maravedís', 'pesos', 'oro', 'según', 'consta',
+    'testigos', 'presentes', 'fueron', 'por', 'ante', 'mí', 'y', 'se', 'obligó', 'pagar', 'año', 'mes'
+]
+PUNCTUATION = ['', '', '', '', '.', ',', ':', ' -', '\n   ']
+MARKS = ['', '', '', '', '(sic)', '[roto]', '[ilegible]', '* * * ', ' , ']
+ENTITIES = {
+    'persName': ['Juan de Ribera', 'Pedro Núñez', 'Ana de Toledo', 'Diego López', 'María Muñoz'],
+    'placeName': ['Sevilla', 'Toledo', 'Cádiz', 'Lima', 'Nueva España'],
+    'orgName': ['la Casa de la Contratación', 'la Real Audiencia', 'el Cabildo'],
+    'date': ['tres de mayo', '1560', 'dicho día'],
+    'rs': ['el dicho', 'su mujer']
+}
+
+
+def words(rng: random.Random, count: int) -> str:
+    return ' '.join(rng.choice(WORDS) + rng.choice(PUNCTUATION) for _ in range(count)) + rng.choice(MARKS)
+
+
+def write_corpus(path: str, paragraphs: int = 100000, seed: int = 0, paragraphs_per_div: int = 20) -> str:
+    '''
+    DESCRIPTION:
+    Writes a XML-TEI file with random paragraphs and entities.
+
+    INPUTS:
+        path: the output file.
+
+        paragraphs: number of paragraphs. default: 100000
+
+        seed: seed of the random generator. default: 0
+
+        paragraphs_per_div: paragraphs of every div. default: 20
+
+    OUTPUTS: the path of the file.
+    '''
+    rng = random.Random(seed)
+    with open(path, 'w', encoding='utf-8') as xml_file:
+        xml_file.write('<?xml version="1.0" encoding="UTF-8"?>\n<TEI xmlns="http://www.tei-c.org/ns/1.0"><text><body>\n')
+        for paragraph in range(paragraphs):
+            if paragraph % paragraphs_per_div == 0:
+                xml_file.write('</div>\n<div type="folio">\n' if paragraph else '<div type="folio">\n')
+            parts = ['<p>', words(rng, rng.randint(3, 12))]
+            for _ in range(rng.randint(0, 4)):
+                tag = rng.choice(list(ENTITIES))
+                parts.append(f' <{tag}>{rng.choice(ENTITIES[tag])}</{tag}> {words(rng, rng.randint(1, 10))}')
+            parts.append('</p>\n')
+            xml_file.write(''.join(parts))
+        xml_file.write('</div>\n</body></text></TEI>\n')
+
+    return path
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Writes a synthetic XML-TEI corpus.')
+    parser.add_argument('path')
+    parser.add_argument('--paragraphs', type=int, default=100000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    write_corpus(args.path, args.paragraphs, args.seed)
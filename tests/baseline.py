@@ -0,0 +1,245 @@
+'''
+Reference copy of the phrase extraction of the baseline commit, before the
+streaming and incremental normalization. The tests compare the current
+modules with it.
+'''
+import random
+import re
+
+import lxml.etree as ET
+
+TEI = '{http://www.tei-c.org/ns/1.0}'
+ENTITY_TAGS = ['persName', 'orgName', 'placeName', 'date', 'rs', 'fw']
+
+
+def baseline_phrase_list(xml_path: str, document_order: bool = False) -> list:
+    '''
+    The phrases of the baseline phrase_extraction, before entity_sort_dictionary. With
+    document_order the paragraphs of the divs are read in the order of the file, as the
+    streaming modes do, instead of div by div.
+    '''
+    root = ET.parse(xml_path).getroot()
+    ns = {'tei': 'http://www.tei-c.org/ns/1.0'}
+    parragraph_objetives = [TEI + 'pb', TEI + 'p']
+    entity_objetives = [TEI + tag for tag in ENTITY_TAGS]
+
+    if document_order:
+        elements = [element for element in root.iter(*parragraph_objetives) if element.getparent().tag == TEI + 'div']
+    else:
+        elements = [element for div in root.xpath('//tei:div', namespaces=ns) for element in div]
+
+    result = ''
+    for element in elements:
+        if element.tag in parragraph_objetives and element.text is not None:
+            paragraph_text = element.text
+            for entity in element:
+                if entity.tag in entity_objetives and entity.text is not None:
+                    paragraph_text += ' $' + re.sub(r'\s+', ' ', entity.text) + '$ '
+                if entity.tail is not None:
+                    paragraph_text += entity.tail
+            paragraph_text += (element.tail or '')
+
+            result += paragraph_text
+
+    return baseline_split(result)
+
+
+def baseline_split(result: str) -> list:
+    '''The baseline normalization of the concatenated paragraphs.'''
+    result = ' '.join(result.split())
+    result = re.sub(r'\s+\-', '', result)
+    result = re.sub(r'[\[\]\(\)]', '', result)
+    result = re.sub(r'\:.', ': ', result)
+    result = re.sub(r'\ , ', ', ', result)
+    result = re.sub(r'\* * * ', '', result)
+
+    return re.sub(r'\[\S+\]', '', result).split('.')
+
+
+def baseline_paragraph_phrases(paragraph_texts: list) -> list:
+    '''
+    The baseline phrases of the concatenated paragraphs, each one with the index of the
+    paragraph holding its closing period. Every period is replaced by its own private use
+    character, which the normalization patterns treat as a period.
+    '''
+    markers = {}
+    marked = []
+    for index, paragraph_text in enumerate(paragraph_texts):
+        pieces = paragraph_text.split('.')
+        for piece in pieces[:-1]:
+            marker = chr(0xF0000 + len(markers))
+            markers[marker] = index
+            marked.append(piece + marker)
+        marked.append(pieces[-1])
+
+    text = baseline_split(''.join(marked))[0]
+    phrases = []
+    start = 0
+    for position, character in enumerate(text):
+        if character in markers:
+            phrases.append((markers[character], text[start:position]))
+            start = position + 1
+    phrases.append((len(paragraph_texts) - 1, text[start:]))
+
+    return phrases
+
+
+def baseline_mark_types(paragraphs: list) -> list:
+    '''
+    The types of the $ marks of every baseline phrase of the concatenated paragraphs, given
+    as (text, mark_types) pairs. Every $ is replaced by its own private use character, which
+    the colon pattern removes as it removes a $.
+    '''
+    types = {}
+    marked = []
+    for paragraph_text, mark_types in paragraphs:
+        pieces = paragraph_text.split('$')
+        for piece, mark_type in zip(pieces, mark_types):
+            marker = chr(0x100000 + len(types))
+            types[marker] = mark_type
+            marked.append(piece + marker)
+        marked.append(pieces[-1])
+
+    return [[types[character] for character in phrase if character in types] for phrase in baseline_split(''.join(marked))]
+
+
+def baseline_entity_sort_dictionary(result_list: list) -> dict:
+    '''The baseline entity_sort_dictionary.'''
+    phrases_by_entity_count = {}
+    for phrase in result_list:
+        entity_count = len(re.findall(r'\$[^$]+\$', phrase))
+        phrases_by_entity_count.setdefault(entity_count, []).append(phrase.strip() + '.')
+
+    return {key: phrases_by_entity_count[key] for key in sorted(phrases_by_entity_count)}
+
+
+def baseline_phrase_extraction(xml_path: str, return_dict: bool = True, document_order: bool = False):
+    '''The baseline phrase_extraction with count=False. See baseline_phrase_list for document_order.'''
+    result_list = baseline_phrase_list(xml_path, document_order)
+    if return_dict:
+        return baseline_entity_sort_dictionary(result_list)
+    return [i + '.' if not i.endswith(':') else i for i in result_list]
+
+
+# Pieces chosen to hit every normalization pattern and its boundaries
+TRICKY_PIECES = [
+    'dijo', 'el', 'dicho', 'Núñez', 'Múñoz', '.', '. ', ':', ':.', '::.', ': .', ' , ', ',',
+    '* * * ', '*', ' -', '\n -', '-', '[roto]', '[', ']', '(sic)', '(', ')', ' ', '\n   ', '$', '\t'
+]
+
+
+def random_text(rng: random.Random, pieces: int) -> str:
+    return ''.join(rng.choice(TRICKY_PIECES) for _ in range(pieces))
+
+
+def write_random_tei(path: str, seed: int, paragraphs: int = 60) -> str:
+    '''Writes a TEI file with random paragraphs, entities and nested divs.'''
+    rng = random.Random(seed)
+    escape = lambda text: text.replace('&', '&amp;').replace('<', '&lt;')
+    parts = ['<?xml version="1.0" encoding="UTF-8"?>\n<TEI xmlns="http://www.tei-c.org/ns/1.0"><text><body><div>']
+    depth = 1
+    for _ in range(paragraphs):
+        choice = rng.random()
+        if choice < 0.08:
+            parts.append('<div>')
+            depth += 1
+        elif choice < 0.14 and depth > 1:
+            parts.append('</div>')
+            depth -= 1
+        elif choice < 0.18:
+            parts.append('<pb n="1"/>')
+        paragraph = ['<p>', escape(random_text(rng, rng.randint(0, 6)))]
+        if rng.random() < 0.1:
+            # Paragraphs starting with an entity have no text and are skipped
+            paragraph = ['<p>']
+        for _ in range(rng.randint(0, 4)):
+            tag = rng.choice(ENTITY_TAGS)
+            name = escape(random_text(rng, rng.randint(1, 3)).replace('$', 'S'))
+            paragraph.append(f'<{tag}>{name}</{tag}>{escape(random_text(rng, rng.randint(0, 5)))}')
+        paragraph.append('</p>' + escape(random_text(rng, rng.randint(0, 2))))
+        parts.append(''.join(paragraph))
+    parts.append('</div>' * depth + '</body></text></TEI>\n')
+
+    with open(path, 'w', encoding='utf-8') as xml_file:
+        xml_file.write(''.join(parts))
+    return path
+
+
+# The templates the BERT baseline repeated for the phrases with two entities
+BERT_REPEATED = ('prompt_0', 'prompt_1', 'prompt_2')
+
+
+def baseline_prompts(
+    entity_dictionary: dict, model_family: str, full_extraction: bool, entity_number: int = 2, repetitions: bool = True
+) -> dict:
+    '''
+    The prompt dictionary of the baseline prompt_generator of BERT_modules or RoBERTa_modules.
+    Without repetitions, the prompts the BERT baseline generated twice for a phrase come once.
+    '''
+    prompt_dict = {}
+    entity_counts = entity_dictionary if full_extraction else [entity_number]
+    for entity_count in entity_counts:
+        if entity_count not in (1, 2, 3) or entity_count not in entity_dictionary:
+            continue
+        builder = {1: _unique_prompts, 2: _two_entity_prompts, 3: _three_entity_prompts}[entity_count]
+        for phrase in entity_dictionary[entity_count]:
+            names = [entity.strip() for entity in re.findall(r'\$(.*?)\$', phrase)]
+            cleaned = phrase.replace('$', '')
+            for key, prompts in builder(cleaned, names, model_family, full_extraction):
+                if not repetitions and entity_count == 2 and model_family == 'bert' and key[:8] in BERT_REPEATED:
+                    prompts = prompts[:1]
+                prompt_dict.setdefault(key, []).extend(prompts)
+    return prompt_dict
+
+
+def _unique_prompts(c, n, family, full):
+    name = ''.join(n)
+    if family == 'bert':
+        yield 'prompt_0_unique', [f"[CLS] {c} La relación entre {name} y la frase anterior es una relación de [MASK]. [SEP]"]
+        yield 'prompt_1_unique', [f"[CLS] {c} La relación entre {name} y la frase anterior es una relación de tipo [MASK]. [SEP]"]
+    else:
+        yield 'prompt_0_unique', [f"<s> {c} La relación entre {name} y la frase anterior es una relación de <mask>. </s>"]
+        yield 'prompt_1_unique', [f"<s> {c} La relación entre {name} y la frase anterior es una relación de tipo <mask>. </s>"]
+
+
+def _two_entity_prompts(c, n, family, full):
+    if family == 'bert':
+        yield 'prompt_0_ent_2', [f'[CLS] {c} {n[0]} [MASK] {n[1]}. [SEP]'] * 2
+        yield 'prompt_1_ent_2', [f'[CLS] {c} La relación entre {n[0]} y {n[1]} es una relación de tipo [MASK]. [SEP]'] * 2
+        yield 'prompt_2_ent_2', [f'[CLS] {c} La relación entre {n[0]} y {n[1]} es una relación de [MASK]. [SEP]'] * 2
+        yield 'prompt_3_ent_2', [f'[CLS] {c} La relación entre {n[0]} y {n[1]} es de naturaleza [MASK] [SEP]']
+        yield 'prompt_4_ent_2', [f'[CLS] {c} La relación entre {n[0]} y {n[1]} es de carácter [MASK] [SEP]']
+        yield 'prompt_5_ent_2', [
+            f'[CLS] {c} ¿Cuál es la relación entre {n[0]} y {n[1]}? La relación es el [MASK] [SEP]',
+            f'[CLS] {c} ¿Cuál es la relación entre {n[0]} y {n[1]}? La relación es la [MASK] [SEP]'
+        ]
+        return
+
+    end = ' </s>' if full else ''
+    yield 'prompt_0_ent_2', [f'<s> {c} {n[0]} <mask> {n[1]}. </s>']
+    yield 'prompt_1_ent_2', [f'<s> {c} La relación entre {n[0]} y {n[1]} es una relación de tipo <mask> </s>']
+    yield 'prompt_2_ent_2', [f'<s> {c} La relación entre {n[0]} y {n[1]} es una relación de <mask> </s>']
+    yield 'prompt_3_ent_2', [f'<s> {c} La relación entre {n[0]} y {n[1]} es de naturaleza <mask> </s>']
+    yield 'prompt_4_ent_2', [f'<s> {c} La relación entre {n[0]} y {n[1]} es de carácter <mask> </s>']
+    yield 'prompt_5_ent_2', [
+        f'<s> {c} ¿Cuál es la relación entre {n[0]} y {n[1]}? La relación es el <mask>{end}',
+        f'<s> {c} ¿Cuál es la relación entre {n[0]} y {n[1]}? La relación es la <mask>{end}'
+    ]
+
+
+def _three_entity_prompts(c, n, family, full):
+    cls, mask, sep = ('[CLS]', '[MASK]', '[SEP]') if family == 'bert' else ('<s>', '<mask>', '</s>')
+    # RoBERTa without full_extraction dropped some periods and the last </s>
+    short = family == 'roberta' and not full
+    end = f'{mask} {sep}' if short else f'{mask}. {sep}'
+    question_end = mask if short else f'{mask}. {sep}'
+    pairs = [(n[0], n[1]), (n[1], n[2]), (n[2], n[0])]
+    yield 'prompt_0_ent_3', [f'{cls} {c} {h} {mask} {t}. {sep}' for h, t in [(n[0], n[1]), (n[1], n[2]), (n[0], n[2])]]
+    yield 'prompt_1_ent_3', [f'{cls} {c} La relación entre {h} y {t} es una relación de tipo {mask}. {sep}' for h, t in pairs]
+    yield 'prompt_2_ent_3', [f'{cls} {c} La relación entre {h} y {t} es una relación de {mask}. {sep}' for h, t in pairs]
+    yield 'prompt_3_ent_3', [f'{cls} {c} La relación entre {h} y {t} es de naturaleza {end}' for h, t in pairs]
+    yield 'prompt_4_ent_3', [f'{cls} {c} La relación entre {h} y {t} es de carácter {end}' for h, t in pairs]
+    yield 'prompt_5_ent_3', (
+        [f'{cls} {c} ¿Cuál es la relación entre {h} y {t}? La relación es el {question_end}' for h, t in pairs] +
+        [f'{cls} {c} ¿Cuál es la relación entre {h} y {t}? La relación es la {question_end}' for h, t in pairs]
+    )
@@ -0,0 +1,97 @@
+import importlib
+import os
+import random
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+# The modules are scripts importing each other by name, as when running main.py
+for folder in ('BERT_modules', 'RoBERTa_modules'):
+    sys.path.insert(0, os.path.join(ROOT, folder))
+
+
+@pytest.fixture(params=['', 'Ro_'], ids=['bert', 'roberta'])
+def family(request):
+    '''Imports the module of the BERT_modules or the RoBERTa_modules copy, e.g. family('prompt_generator').'''
+    return lambda module: importlib.import_module(request.param + module)
+
+
+@pytest.fixture
+def edge_cases_xml():
+    return os.path.join(FIXTURES, 'edge_cases.xml')
+
+
+# Tokenizer of the tiny checkpoint of every family, see offline_tokenizers
+TINY_TOKENIZERS = {'': 'beto-uncased-offline', 'Ro_': 'roberta-bne-offline'}
+_tiny_checkpoints = {}
+
+
+@pytest.fixture
+def tiny_checkpoint(family, tmp_path_factory):
+    '''
+    A directory with a tiny random masked language model of the family and a tokenizer
+    trained on random TEI text, built once per session. Copy it before changing its files.
+    '''
+    torch = pytest.importorskip('torch')
+    transformers = pytest.importorskip('transformers')
+    pytest.importorskip('tokenizers')
+    from baseline import random_text
+    from offline_tokenizers import offline_tokenizer
+
+    prefix = 'Ro_' if family('model_cache').__name__.startswith('Ro_') else ''
+    if prefix not in _tiny_checkpoints:
+        rng = random.Random(0)
+        texts = [random_text(rng, 30) for _ in range(500)]
+        tokenizer = offline_tokenizer(TINY_TOKENIZERS[prefix], texts, vocab_size=300)
+        if prefix:
+            config_class, model_class = transformers.RobertaConfig, transformers.RobertaForMaskedLM
+        else:
+            config_class, model_class = transformers.BertConfig, transformers.BertForMaskedLM
+        config = config_class(
+            vocab_size=max(len(tokenizer), 128),
+            hidden_size=32,
+            num_hidden_layers=2,
+            num_attention_heads=2,
+            intermediate_size=64,
+            pad_token_id=tokenizer.pad_token_id
+        )
+        torch.manual_seed(0)
+        model_path = str(tmp_path_factory.mktemp(f'{prefix}tiny_model'))
+        model_class(config).save_pretrained(model_path)
+        tokenizer.save_pretrained(model_path)
+        _tiny_checkpoints[prefix] = model_path
+    return _tiny_checkpoints[prefix]
+
+
+@pytest.fixture
+def tiny_inputs(family, tiny_checkpoint):
+    '''Prompts with one or two masks, some repeated, tokenized by the tokenizer of tiny_checkpoint.'''
+    prompt_preprocessing = family('prompt_preprocessing')
+    tokenize_prompts = getattr(prompt_preprocessing, 'tokenize_prompts_beto', None) or \
+        prompt_preprocessing.tokenize_prompts_Roberta
+    mask = prompt_preprocessing.load_tokenizer(tiny_checkpoint).mask_token
+    from baseline import random_text
+
+    rng = random.Random(0)
+    texts = [random_text(rng, rng.randrange(1, 30)) for _ in range(10)]
+    prompts = [rng.choice(texts) + f' {mask}' + f' el {mask}' * (index % 3 == 0) for index in range(40)]
+    return tokenize_prompts(prompts, tokenizer_name=tiny_checkpoint)
+
+
+@pytest.fixture
+def extract_predictions(family, tiny_checkpoint):
+    '''The inference of the family, with the model of tiny_checkpoint by default.'''
+    inference = family('inference')
+    extract = getattr(inference, 'extract_bert_embeddings_dataframe', None) or \
+        inference.extract_Roberta_embeddings_dataframe
+
+    def extract_predictions(inputs, **kwargs):
+        kwargs.setdefault('model_name', tiny_checkpoint)
+        kwargs.setdefault('tokenizer_name', kwargs['model_name'])
+        return extract(inputs, **kwargs)
+
+    yield extract_predictions
+    family('model_cache').clear_model_cache()
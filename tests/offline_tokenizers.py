@@ -0,0 +1,81 @@
+'''
+Tokenizers of the models for the tests and benchmarks.
+
+The real BETO and RoBERTa-BNE tokenizers are loaded from the paths in the
+BETO_TOKENIZER and ROBERTA_BNE_TOKENIZER environment variables, or from the
+Hugging Face cache, without network access. The offline tokenizers use the
+same pipelines (WordPiece with the BERT normalizer and pre-tokenizer for BETO,
+byte-level BPE without prefix space for RoBERTa-BNE) with a vocabulary trained
+on the given texts, so the splicing can be checked where the real ones are
+not available.
+'''
+import os
+
+# Name: (environment variable, hub name, model family)
+REAL_TOKENIZERS = {
+    'beto': ('BETO_TOKENIZER', 'dccuchile/bert-base-spanish-wwm-uncased', 'bert'),
+    'roberta-bne': ('ROBERTA_BNE_TOKENIZER', 'PlanTL-GOB-ES/roberta-base-bne', 'roberta')
+}
+
+# Name: model family
+OFFLINE_TOKENIZERS = {
+    'beto-uncased-offline': 'bert',
+    'beto-cased-offline': 'bert',
+    'roberta-bne-offline': 'roberta'
+}
+
+
+def real_tokenizer(name: str):
+    '''The real tokenizer, or None if it cannot be loaded without network access.'''
+    from transformers import AutoTokenizer
+
+    variable, hub_name, _ = REAL_TOKENIZERS[name]
+    try:
+        return AutoTokenizer.from_pretrained(os.environ.get(variable, hub_name), use_fast=True, local_files_only=True)
+    except (OSError, ValueError):
+        return None
+
+
+def offline_tokenizer(name: str, texts: list, vocab_size: int = 2000):
+    '''A tokenizer with the pipeline of the model of name and a vocabulary trained on texts.'''
+    from tokenizers import Tokenizer, decoders, models, normalizers, pre_tokenizers, trainers
+    from transformers import BertTokenizerFast, RobertaTokenizerFast
+
+    if OFFLINE_TOKENIZERS[name] == 'bert':
+        special = ['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]']
+        tokenizer = Tokenizer(models.WordPiece(unk_token='[UNK]'))
+        # BETO uncased lowercases the text but keeps the accents
+        tokenizer.normalizer = normalizers.BertNormalizer(lowercase=name == 'beto-uncased-offline', strip_accents=False)
+        tokenizer.pre_tokenizer = pre_tokenizers.BertPreTokenizer()
+        tokenizer.decoder = decoders.WordPiece()
+        tokenizer.train_from_iterator(texts, trainers.WordPieceTrainer(vocab_size=vocab_size, special_tokens=special))
+        return BertTokenizerFast(
+            tokenizer_object=tokenizer,
+            unk_token='[UNK]',
+            cls_token='[CLS]',
+            sep_token='[SEP]',
+            pad_token='[PAD]',
+            mask_token='[MASK]'
+        )
+
+    special = ['<s>', '<pad>', '</s>', '<unk>', '<mask>']
+    tokenizer = Tokenizer(models.BPE())
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(
+        vocab_size=vocab_size,
+        special_tokens=special,
+        initial_alphabet=pre_tokenizers.ByteLevel.alphabet()
+    )
+    tokenizer.train_from_iterator(texts, trainer)
+    return RobertaTokenizerFast(
+        tokenizer_object=tokenizer,
+        add_prefix_space=False,
+        bos_token='<s>',
+        eos_token='</s>',
+        cls_token='<s>',
+        sep_token='</s>',
+        pad_token='<pad>',
+        unk_token='<unk>',
+        mask_token='<mask>'
+    )
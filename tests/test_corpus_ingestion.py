@@ -0,0 +1,83 @@
+import os
+
+import pytest
+
+from baseline import write_random_tei
+
+
+def fields(phrase):
+    if isinstance(phrase, str):
+        return phrase
+    return (phrase.text, phrase.entities, phrase.spans, phrase.types, phrase.source, phrase.div, phrase.sentence)
+
+
+def test_merge_entity_dictionaries_keeps_file_order(family):
+    merge_entity_dictionaries = family('corpus_ingestion').merge_entity_dictionaries
+    dictionaries = [
+        ('a.xml', {2: ['a2.', 'b2.'], 0: ['a0.']}),
+        ('b.xml', {1: ['c1.'], 2: ['c2.']}),
+        ('c.xml', {2: ['d2.'], 0: ['d0.']})
+    ]
+
+    merged, provenance = merge_entity_dictionaries(dictionaries)
+
+    assert list(merged) == [0, 1, 2]
+    assert merged == {0: ['a0.', 'd0.'], 1: ['c1.'], 2: ['a2.', 'b2.', 'c2.', 'd2.']}
+    assert provenance == {0: ['a.xml', 'c.xml'], 1: ['b.xml'], 2: ['a.xml', 'a.xml', 'b.xml', 'c.xml']}
+
+
+def test_merge_prompt_dictionaries_keeps_prompt_order(family):
+    merge_prompt_dictionaries = family('corpus_ingestion').merge_prompt_dictionaries
+    dictionaries = [
+        {'prompt_1_ent_2': ['a1'], 'prompt_0_ent_3': ['a3']},
+        {'prompt_0_unique': ['b0'], 'prompt_10_ent_2': ['b10'], 'prompt_1_ent_2': ['b1']},
+        {'prompt_0_ent_2': ['c0']}
+    ]
+
+    merged = merge_prompt_dictionaries(dictionaries)
+
+    assert list(merged) == ['prompt_0_unique', 'prompt_0_ent_2', 'prompt_1_ent_2', 'prompt_10_ent_2', 'prompt_0_ent_3']
+    assert merged['prompt_1_ent_2'] == ['a1', 'b1']
+
+
+@pytest.fixture
+def corpus(tmp_path):
+    directory = tmp_path / 'corpus'
+    (directory / 'legajo').mkdir(parents=True)
+    for seed, name in enumerate(['b.xml', 'a.xml', os.path.join('legajo', 'c.xml')]):
+        write_random_tei(str(directory / name), seed)
+    return str(directory)
+
+
+def test_resolve_xml_inputs(family, corpus):
+    resolve_xml_inputs = family('corpus_ingestion').resolve_xml_inputs
+    expected = [os.path.join(corpus, name) for name in ['a.xml', 'b.xml', os.path.join('legajo', 'c.xml')]]
+
+    assert resolve_xml_inputs(corpus) == expected
+    assert resolve_xml_inputs(os.path.join(corpus, '*.xml')) == expected[:2]
+    assert resolve_xml_inputs(expected[2]) == expected[2:]
+
+
+@pytest.mark.parametrize('records', [False, True], ids=['phrases', 'records'])
+def test_corpus_matches_every_file(family, corpus, records):
+    corpus_ingestion = family('corpus_ingestion')
+    phrase_extraction = family('prompt_generator').phrase_extraction
+    xml_files = corpus_ingestion.resolve_xml_inputs(corpus)
+
+    expected = {}
+    expected_provenance = {}
+    for xml_path in xml_files:
+        for entity_count, phrases in phrase_extraction(xml_path=xml_path, streaming=True, records=records).items():
+            expected.setdefault(entity_count, []).extend(fields(phrase) for phrase in phrases)
+            expected_provenance.setdefault(entity_count, []).extend([xml_path] * len(phrases))
+
+    # The process pool returns the files in the order of resolve_xml_inputs
+    merged, provenance = corpus_ingestion.corpus_phrase_extraction(
+        corpus, max_workers=2, return_provenance=True, records=records
+    )
+
+    assert {key: [fields(phrase) for phrase in phrases] for key, phrases in merged.items()} == \
+        {key: expected[key] for key in sorted(expected)}
+    assert provenance == {key: expected_provenance[key] for key in sorted(expected)}
+    if records:
+        assert all(record.source == source for key in merged for record, source in zip(merged[key], provenance[key]))
@@ -0,0 +1,115 @@
+import os
+import shutil
+import types
+
+import pytest
+
+torch = pytest.importorskip('torch')
+transformers = pytest.importorskip('transformers')
+np = pytest.importorskip('numpy')
+
+
+def embeddings(dataframe):
+    return np.stack(dataframe['mask_embedding'].to_list())
+
+
+def test_warm_cache_returns_identical_rows(family, tiny_inputs, extract_predictions, tmp_path, monkeypatch, capsys):
+    cache_dir = str(tmp_path / 'embedding_cache')
+    expected = extract_predictions(tiny_inputs, embedding_cache=cache_dir)
+
+    # Every mask is cached, the model is not loaded
+    def load_model(*args, **kwargs):
+        raise AssertionError('the model was loaded')
+    monkeypatch.setattr(family('inference'), 'load_model', load_model)
+    capsys.readouterr()
+    cached = extract_predictions(tiny_inputs, embedding_cache=cache_dir)
+
+    assert f'{len(expected)} of {len(expected)} mask predictions read' in capsys.readouterr().out
+    assert cached['predicted_token'].tolist() == expected['predicted_token'].tolist()
+    assert cached['prompt_index'].tolist() == expected['prompt_index'].tolist()
+    assert np.array_equal(embeddings(cached), embeddings(expected))
+
+
+def test_changed_checkpoint_misses(family, tiny_checkpoint, tiny_inputs, extract_predictions, tmp_path, capsys):
+    model_path = str(tmp_path / 'model')
+    shutil.copytree(tiny_checkpoint, model_path)
+    cache_dir = str(tmp_path / 'embedding_cache')
+    cache = family('embedding_cache').EmbeddingCache(cache_dir)
+    extract_predictions(tiny_inputs, model_name=model_path, embedding_cache=cache)
+    key = cache.model_key(model_path)
+
+    # Touching the files is not a change
+    for name in os.listdir(model_path):
+        os.utime(os.path.join(model_path, name))
+    assert cache.model_key(model_path) == key
+
+    # Further training changes the weights of the same directory
+    model = transformers.AutoModelForMaskedLM.from_pretrained(model_path)
+    with torch.no_grad():
+        for parameter in model.parameters():
+            parameter.add_(0.01)
+    model.save_pretrained(model_path)
+    family('model_cache').clear_model_cache()
+    capsys.readouterr()
+
+    result = extract_predictions(tiny_inputs, model_name=model_path, embedding_cache=cache)
+
+    assert cache.model_key(model_path) != key
+    assert f'0 of {len(result)} mask predictions read' in capsys.readouterr().out
+    expected = extract_predictions(tiny_inputs, model_name=model_path, embedding_cache=str(tmp_path / 'new_cache'))
+    assert np.array_equal(embeddings(result), embeddings(expected))
+
+
+@pytest.fixture
+def table(family, tmp_path):
+    '''A table of 10 rows of 4 floats and 5 token ids.'''
+    EmbeddingTable = family('embedding_cache').EmbeddingTable
+    row_bytes = 4 * 4 + 5 * 4 + 8 + 8
+    return EmbeddingTable(str(tmp_path / 'table'), max_bytes=10 * row_bytes)
+
+
+def rows(keys):
+    keys = np.asarray(keys, dtype=np.uint64)
+    return keys, np.repeat(keys[:, None], 4, axis=1).astype(np.float32), np.repeat(keys[:, None], 5, axis=1).astype(np.int32)
+
+
+def test_table_evicts_the_least_recently_used_rows(table):
+    table.write(*rows(range(1, 11)))
+    assert table.max_rows == 10
+    table.flush()
+    # A later run uses the first five
+    table.lookup(np.arange(1, 6, dtype=np.uint64))
+
+    table.write(*rows(range(11, 14)))
+
+    assert len(table) == 10
+    assert table.capacity == 10
+    slots = table.lookup(np.arange(1, 14, dtype=np.uint64))
+    assert (slots[:5] >= 0).all()
+    assert (slots[10:] >= 0).all()
+    assert (slots[5:10] >= 0).sum() == 2
+    vectors, top_ids = table.read(slots[slots >= 0])
+    assert vectors[:, 0].tolist() == np.arange(1, 14)[slots >= 0].tolist()
+    assert top_ids[:, 0].tolist() == np.arange(1, 14)[slots >= 0].tolist()
+
+
+def test_cache_evicts_the_least_recently_used_tables(family, tmp_path, monkeypatch):
+    embedding_cache = family('embedding_cache')
+    clock = iter(range(1, 100))
+    monkeypatch.setattr(embedding_cache, 'time', types.SimpleNamespace(time=lambda: next(clock)))
+    cache = embedding_cache.EmbeddingCache(str(tmp_path / 'embedding_cache'))
+    tables = []
+    for index in range(3):
+        table = cache.table(str(index) * 64, {'embedding': 'logits'})
+        table.write(*rows(range(1, 101)))
+        table.flush()
+        tables.append(table)
+    table_bytes = sum(entry.stat().st_size for entry in os.scandir(tables[0].directory))
+
+    # The second table is the least recently used, the last one is kept even if it is older
+    tables[0].flush()
+    cache.max_bytes = 2 * table_bytes + table_bytes // 2
+    cache.evict(keep=tables[2])
+
+    assert [os.path.isdir(table.directory) for table in tables] == [True, False, True]
+    assert len(cache.table('0' * 64, {'embedding': 'logits'})) == 100
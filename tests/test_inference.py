@@ -0,0 +1,176 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+np = pytest.importorskip('numpy')
+transformers = pytest.importorskip('transformers')
+
+
+@pytest.fixture
+def token_lists():
+    rng = np.random.default_rng(0)
+    return [rng.integers(5, 100, size=length).tolist() for length in [3, 17, 1, 9, 17, 4]]
+
+
+def test_pad_batch_pads_to_the_longest_prompt(family, token_lists):
+    pad_batch = family('inference').pad_batch
+    # Items of TokenShardDataSet, only the unpadded input_ids
+    batch = pad_batch([{'input_ids': np.asarray(ids, dtype=np.int32)} for ids in token_lists], pad_token_id=1)
+
+    assert batch['input_ids'].shape == (len(token_lists), max(map(len, token_lists)))
+    for row, ids in enumerate(token_lists):
+        assert batch['input_ids'][row].tolist() == ids + [1] * (batch['input_ids'].shape[1] - len(ids))
+        assert batch['attention_mask'][row].tolist() == [1] * len(ids) + [0] * (batch['input_ids'].shape[1] - len(ids))
+
+
+def test_pad_batch_drops_the_previous_padding(family, token_lists):
+    inference = family('inference')
+    # Items of MeditationsDataSet, padded to 512 as the tokenizers used to do
+    encodings = {
+        'input_ids': [ids + [0] * (512 - len(ids)) for ids in token_lists],
+        'attention_mask': [[1] * len(ids) + [0] * (512 - len(ids)) for ids in token_lists]
+    }
+    dataset = inference.MeditationsDataSet(encodings)
+    batch = inference.pad_batch([dataset[index] for index in range(1, 4)])
+
+    assert batch['input_ids'].shape == (3, 17)
+    assert batch['attention_mask'].sum(dim=1).tolist() == [17, 1, 9]
+    assert batch['input_ids'][0].tolist() == token_lists[1]
+
+
+@pytest.mark.parametrize('max_tokens', [64, 300, 1000])
+def test_sampler_batches_fit_the_budget(family, max_tokens):
+    TokenBudgetSampler = family('inference').TokenBudgetSampler
+    rng = np.random.default_rng(0)
+    # Some prompts are longer than the smallest budget
+    lengths = rng.integers(1, 200, size=500)
+
+    batches = list(TokenBudgetSampler(lengths, max_tokens=max_tokens))
+
+    for batch in batches:
+        assert len(batch) == 1 or len(batch) * lengths[batch].max() <= max_tokens
+        assert len(set((-(-lengths[batch] // 8)).tolist())) == 1
+    assert sorted(np.concatenate(batches).tolist()) == list(range(len(lengths)))
+
+
+def test_sampler_without_budget_takes_consecutive_prompts(family):
+    sampler = family('inference').TokenBudgetSampler(np.ones(20, dtype=np.int64), batch_size=8)
+
+    batches = []
+    for batch in sampler:
+        batches.append(batch.tolist())
+        if len(batches) == 1:
+            sampler.shrink(8, 8)
+
+    assert batches == [list(range(8)), [8, 9, 10, 11], [12, 13, 14, 15], [16, 17, 18, 19]]
+
+
+class OutOfMemory:
+    '''Makes the encoder of a model fail like the allocator for batches of more than max_prompts prompts.'''
+
+    def __init__(self, model, max_prompts: int):
+        self.max_prompts = max_prompts
+        self.batches = []
+        model.base_model.register_forward_pre_hook(self, with_kwargs=True)
+
+    def __call__(self, module, args, kwargs):
+        input_ids = args[0] if args else kwargs['input_ids']
+        if len(input_ids) > self.max_prompts:
+            raise RuntimeError('CUDA out of memory. Tried to allocate 2.00 GiB')
+        self.batches.append(len(input_ids))
+
+
+@pytest.fixture
+def tiny_items(family, tiny_inputs):
+    dataset = family('inference').MeditationsDataSet(tiny_inputs)
+    return [dataset[index] for index in range(len(dataset))]
+
+
+@pytest.mark.parametrize('mask_only', [True, False])
+def test_infer_adaptive_splits_the_batch(family, tiny_checkpoint, tiny_items, mask_only):
+    inference = family('inference')
+    tokenizer = inference.load_tokenizer(tiny_checkpoint)
+    model = transformers.AutoModelForMaskedLM.from_pretrained(tiny_checkpoint).eval()
+    arguments = (tokenizer.pad_token_id, tokenizer.mask_token_id, torch.device('cpu'))
+    expected = inference.infer_adaptive(model, tiny_items, *arguments, mask_only=mask_only)
+
+    sampler = inference.TokenBudgetSampler(batch_size=len(tiny_items))
+    stats = inference.InferenceStats()
+    failures = OutOfMemory(model, 7)
+    rows, vectors, top_ids = inference.infer_adaptive(
+        model, tiny_items, *arguments, mask_only=mask_only, sampler=sampler, stats=stats
+    )
+
+    # 40 prompts are split in halves until they fit: 20, then 10, then 5
+    assert failures.batches == [5] * 8
+    assert stats.retries == 7
+    assert stats.prompts == len(tiny_items)
+    assert sampler.batch_size == 5
+    # The masks keep the order of the prompts
+    assert rows.tolist() == expected[0].tolist()
+    assert np.allclose(vectors, expected[1], atol=1e-5)
+    assert np.array_equal(top_ids, expected[2])
+
+
+def test_infer_models_adaptive_splits_the_batch_of_every_model(family, tiny_checkpoint, tiny_items):
+    inference = family('inference')
+    tokenizer = inference.load_tokenizer(tiny_checkpoint)
+    models = {
+        'first': transformers.AutoModelForMaskedLM.from_pretrained(tiny_checkpoint),
+        'second': transformers.AutoModelForMaskedLM.from_pretrained(tiny_checkpoint)
+    }
+    arguments = (tokenizer.pad_token_id, tokenizer.mask_token_id, torch.device('cpu'))
+    expected_rows, expected = inference.infer_models_adaptive(models, tiny_items, *arguments)
+
+    stats = {name: inference.InferenceStats() for name in models}
+    # Only the second model runs out of memory, both run the halves
+    failures = OutOfMemory(models['second'], 20)
+    rows, outputs = inference.infer_models_adaptive(models, tiny_items, *arguments, stats=stats)
+
+    assert failures.batches == [20, 20]
+    assert [model_stats.retries for model_stats in stats.values()] == [1, 1]
+    assert [model_stats.batches for model_stats in stats.values()] == [2, 2]
+    assert rows.tolist() == expected_rows.tolist()
+    for name in models:
+        assert np.allclose(outputs[name][0], expected[name][0], atol=1e-5)
+        assert np.array_equal(outputs[name][1], expected[name][1])
+
+
+@pytest.fixture
+def fine_tuned_checkpoints(tiny_checkpoint, tmp_path):
+    '''Two checkpoints with the tokenizer of tiny_checkpoint and different weights.'''
+    checkpoints = {}
+    for seed in range(2):
+        model = transformers.AutoModelForMaskedLM.from_pretrained(tiny_checkpoint)
+        generator = torch.Generator().manual_seed(seed)
+        with torch.no_grad():
+            for parameter in model.parameters():
+                parameter.add_(0.02 * torch.randn(parameter.shape, generator=generator))
+        checkpoints[f'checkpoint_{seed}'] = str(tmp_path / f'checkpoint_{seed}')
+        model.save_pretrained(checkpoints[f'checkpoint_{seed}'])
+        transformers.AutoTokenizer.from_pretrained(tiny_checkpoint).save_pretrained(checkpoints[f'checkpoint_{seed}'])
+    return checkpoints
+
+
+@pytest.mark.parametrize('max_tokens', [None, 256])
+@pytest.mark.parametrize('streamed', [False, True], ids=['dataframe', 'store'])
+def test_shared_batches_match_every_model(family, fine_tuned_checkpoints, tiny_inputs, extract_predictions, tmp_path, max_tokens, streamed):
+    inference = family('inference')
+    options = {'batch_size': 6, 'max_tokens': max_tokens, 'embedding': 'hidden', 'layers': [-1, -2]}
+    prediction_dirs = {name: str(tmp_path / 'shared' / name) for name in fine_tuned_checkpoints} if streamed else None
+
+    shared = inference.extract_multi_model_predictions(
+        tiny_inputs, fine_tuned_checkpoints, prediction_dirs=prediction_dirs, chunk_size=8, **options
+    )
+
+    embeddings = []
+    for name, model_path in fine_tuned_checkpoints.items():
+        expected = extract_predictions(tiny_inputs, model_name=model_path, decode_phrases=False, **options)
+        result = shared[name].to_dataframe() if streamed else shared[name]
+        assert list(result.columns) == list(expected.columns)
+        assert result['predicted_token'].map(list).tolist() == expected['predicted_token'].map(list).tolist()
+        assert result['prompt_index'].tolist() == expected['prompt_index'].tolist()
+        # The same batches, so the same padding and the same values
+        embeddings.append(np.stack(result['mask_embedding'].to_list()))
+        assert np.array_equal(embeddings[-1], np.stack(expected['mask_embedding'].to_list()))
+    # Every model got its own predictions
+    assert not np.array_equal(*embeddings)
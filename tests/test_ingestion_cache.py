@@ -0,0 +1,107 @@
+import re
+
+import pytest
+
+from baseline import write_random_tei
+
+
+def record_fields(entity_dictionary):
+    return {
+        count: [
+            (record.text, record.entities, record.spans, record.types, record.source, record.div, record.sentence)
+            for record in records
+        ]
+        for count, records in entity_dictionary.items()
+    }
+
+
+def extract(family, cache_dir, xml_input, **options):
+    return family('ingestion_cache').IngestionCache(str(cache_dir)).extract(xml_input, with_provenance=True, **options)
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_cached_records_match_uncached(family, tmp_path, seed):
+    xml_path = write_random_tei(str(tmp_path / 'random.xml'), seed, paragraphs=150)
+    expected = family('prompt_generator').phrase_extraction(xml_path=xml_path, records=True)
+
+    # The first run fills the cache and the second one reads it
+    for _ in range(2):
+        entity_dictionary, _ = extract(family, tmp_path / 'cache', xml_path)
+        assert record_fields(entity_dictionary) == record_fields(expected)
+
+
+@pytest.mark.parametrize('full_extraction', [False, True])
+def test_cached_prompts_match_uncached(family, edge_cases_xml, tmp_path, full_extraction):
+    prompt_generator = family('prompt_generator')
+    entity_dictionary = prompt_generator.phrase_extraction(xml_path=edge_cases_xml, records=True)
+    expected = list(prompt_generator.iter_prompts(entity_dictionary, full_extraction=full_extraction, with_provenance=True))
+
+    for _ in range(2):
+        _, prompts = extract(family, tmp_path / 'cache', edge_cases_xml, full_extraction=full_extraction)
+        assert prompts == expected
+
+
+def edit_file(xml_path, edit):
+    with open(xml_path, 'r', encoding='utf-8') as xml_file:
+        content = xml_file.read()
+    with open(xml_path, 'w', encoding='utf-8') as xml_file:
+        xml_file.write(edit(content))
+
+
+def insert_last_paragraph(content):
+    position = content.rindex('</p>')
+    return content[:position] + ' de <persName>Juan</persName>.' + content[position:]
+
+
+def insert_first_div(content):
+    # Every div after it changes its number
+    position = content.index('<body>') + len('<body>')
+    return content[:position] + '<div><p>Nuevo <persName>Pedro</persName>.</p></div>' + content[position:]
+
+
+@pytest.mark.parametrize('edit', [insert_last_paragraph, insert_first_div], ids=['last_paragraph', 'first_div'])
+def test_changed_file_reuses_divs(family, tmp_path, capsys, edit):
+    xml_path = write_random_tei(str(tmp_path / 'random.xml'), 0, paragraphs=150)
+    extract(family, tmp_path / 'cache', xml_path)
+    edit_file(xml_path, edit)
+
+    capsys.readouterr()
+    entity_dictionary, _ = extract(family, tmp_path / 'cache', xml_path)
+    stats = re.search(r'(\d+) divs reused, (\d+) processed', capsys.readouterr().out)
+
+    assert int(stats.group(1)) > 0 and int(stats.group(2)) > 0
+    expected = family('prompt_generator').phrase_extraction(xml_path=xml_path, records=True)
+    assert record_fields(entity_dictionary) == record_fields(expected)
+
+
+def test_prompt_store_from_cache(family, tmp_path):
+    xml_path = write_random_tei(str(tmp_path / 'random.xml'), 1, paragraphs=150)
+    prompt_generator = family('prompt_generator')
+    entity_dictionary = prompt_generator.phrase_extraction(xml_path=xml_path, records=True)
+    expected = list(prompt_generator.iter_prompts(entity_dictionary, full_extraction=True, with_provenance=True))
+
+    store = family('prompt_store').PromptStore(str(tmp_path / 'prompts.jsonl'))
+    extract(family, tmp_path / 'cache', xml_path, full_extraction=True, prompt_store=store)
+    assert list(store.iter_prompts(with_provenance=True)) == expected
+
+
+# Large enough to cross the phrases of several entity counts and documents
+@pytest.mark.parametrize('budgets', [(None, 150), (300, None), (300, 150)], ids=['per_document', 'total', 'both'])
+def test_cached_budgets_match_uncached(family, tmp_path, budgets):
+    max_prompts, max_prompts_per_document = budgets
+    corpus = tmp_path / 'corpus'
+    corpus.mkdir()
+    for seed in range(3):
+        write_random_tei(str(corpus / f'{seed}.xml'), seed, paragraphs=150)
+
+    entity_dictionary = family('corpus_ingestion').corpus_phrase_extraction(str(corpus), max_workers=1, records=True)
+    options = {
+        'full_extraction': True,
+        'max_prompts': max_prompts,
+        'max_prompts_per_document': max_prompts_per_document
+    }
+    expected = list(family('prompt_generator').iter_prompts(entity_dictionary, with_provenance=True, **options))
+
+    for _ in range(2):
+        _, prompts = extract(family, tmp_path / 'cache', str(corpus), max_workers=2, **options)
+        assert prompts == expected
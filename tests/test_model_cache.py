@@ -0,0 +1,116 @@
+import os
+
+import pytest
+
+torch = pytest.importorskip('torch')
+transformers = pytest.importorskip('transformers')
+
+
+@pytest.fixture
+def checkpoint(family, tmp_path):
+    '''A tiny random checkpoint of the model family.'''
+    if family('model_cache').__name__.startswith('Ro_'):
+        config_class, model_class = transformers.RobertaConfig, transformers.RobertaForMaskedLM
+    else:
+        config_class, model_class = transformers.BertConfig, transformers.BertForMaskedLM
+    torch.manual_seed(0)
+    config = config_class(vocab_size=100, hidden_size=32, num_hidden_layers=2, num_attention_heads=2, intermediate_size=64)
+    model_path = str(tmp_path / 'model')
+    model_class(config).save_pretrained(model_path)
+    return model_path
+
+
+def test_quantized_cache_matches_quantization(family, checkpoint, tmp_path):
+    model_cache = family('model_cache')
+    cache_dir = str(tmp_path / 'quantized')
+    input_ids = torch.randint(5, 100, (3, 12))
+
+    quantized = model_cache.load_model(checkpoint, precision='int8', quantized_cache_dir=cache_dir)
+    with torch.no_grad():
+        expected = quantized(input_ids=input_ids).logits
+    model_cache.clear_model_cache()
+
+    # Only a state dict is saved, so it is read without unpickling arbitrary objects
+    [cache_file] = os.listdir(cache_dir)
+    state_dict = torch.load(os.path.join(cache_dir, cache_file), map_location='cpu', weights_only=True)
+    assert isinstance(state_dict, dict)
+
+    cached = model_cache.load_model(checkpoint, precision='int8', quantized_cache_dir=cache_dir)
+    assert cached is not quantized
+    assert isinstance(cached.base_model.encoder.layer[0].attention.self.query, torch.ao.nn.quantized.dynamic.Linear)
+    with torch.no_grad():
+        assert torch.equal(cached(input_ids=input_ids).logits, expected)
+    model_cache.clear_model_cache()
+
+
+def test_checkpoint_without_tokenizer_uses_fallback(family, tiny_checkpoint, tmp_path):
+    model_cache = family('model_cache')
+    # A fine-tuned checkpoint saved without its tokenizer
+    fine_tuned = str(tmp_path / 'fine_tuned')
+    transformers.AutoModelForMaskedLM.from_pretrained(tiny_checkpoint).save_pretrained(fine_tuned)
+    assert not any(os.path.isfile(os.path.join(fine_tuned, name)) for name in model_cache.TOKENIZER_FILES)
+
+    tokenizer = model_cache.load_tokenizer(fine_tuned, fallback=tiny_checkpoint)
+
+    assert tokenizer is model_cache.load_tokenizer(tiny_checkpoint)
+    assert tokenizer is model_cache.load_tokenizer(fine_tuned, fallback=tiny_checkpoint)
+    model_cache.clear_model_cache()
+
+
+def test_checkpoint_with_tokenizer_ignores_fallback(family, tiny_checkpoint, tmp_path):
+    model_cache = family('model_cache')
+    fallback = str(tmp_path / 'missing')
+
+    tokenizer = model_cache.load_tokenizer(tiny_checkpoint, fallback=fallback)
+
+    assert tokenizer.get_vocab() == transformers.AutoTokenizer.from_pretrained(tiny_checkpoint).get_vocab()
+    assert tokenizer is model_cache.load_tokenizer(tiny_checkpoint)
+    model_cache.clear_model_cache()
+
+
+def test_hub_models_are_cached_by_commit(family, monkeypatch):
+    model_cache = family('model_cache')
+    commits = {'org/model': 'a' * 40}
+
+    def cached_file(model_path, filename):
+        if model_path not in commits:
+            raise OSError(f'{model_path} is not in the cache')
+        return f'/hub/models--{model_path.replace("/", "--")}/snapshots/{commits[model_path]}/{filename}'
+    monkeypatch.setattr(model_cache, 'cached_file', cached_file)
+
+    key = model_cache._checkpoint_key('org/model')
+    assert key == model_cache._checkpoint_key('org/model')
+    # A new commit of the same model
+    commits['org/model'] = 'b' * 40
+    assert model_cache._checkpoint_key('org/model') != key
+    assert model_cache._checkpoint_key('org/unknown') is None
+
+
+def test_unknown_revision_is_not_cached(family, checkpoint, tmp_path, monkeypatch):
+    model_cache = family('model_cache')
+    cache_dir = tmp_path / 'quantized'
+    monkeypatch.setattr(model_cache, '_checkpoint_key', lambda model_path: None)
+
+    model = model_cache.load_model(checkpoint, precision='int8', quantized_cache_dir=str(cache_dir))
+    model_cache.clear_model_cache()
+
+    assert isinstance(model.base_model.encoder.layer[0].attention.self.query, torch.ao.nn.quantized.dynamic.Linear)
+    assert not cache_dir.exists() or not os.listdir(cache_dir)
+
+
+def test_identical_predictions_agree(family, tiny_checkpoint, tiny_inputs, monkeypatch):
+    pytest.importorskip('sklearn')
+    model_cache = family('model_cache')
+    # The int8 model is the float32 one
+    monkeypatch.setattr(model_cache, 'quantize_model', lambda model: model.eval())
+    model_cache.clear_model_cache()
+
+    agreement = family('quantization').quantization_agreement(
+        tiny_inputs, tiny_checkpoint, tokenizer_name=tiny_checkpoint, sample_size=30
+    )
+    model_cache.clear_model_cache()
+
+    assert agreement['prompts'] == 30
+    assert agreement['masks'] >= 30
+    assert agreement['top1_agreement'] == 1.0
+    assert agreement['ari'] == 1.0
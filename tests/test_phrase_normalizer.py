@@ -0,0 +1,239 @@
+import json
+import os
+import random
+
+import pytest
+
+from baseline import (
+    baseline_mark_types,
+    baseline_paragraph_phrases,
+    baseline_phrase_extraction,
+    baseline_phrase_list,
+    baseline_split,
+    random_text,
+    write_random_tei
+)
+
+BUFFER_SIZES = [0, 1, 2, 3, 7, 64, 65536]
+
+
+def normalize_in_fragments(normalizer, fragments):
+    phrases = []
+    for fragment in fragments:
+        phrases.extend(normalizer.feed(fragment))
+    return phrases + normalizer.close()
+
+
+def label_in_fragments(normalizer, fragments, first=0):
+    phrases = []
+    for index, fragment in enumerate(fragments, first):
+        phrases.extend(normalizer.feed(fragment, index))
+    return phrases + normalizer.close()
+
+
+def paragraphs(family, xml_path, tree_order=True):
+    return list(family('prompt_generator').iter_paragraphs(xml_path, tree_order=tree_order))
+
+
+# The tree parse, the streaming mode in document order and the streaming mode in tree order
+@pytest.mark.parametrize(
+    'streaming, tree_order',
+    [(False, False), (True, False), (True, True)],
+    ids=['tree', 'streaming', 'streaming_tree_order']
+)
+def test_phrase_extraction_matches_baseline(family, edge_cases_xml, streaming, tree_order):
+    phrase_extraction = lambda **options: family('prompt_generator').phrase_extraction(
+        xml_path=edge_cases_xml, streaming=streaming, tree_order=tree_order, **options
+    )
+    document_order = streaming and not tree_order
+
+    assert phrase_extraction() == baseline_phrase_extraction(edge_cases_xml, document_order=document_order)
+    assert phrase_extraction(return_dict=False) == \
+        baseline_phrase_extraction(edge_cases_xml, return_dict=False, document_order=document_order)
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_streaming_matches_baseline_on_random_documents(family, tmp_path, seed):
+    xml_path = write_random_tei(str(tmp_path / 'random.xml'), seed)
+    phrase_extraction = family('prompt_generator').phrase_extraction
+
+    assert phrase_extraction(xml_path=xml_path, streaming=True) == baseline_phrase_extraction(xml_path, document_order=True)
+    assert phrase_extraction(xml_path=xml_path, streaming=True, tree_order=True) == baseline_phrase_extraction(xml_path)
+    assert phrase_extraction(xml_path=xml_path, streaming=False) == baseline_phrase_extraction(xml_path)
+
+
+def test_records_match_baseline_phrases(family, edge_cases_xml):
+    records = family('prompt_generator').phrase_extraction(xml_path=edge_cases_xml, records=True)
+    expected = baseline_phrase_extraction(edge_cases_xml, document_order=True)
+
+    assert {count: [record.text for record in phrases] for count, phrases in records.items()} == \
+        {count: [phrase.replace('$', '') for phrase in phrases] for count, phrases in expected.items()}
+
+
+@pytest.mark.parametrize('buffer_size', BUFFER_SIZES)
+def test_normalizer_buffer_sizes(family, edge_cases_xml, buffer_size):
+    normalizer = family('auxiliary_function_XML_process').PhraseNormalizer(buffer_size=buffer_size)
+
+    assert normalize_in_fragments(normalizer, paragraphs(family, edge_cases_xml)) == baseline_phrase_list(edge_cases_xml)
+
+
+@pytest.mark.parametrize('seed', range(30))
+def test_normalizer_cut_at_every_position(family, seed):
+    PhraseNormalizer = family('auxiliary_function_XML_process').PhraseNormalizer
+    text = random_text(random.Random(seed), 40)
+    expected = baseline_split(text)
+
+    for cut in range(len(text) + 1):
+        for buffer_size in (0, 5):
+            fragments = [text[:cut], text[cut:]]
+            assert normalize_in_fragments(PhraseNormalizer(buffer_size), fragments) == expected, (text, cut)
+
+
+@pytest.mark.parametrize('seed', range(30))
+def test_normalizer_character_by_character(family, seed):
+    PhraseNormalizer = family('auxiliary_function_XML_process').PhraseNormalizer
+    text = random_text(random.Random(seed), 60)
+
+    assert normalize_in_fragments(PhraseNormalizer(buffer_size=0), list(text)) == baseline_split(text)
+
+
+@pytest.mark.parametrize('buffer_size', BUFFER_SIZES)
+def test_normalizer_resumes_from_state(family, edge_cases_xml, buffer_size):
+    PhraseNormalizer = family('auxiliary_function_XML_process').PhraseNormalizer
+    fragments = paragraphs(family, edge_cases_xml)
+    expected = baseline_phrase_list(edge_cases_xml)
+
+    for stop in range(len(fragments) + 1):
+        normalizer = PhraseNormalizer(buffer_size)
+        phrases = []
+        for fragment in fragments[:stop]:
+            phrases.extend(normalizer.feed(fragment))
+        # The state is saved as JSON by the ingestion cache
+        state = json.loads(json.dumps(normalizer.get_state()))
+
+        resumed = PhraseNormalizer(buffer_size)
+        resumed.set_state(state)
+        assert phrases + normalize_in_fragments(resumed, fragments[stop:]) == expected, stop
+
+
+@pytest.mark.parametrize('buffer_size', BUFFER_SIZES)
+def test_normalizer_paragraphs(family, edge_cases_xml, tmp_path, buffer_size):
+    PhraseNormalizer = family('auxiliary_function_XML_process').PhraseNormalizer
+    documents = [edge_cases_xml] + [write_random_tei(str(tmp_path / f'{seed}.xml'), seed) for seed in range(10)]
+
+    for xml_path in documents:
+        fragments = paragraphs(family, xml_path)
+        expected = baseline_paragraph_phrases(fragments)
+        assert label_in_fragments(PhraseNormalizer(buffer_size, paragraphs=True), fragments) == expected, xml_path
+
+
+@pytest.mark.parametrize('seed', range(30))
+def test_normalizer_paragraphs_character_by_character(family, seed):
+    PhraseNormalizer = family('auxiliary_function_XML_process').PhraseNormalizer
+    text = random_text(random.Random(seed), 60)
+
+    labelled = label_in_fragments(PhraseNormalizer(buffer_size=0, paragraphs=True), list(text))
+    assert labelled == baseline_paragraph_phrases(list(text))
+
+
+@pytest.mark.parametrize('buffer_size', [0, 3, 65536])
+def test_normalizer_paragraphs_resume_from_state(family, edge_cases_xml, buffer_size):
+    PhraseNormalizer = family('auxiliary_function_XML_process').PhraseNormalizer
+    fragments = paragraphs(family, edge_cases_xml)
+    expected = baseline_paragraph_phrases(fragments)
+
+    for stop in range(len(fragments) + 1):
+        normalizer = PhraseNormalizer(buffer_size, paragraphs=True)
+        phrases = []
+        for index, fragment in enumerate(fragments[:stop]):
+            phrases.extend(normalizer.feed(fragment, index))
+        state = json.loads(json.dumps(normalizer.get_state()))
+
+        resumed = PhraseNormalizer(buffer_size, paragraphs=True)
+        resumed.set_state(state)
+        phrases += label_in_fragments(resumed, fragments[stop:], stop)
+        assert phrases == expected, stop
+
+
+def test_records_div(family, edge_cases_xml):
+    prompt_generator = family('prompt_generator')
+    divs = [div for div, _ in prompt_generator.iter_paragraphs(edge_cases_xml, with_div=True)]
+    expected = baseline_paragraph_phrases(paragraphs(family, edge_cases_xml, tree_order=False))
+    records = prompt_generator.phrase_extraction(xml_path=edge_cases_xml, return_dict=False, records=True)
+
+    assert [(record.div, record.sentence) for record in records] == \
+        [(divs[index], sentence) for sentence, (index, _) in enumerate(expected)]
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_record_types_do_not_depend_on_buffer(family, tmp_path, seed):
+    auxiliary = family('auxiliary_function_XML_process')
+    xml_path = write_random_tei(str(tmp_path / 'random.xml'), seed, paragraphs=150)
+    mark_types = []
+    fragments = []
+    for div, text in family('prompt_generator').iter_paragraphs(xml_path, with_div=True, mark_types=mark_types):
+        fragments.append((div, text, list(mark_types)))
+        mark_types.clear()
+
+    results = []
+    for buffer_size in (0, 65536):
+        normalizer = auxiliary.PhraseNormalizer(buffer_size, paragraphs=True)
+        builder = auxiliary.PhraseRecordBuilder(xml_path)
+        records = []
+        for div, text, types in fragments:
+            builder.add_paragraph(text, types)
+            records.extend(builder.build(normalizer.feed(text, div)))
+        records.extend(builder.build(normalizer.close()))
+        results.append([(record.text, record.types, record.div, record.sentence) for record in records])
+
+    assert results[0] == results[1]
+
+
+def test_record_types_follow_marks(family, edge_cases_xml, tmp_path):
+    auxiliary = family('auxiliary_function_XML_process')
+    prompt_generator = family('prompt_generator')
+    documents = [edge_cases_xml] + [write_random_tei(str(tmp_path / f'{seed}.xml'), seed) for seed in range(10)]
+
+    for xml_path in documents:
+        mark_types = []
+        fragments = []
+        for text in prompt_generator.iter_paragraphs(xml_path, mark_types=mark_types):
+            fragments.append((text, list(mark_types)))
+            mark_types.clear()
+        phrases = baseline_phrase_list(xml_path, document_order=True)
+        expected = [
+            auxiliary.PhraseRecord.from_phrase(phrase, marks[::2]).types
+            for phrase, marks in zip(phrases, baseline_mark_types(fragments))
+        ]
+        records = prompt_generator.phrase_extraction(xml_path=xml_path, return_dict=False, records=True)
+        assert [record.types for record in records] == expected, xml_path
+
+
+def write_wrapped_tei(path, divs):
+    # TEI exports usually wrap the whole body in a single div
+    parts = ['<?xml version="1.0" encoding="UTF-8"?>\n<TEI xmlns="http://www.tei-c.org/ns/1.0"><text><body><div>']
+    for index in range(divs):
+        parts.append(f'<div><p>Carta {index} de <persName>Juan</persName> a <persName>Pedro</persName>.</p></div>')
+    parts.append('</div></body></text></TEI>\n')
+    with open(path, 'w', encoding='utf-8') as xml_file:
+        xml_file.write(''.join(parts))
+    return path
+
+
+def test_wrapped_divs_are_streamed(family, tmp_path):
+    xml_path = write_wrapped_tei(str(tmp_path / 'wrapped.xml'), 5000)
+    iter_paragraphs = family('prompt_generator').iter_paragraphs
+    size = os.path.getsize(xml_path)
+
+    with open(xml_path, 'rb') as xml_file:
+        div, paragraph_text = next(iter_paragraphs(xml_file, with_div=True))
+        # The first paragraph comes out long before the parser reaches the end of the file
+        assert xml_file.tell() < size / 4
+    assert (div, paragraph_text.split()[:2]) == (2, ['Carta', '0'])
+
+    # In tree order the paragraphs of the nested divs wait for the wrapper div to close
+    with open(xml_path, 'rb') as xml_file:
+        next(iter_paragraphs(xml_file, tree_order=True))
+        assert xml_file.tell() == size
+
+    assert list(iter_paragraphs(xml_path)) == list(iter_paragraphs(xml_path, tree_order=True))
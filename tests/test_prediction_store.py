@@ -0,0 +1,81 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+pd = pytest.importorskip('pandas')
+
+
+@pytest.fixture
+def predictions():
+    rng = np.random.default_rng(0)
+    prompt_index = np.repeat(np.arange(30), rng.integers(1, 3, size=30))
+    return (
+        rng.standard_normal((len(prompt_index), 6)).astype(np.float32),
+        rng.integers(0, 50000, size=(len(prompt_index), 4)).astype(np.int32),
+        prompt_index
+    )
+
+
+@pytest.mark.parametrize('embedding_dtype', ['float32', 'float16'])
+def test_store_round_trip(family, predictions, tmp_path, embedding_dtype):
+    PredictionStore = family('prediction_store').PredictionStore
+    vectors, top_ids, prompt_index = predictions
+    store = PredictionStore(str(tmp_path / 'store')).create(0, 6, 4, embedding_dtype)
+    # Appended in uneven chunks, as the batches are inferred
+    for start, stop in [(0, 7), (7, 8), (8, len(vectors))]:
+        store.append(vectors[start:stop], top_ids[start:stop], prompt_index[start:stop])
+    assert not store.is_complete()
+    store.close()
+
+    # A new process opens it from the files
+    store = PredictionStore(str(tmp_path / 'store')).open()
+    assert len(store) == len(vectors)
+    assert store.embeddings.dtype == np.dtype(embedding_dtype)
+    assert np.array_equal(store.embeddings, vectors.astype(embedding_dtype))
+    assert np.array_equal(store.top_ids, top_ids)
+    assert np.array_equal(store.prompt_index, prompt_index)
+
+    labels = np.arange(len(vectors)) % 3
+    store.save_column('cluster', labels)
+    dataframe = store.to_dataframe()
+    assert list(dataframe.columns) == ['predicted_token', 'mask_embedding', 'prompt_index', 'cluster']
+    assert np.array_equal(np.stack(dataframe['mask_embedding'].to_list()), vectors.astype(embedding_dtype).astype(np.float32))
+    assert dataframe['cluster'].tolist() == labels.tolist()
+    pd.testing.assert_frame_equal(pd.concat(store.iter_dataframes(chunk_size=7)), dataframe)
+
+
+def test_incomplete_store_is_not_opened(family, predictions, tmp_path):
+    PredictionStore = family('prediction_store').PredictionStore
+    store = PredictionStore(str(tmp_path / 'store')).create(len(predictions[0]), 6, 4)
+    store.flush()
+
+    with pytest.raises(ValueError):
+        PredictionStore(str(tmp_path / 'store')).open()
+
+
+def test_take_copies_the_rows(family, predictions, tmp_path):
+    PredictionStore = family('prediction_store').PredictionStore
+    vectors, top_ids, prompt_index = predictions
+    store = PredictionStore(str(tmp_path / 'store')).create(0, 6, 4)
+    store.append(vectors, top_ids, prompt_index)
+    store = store.close()
+    rows = np.array([5, 0, 5, len(vectors) - 1])
+
+    taken = store.take(rows, str(tmp_path / 'taken'), chunk_size=3)
+
+    assert np.array_equal(taken.embeddings, vectors[rows])
+    assert np.array_equal(taken.top_ids, top_ids[rows])
+    assert np.array_equal(taken.prompt_index, prompt_index[rows])
+
+
+def test_store_matches_the_dataframe(tiny_inputs, extract_predictions, tmp_path):
+    expected = extract_predictions(tiny_inputs)
+
+    store = extract_predictions(tiny_inputs, prediction_dir=str(tmp_path / 'store'), chunk_size=8)
+    dataframe = store.to_dataframe()
+
+    assert list(dataframe.columns) == list(expected.columns)
+    assert dataframe['predicted_token'].map(list).tolist() == expected['predicted_token'].map(list).tolist()
+    assert dataframe['prompt_index'].tolist() == expected['prompt_index'].tolist()
+    # The store rebuilds the phrase from the prompt text as attach_provenance does, stripped
+    assert dataframe['predicted_phrase'].tolist() == expected['predicted_phrase'].str.strip().tolist()
+    assert np.array_equal(np.stack(dataframe['mask_embedding'].to_list()), np.stack(expected['mask_embedding'].to_list()))
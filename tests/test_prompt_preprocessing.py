@@ -0,0 +1,73 @@
+import random
+
+import pytest
+
+pytest.importorskip('transformers')
+np = pytest.importorskip('numpy')
+pd = pytest.importorskip('pandas')
+
+
+def mask_rows(prompts):
+    '''The rows a deterministic inference would give: one per mask, the prediction only depends on the text.'''
+    rows = []
+    for prompt_index, prompt in enumerate(prompts):
+        for mask in range(prompt.count('[MASK]')):
+            rows.append({'predicted_token': f'{prompt}#{mask}', 'prompt_index': prompt_index})
+    return pd.DataFrame(rows, columns=['predicted_token', 'prompt_index'])
+
+
+def shuffle_prompts(dataframe):
+    # The batches can come in any order, the masks of a prompt stay in their order
+    order = list(dict.fromkeys(dataframe['prompt_index']))
+    random.Random(0).shuffle(order)
+    rows = dataframe.groupby('prompt_index', sort=False).indices
+    return dataframe.iloc[[row for prompt_index in order for row in rows[prompt_index]]].reset_index(drop=True)
+
+
+@pytest.fixture
+def prompts():
+    rng = random.Random(0)
+    texts = [f'[CLS] frase {index} [MASK]' + ' y [MASK]' * (index % 3 == 0) + ' [SEP]' for index in range(40)]
+    # Repeated formulae, with prompts without masks in between
+    return [rng.choice(texts) for _ in range(300)] + ['[CLS] sin mascara [SEP]'] * 3
+
+
+def test_deduplicate_keeps_first_appearance(family, prompts):
+    unique_prompts, inverse = family('prompt_preprocessing').deduplicate_prompts(prompts)
+
+    assert unique_prompts == list(dict.fromkeys(prompts))
+    assert [unique_prompts[unique] for unique in inverse] == prompts
+
+
+def test_expand_after_deduplicate_is_identity(family, prompts):
+    prompt_preprocessing = family('prompt_preprocessing')
+    unique_prompts, inverse = prompt_preprocessing.deduplicate_prompts(prompts)
+
+    unique_rows = shuffle_prompts(mask_rows(unique_prompts))
+    expanded = prompt_preprocessing.expand_predictions(unique_rows, inverse)
+
+    pd.testing.assert_frame_equal(expanded, mask_rows(prompts))
+
+
+def test_expand_prediction_store_is_identity(family, prompts, tmp_path):
+    prompt_preprocessing = family('prompt_preprocessing')
+    unique_prompts, inverse = prompt_preprocessing.deduplicate_prompts(prompts)
+    # The rows of every unique prompt hold its index, so the expansion can be followed
+    unique_rows = shuffle_prompts(mask_rows(unique_prompts))
+    unique_index = unique_rows['prompt_index'].to_numpy()
+
+    store = family('prediction_store').PredictionStore(str(tmp_path / 'unique')).create(len(unique_rows), 2, 1)
+    store.embeddings[:] = np.stack([unique_index, np.arange(len(unique_rows))], axis=1)
+    store.top_ids[:, 0] = unique_index
+    store.prompt_index[:] = unique_index
+    store = store.close()
+
+    expanded = prompt_preprocessing.expand_prediction_store(store, inverse, str(tmp_path / 'expanded'))
+
+    expected = mask_rows(prompts)
+    assert expanded.prompt_index.tolist() == expected['prompt_index'].tolist()
+    assert expanded.top_ids[:, 0].tolist() == [inverse[index] for index in expected['prompt_index']]
+    # Every mask of a unique prompt is copied once per occurrence, in the order of the unique rows
+    for original_index, unique in enumerate(inverse):
+        copied = np.asarray(expanded.embeddings)[np.asarray(expanded.prompt_index) == original_index, 1]
+        assert copied.tolist() == np.flatnonzero(unique_index == unique).astype(float).tolist()
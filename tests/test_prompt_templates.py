@@ -0,0 +1,77 @@
+import pytest
+
+from baseline import baseline_phrase_extraction, baseline_prompts, write_random_tei
+
+FAMILIES = {'': 'bert', 'Ro_': 'roberta'}
+
+
+@pytest.fixture
+def entity_dictionary(edge_cases_xml, tmp_path):
+    dictionary = baseline_phrase_extraction(edge_cases_xml)
+    for seed in range(8):
+        xml_path = write_random_tei(str(tmp_path / f'{seed}.xml'), seed, paragraphs=150)
+        for entity_count, phrases in baseline_phrase_extraction(xml_path).items():
+            dictionary.setdefault(entity_count, []).extend(phrases)
+    assert {1, 2, 3, 4} <= set(dictionary)
+    return {key: dictionary[key] for key in sorted(dictionary)}
+
+
+@pytest.mark.parametrize('full_extraction, entity_number', [(True, 2), (False, 1), (False, 2), (False, 3), (False, 4)])
+@pytest.mark.parametrize('template_set', ['baseline', 'legacy'])
+def test_default_prompts_match_baseline(family, entity_dictionary, full_extraction, entity_number, template_set):
+    prompt_generator = family('prompt_generator')
+    model_family = prompt_generator.MODEL_FAMILY
+
+    prompts = prompt_generator.prompt_generator(
+        entity_dictionary, full_extraction, entity_number, json_file_path_name=None, template_set=template_set
+    )
+    expected = baseline_prompts(
+        entity_dictionary, model_family, full_extraction, entity_number, repetitions=template_set == 'legacy'
+    )
+
+    assert list(prompts) == list(expected)
+    assert prompts == expected
+
+
+@pytest.mark.parametrize('full_extraction', [False, True])
+def test_baseline_templates_are_not_repeated(family, full_extraction):
+    prompt_templates = family('prompt_templates')
+
+    for model_family in ('bert', 'roberta'):
+        templates = prompt_templates.compile_templates(model_family, 'baseline', full_extraction)
+        for entity_count, group in templates.items():
+            for template_id, variants in group.items():
+                assert len(set(variants)) == len(variants), (model_family, entity_count, template_id)
+
+
+def test_default_prompts_of_records_match_baseline(family, edge_cases_xml):
+    prompt_generator = family('prompt_generator')
+    records = prompt_generator.phrase_extraction(xml_path=edge_cases_xml, records=True, tree_order=True)
+
+    prompts = prompt_generator.prompt_generator(records, True, json_file_path_name=None)
+    expected = baseline_prompts(baseline_phrase_extraction(edge_cases_xml), prompt_generator.MODEL_FAMILY, True, repetitions=False)
+
+    assert prompts == expected
+
+
+def test_uniform_templates_cover_every_pair(family, entity_dictionary):
+    prompt_generator = family('prompt_generator')
+    prompts = prompt_generator.prompt_generator(
+        entity_dictionary, True, json_file_path_name=None, pair_policy='all', template_set='uniform'
+    )
+    tokens = family('prompt_templates').SPECIAL_TOKENS[prompt_generator.MODEL_FAMILY]
+
+    for entity_count, phrases in entity_dictionary.items():
+        if entity_count < 2:
+            continue
+        pairs = entity_count * (entity_count - 1) // 2
+        assert len(prompts[f'prompt_0_ent_{entity_count}']) == pairs * len(phrases)
+        assert len(prompts[f'prompt_5_ent_{entity_count}']) == 2 * pairs * len(phrases)
+    for key, values in prompts.items():
+        ending = '. {sep}'.format(**tokens) if key.startswith('prompt_0_ent') else '{mask}. {sep}'.format(**tokens)
+        assert all(prompt.endswith(ending) for prompt in values), key
+
+
+def test_unknown_template_set(family):
+    with pytest.raises(ValueError):
+        family('prompt_templates').compile_templates('bert', 'other')
@@ -0,0 +1,115 @@
+import importlib
+
+import pytest
+
+pytest.importorskip('transformers')
+pytest.importorskip('tokenizers')
+
+from baseline import write_random_tei
+from offline_tokenizers import OFFLINE_TOKENIZERS, REAL_TOKENIZERS, offline_tokenizer, real_tokenizer
+
+PREFIXES = {'bert': '', 'roberta': 'Ro_'}
+
+# Accented and combining characters, in both normalization forms, and names with periods
+ENTITIES = [
+    'Jos\u00e9', 'Jose\u0301', 'N\u00fa\u00f1ez', 'Nu\u0301n\u0303ez', 'Mu\u00f1oz', 'Gon\u00e7alves', "O'Neill", 'd\u2019\u00c1vila',
+    'S\u00e3o Tom\u00e9', '\u00c6r\u00f8', '1560', 'S. Juan', 'fol. 3', '\u00abGuanahan\u00ed\u00bb', 'Ca(1)', '-Pedro', 'Lima,', 'Juan de Ribera'
+]
+PHRASES = [
+    'El escribano Juan dio poder a Pedro.',
+    'Lo dijo el Sr. Pérez en la pág. 3.',
+    'En la ciudad de S. Juan a 3 de mayo.',
+    'Ante mí, José Núñez: testigo.',
+    'Otorgó carta de pago. Y se obligó.',
+    'Nu\u0303n\u0303ez y Mun\u0303oz vecinos de Sevilla...',
+    '«Lima» (sic) [roto] - dicho día.'
+]
+
+
+def corpus_prompts(module, corpus: str) -> list:
+    corpus_ingestion = module('corpus_ingestion')
+    prompt_generator = module('prompt_generator')
+    prompt_templates = module('prompt_templates')
+    entity_dictionary = corpus_ingestion.corpus_phrase_extraction(corpus, max_workers=1, records=True)
+
+    prompts = []
+    for template_set in prompt_templates.TEMPLATE_SETS:
+        for full_extraction in (False, True):
+            for pair_policy in ('baseline', 'all'):
+                prompts.extend(
+                    text for _, _, text in prompt_generator.iter_prompts(
+                        entity_dictionary,
+                        full_extraction=full_extraction,
+                        entity_number=3,
+                        pair_policy=pair_policy,
+                        template_set=template_set
+                    )
+                )
+    return prompts
+
+
+def variant_prompts(module, model_family: str) -> list:
+    # Every variant of every template set, with the tricky phrases and entities
+    prompt_templates = module('prompt_templates')
+    tokens = prompt_templates.special_tokens(model_family)
+    return [
+        variant.format(**tokens, phrase=phrase, head=head, tail=tail)
+        for variant in prompt_templates.all_template_variants()
+        for phrase in PHRASES
+        for head, tail in zip(ENTITIES, ENTITIES[1:] + ENTITIES[:1])
+    ]
+
+
+@pytest.fixture(scope='module')
+def corpus(tmp_path_factory):
+    directory = tmp_path_factory.mktemp('corpus')
+    for seed in range(2):
+        write_random_tei(str(directory / f'{seed}.xml'), seed, paragraphs=60)
+    return str(directory)
+
+
+@pytest.fixture(scope='module', params=list(REAL_TOKENIZERS) + list(OFFLINE_TOKENIZERS))
+def tokenized(request, corpus):
+    '''The modules, the prompts of every template variant and the tokenizer of a model.'''
+    name = request.param
+    model_family = REAL_TOKENIZERS[name][2] if name in REAL_TOKENIZERS else OFFLINE_TOKENIZERS[name]
+    module = lambda module_name: importlib.import_module(PREFIXES[model_family] + module_name)
+    if name in REAL_TOKENIZERS:
+        tokenizer = real_tokenizer(name)
+        if tokenizer is None:
+            pytest.skip(f'{name} tokenizer not available, set {REAL_TOKENIZERS[name][0]}')
+
+    prompts = variant_prompts(module, model_family) + corpus_prompts(module, corpus)
+    if name in OFFLINE_TOKENIZERS:
+        tokenizer = offline_tokenizer(name, prompts + ENTITIES)
+    return module, prompts, tokenizer
+
+
+def test_spliced_matches_full_tokenization(tokenized):
+    module, prompts, tokenizer = tokenized
+    prompt_tokenization = module('prompt_tokenization')
+
+    assert prompt_tokenization.verify_spliced_tokenization(prompts, tokenizer) == []
+
+    # Most prompts must be spliced, or the comparison says nothing
+    spliced_tokenizer = prompt_tokenization.SplicedTokenizer(tokenizer)
+    spliced_tokenizer(prompts)
+    assert spliced_tokenizer.stats['spliced'] > 0.8 * len(prompts)
+
+
+@pytest.mark.parametrize('max_length', [1, 8, 32])
+def test_spliced_truncation(tokenized, max_length):
+    module, prompts, tokenizer = tokenized
+
+    assert module('prompt_tokenization').verify_spliced_tokenization(prompts, tokenizer, max_length=max_length) == []
+
+
+def test_every_variant_is_spliced(tokenized):
+    module, _, tokenizer = tokenized
+    prompt_templates = module('prompt_templates')
+    spliced_tokenizer = module('prompt_tokenization').SplicedTokenizer(tokenizer)
+    tokens = prompt_templates.special_tokens(tokenizer)
+
+    for variant in prompt_templates.all_template_variants():
+        prompt = variant.format(**tokens, phrase=PHRASES[0], head='Juan', tail='Pedro')
+        assert spliced_tokenizer.split(prompt) is not None, variant
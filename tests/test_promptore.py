@@ -0,0 +1,64 @@
+import os
+import shutil
+
+import pytest
+
+pytest.importorskip('torch')
+pytest.importorskip('sklearn')
+transformers = pytest.importorskip('transformers')
+pd = pytest.importorskip('pandas')
+
+from baseline import write_random_tei
+
+
+def run_models(family):
+    '''The run_models of the pipeline of the family.'''
+    if family('model_cache').__name__.startswith('Ro_'):
+        return family('promptORE').pipeline_PromptORE_Roberta().run_models_base
+    return family('PromptORE').pipeline_PromptORE().run_models
+
+
+@pytest.fixture
+def models_path(tiny_checkpoint, tmp_path):
+    '''A directory of two fine-tuned checkpoints with the same tokenizer.'''
+    torch = pytest.importorskip('torch')
+    models_path = tmp_path / 'models'
+    for seed in range(2):
+        model_path = str(models_path / f'checkpoint_{seed}')
+        shutil.copytree(tiny_checkpoint, model_path)
+        model = transformers.AutoModelForMaskedLM.from_pretrained(model_path)
+        generator = torch.Generator().manual_seed(seed)
+        with torch.no_grad():
+            for parameter in model.parameters():
+                parameter.add_(0.02 * torch.randn(parameter.shape, generator=generator))
+        model.save_pretrained(model_path)
+    return str(models_path)
+
+
+@pytest.mark.parametrize('streamed', [False, True], ids=['dataframe', 'store'])
+def test_shared_batches_match_the_sweep(family, models_path, tmp_path, monkeypatch, streamed):
+    # The prompts json is written to the working directory
+    monkeypatch.chdir(tmp_path)
+    xml_path = write_random_tei(str(tmp_path / 'corpus.xml'), 0, paragraphs=20)
+    outputs = {}
+    for shared_batches in [False, True]:
+        output_folder = str(tmp_path / f'shared_{shared_batches}')
+        run_models(family)(
+            xml_input=xml_path,
+            models_path=models_path,
+            output_folder=output_folder,
+            batch_size=8,
+            entity_number=2,
+            embedding='hidden',
+            prediction_dir=str(tmp_path / f'predictions_{shared_batches}') if streamed else None,
+            shared_batches=shared_batches
+        )
+        outputs[shared_batches] = {
+            name: pd.read_csv(os.path.join(output_folder, name)) for name in sorted(os.listdir(output_folder))
+        }
+        family('model_cache').clear_model_cache()
+
+    assert list(outputs[True]) == ['checkpoint_0_clustering.csv', 'checkpoint_1_clustering.csv']
+    assert list(outputs[False]) == list(outputs[True])
+    for name, expected in outputs[False].items():
+        pd.testing.assert_frame_equal(outputs[True][name], expected)
@@ -0,0 +1,68 @@
+import os
+import time
+
+import pytest
+
+pytest.importorskip('torch')
+
+
+# The tasks are module functions so that the spawn start method can pickle them
+def interval(name: str, seconds: float = 0.3):
+    start = time.time()
+    time.sleep(seconds)
+    return name, start, time.time()
+
+
+def fail_some(name: str):
+    if name == 'raises':
+        raise ValueError(f'{name} cannot be inferred')
+    if name == 'killed':
+        # As the system killing the worker
+        os._exit(3)
+    return interval(name, 0.05)
+
+
+def overlap(first: tuple, second: tuple) -> bool:
+    return first[1] < second[2] and second[1] < first[2]
+
+
+def test_failed_jobs_do_not_stop_the_sweep(family):
+    scheduler = family('sweep_scheduler').SweepScheduler(workers=2, threads_per_worker=1)
+    jobs = {name: (name,) for name in ['first', 'raises', 'second', 'killed', 'third']}
+
+    outcomes = scheduler.run(fail_some, jobs)
+
+    assert set(outcomes) == set(jobs)
+    for name in ['first', 'second', 'third']:
+        assert outcomes[name]['status'] == 'done'
+        assert outcomes[name]['result'][0] == name
+    assert outcomes['raises']['status'] == 'failed'
+    assert 'ValueError: raises cannot be inferred' in outcomes['raises']['error']
+    assert outcomes['killed']['status'] == 'failed'
+    assert outcomes['killed']['error'] == 'the worker process exited with code 3'
+
+
+def test_job_waits_for_memory(family):
+    scheduler = family('sweep_scheduler').SweepScheduler(workers=3, threads_per_worker=1, memory_budget=100)
+    jobs = {name: (name,) for name in ['first', 'second', 'third']}
+
+    outcomes = scheduler.run(interval, jobs, memory={'first': 60, 'second': 60, 'third': 30})
+    first, second, third = (outcomes[name]['result'] for name in jobs)
+
+    # The second job does not fit with the first one, and the third one is started in order
+    assert not overlap(first, second)
+    assert not overlap(first, third)
+    assert overlap(second, third)
+
+
+def test_job_larger_than_the_budget_runs_alone(family, capsys):
+    scheduler = family('sweep_scheduler').SweepScheduler(workers=3, threads_per_worker=1, memory_budget=100)
+    jobs = {name: (name,) for name in ['small', 'large', 'last']}
+
+    outcomes = scheduler.run(interval, jobs, memory={'small': 10, 'large': 200, 'last': 10})
+    small, large, last = (outcomes[name]['result'] for name in jobs)
+
+    assert outcomes['large']['status'] == 'done'
+    assert 'large: the estimated' in capsys.readouterr().out
+    assert not overlap(small, large)
+    assert not overlap(large, last)
@@ -0,0 +1,63 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+
+
+@pytest.fixture
+def token_chunks():
+    rng = np.random.default_rng(0)
+    # Chunks of prompts, with an empty prompt and an empty chunk
+    lengths = [[3, 17, 0], [], [9], [512, 1, 4]]
+    return [[rng.integers(0, 50000, size=length).tolist() for length in chunk] for chunk in lengths]
+
+
+def test_shard_round_trip(family, token_chunks, tmp_path):
+    TokenShard = family('token_store').TokenShard
+    input_ids = [ids for chunk in token_chunks for ids in chunk]
+    shard = TokenShard(str(tmp_path / 'shard'), tokenizer_key='tokenizer', prompts_key='prompts')
+    assert not shard.is_complete()
+
+    assert shard.write(iter(token_chunks)) == len(input_ids)
+    assert shard.is_complete()
+
+    # A new run reads it back from the files
+    shard = TokenShard(str(tmp_path / 'shard'), tokenizer_key='tokenizer', prompts_key='prompts').open()
+    assert len(shard) == len(input_ids)
+    assert [shard[index].tolist() for index in range(len(shard))] == input_ids
+    assert isinstance(shard[1], np.memmap)
+    assert shard.meta()['token_count'] == sum(map(len, input_ids))
+
+
+def test_shard_of_other_prompts_is_incomplete(family, token_chunks, tmp_path):
+    TokenShard = family('token_store').TokenShard
+    TokenShard(str(tmp_path / 'shard'), tokenizer_key='tokenizer', prompts_key='prompts').write(token_chunks)
+
+    for keys in [{'tokenizer_key': 'other', 'prompts_key': 'prompts'}, {'tokenizer_key': 'tokenizer', 'prompts_key': 'other'}]:
+        shard = TokenShard(str(tmp_path / 'shard'), **keys)
+        assert not shard.is_complete()
+        with pytest.raises(ValueError):
+            shard.open()
+
+
+def test_empty_shard(family, tmp_path):
+    shard = family('token_store').TokenShard(str(tmp_path / 'shard'))
+
+    assert shard.write([[[], []]]) == 2
+    assert len(shard.open()) == 2
+    assert shard[0].tolist() == shard[1].tolist() == []
+
+
+def test_tokenized_prompts_are_read_from_the_shard(family, tiny_checkpoint, tmp_path, capsys):
+    prompt_preprocessing = family('prompt_preprocessing')
+    tokenize_prompts = getattr(prompt_preprocessing, 'tokenize_prompts_beto', None) or \
+        prompt_preprocessing.tokenize_prompts_Roberta
+    mask = prompt_preprocessing.load_tokenizer(tiny_checkpoint).mask_token
+    prompts = [f'frase {index} con {mask} y {"otra " * index}{mask}.' for index in range(20)]
+    expected = tokenize_prompts(prompts, tokenizer_name=tiny_checkpoint)['input_ids']
+
+    for _ in range(2):
+        shard = tokenize_prompts(
+            prompts, tokenizer_name=tiny_checkpoint, token_cache_dir=str(tmp_path / 'tokens')
+        )
+        assert [shard[index].tolist() for index in range(len(shard))] == expected
+    assert 'Tokenized prompts read from' in capsys.readouterr().out